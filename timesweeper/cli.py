@@ -37,6 +37,29 @@ def ts_main():
         help="<start, stop>. If used, only range(start, stop) will be simulated for reps. \
             This is to allow for easy SLURM parallel simulations.",
     )
+    sim_s_parser.add_argument(
+        "--timeout",
+        required=False,
+        type=float,
+        dest="timeout",
+        help="Seconds to let each SLiM run go before it's killed and listed in <work dir>/sim_failures.tsv. Defaults to no limit.",
+    )
+    sim_s_parser.add_argument(
+        "--burn-ins",
+        required=False,
+        type=int,
+        dest="burn_ins",
+        help="Simulate this many neutral burn-ins once and start every replicate from a random one with a fresh seed, instead of each replicate simulating its own. \
+            Saved to <work dir>/burn_ins/<slimfile name>/ and reused by later runs, delete them after changing the model.",
+    )
+    sim_s_parser.add_argument(
+        "--recapitate",
+        required=False,
+        action="store_true",
+        dest="recapitate",
+        help="Record tree sequences and skip the forward burn-in for neut and sdn replicates, recapitating with msprime and overlaying neutral mutations afterwards. \
+            ssv replicates need standing variation and are still forward-simulated. Needs msprime, pyslim, and tskit (pip install timesweeper[tree-seq]).",
+    )
     sim_s_parser.add_argument(
         metavar="YAML CONFIG",
         dest="yaml_file",
@@ -64,6 +87,14 @@ def ts_main():
         help="<start, stop>. If used, only range(start, stop) will be simulated for reps. \
             This is to allow for easy SLURM parallel simulations.",
     )
+    sim_c_parser.add_argument(
+        "--burn-ins",
+        required=False,
+        type=int,
+        dest="burn_ins",
+        help="Simulate this many neutral burn-ins once and start every replicate from a random one with a fresh seed, instead of each replicate simulating its own. \
+            The SLiM script has to handle the burnInFile and saveBurnIn constants, see constant_population.slim.",
+    )
     sim_c_parser.add_argument(
         "-y",
         "--yaml",
@@ -89,10 +120,67 @@ def ts_main():
         "-t",
         "--threads",
         dest="threads",
-        help="Threads to use for multiprocessing.",
+        type=int,
+        default=mp.cpu_count() - 1,
+        help="Number of processes to parallelize across, each merges one replicate at a time.",
+        required=False,
+    )
+    process_vcf_parser.add_argument(
+        "-y",
+        "--yaml",
+        metavar="YAML_CONFIG",
         required=True,
-    )   
+        dest="yaml_file",
+        help="YAML config file, the number of timepoints is taken from 'sample sizes' (or 'num_sample_points' for sim_custom configs).",
+    )
+    process_vcf_parser.add_argument(
+        "--fail-list",
+        dest="fail_list",
+        required=False,
+        help="File to list replicates that couldn't be processed in, along with their errors. Defaults to <in_dir>/process_failures.tsv.",
+    )
+    process_vcf_parser.add_argument(
+        "--no-progress",
+        action="store_true",
+        dest="no_progress",
+        help="Turn off progress bar.",
+    )
      
+    # index_store.py
+    index_parser = subparsers.add_parser(
+        name="index",
+        help="Converts a merged VCF into a chunked, memory-mappable genotype store that detect, plot_freqs, and plot_bedfile_inputs can read in place of the VCF.",
+    )
+    index_parser.add_argument(
+        "-i",
+        "--input-vcf",
+        dest="input_vcf",
+        help="Merged VCF to convert. Must be merged VCF where files are merged in order from earliest to latest sampling time, -0 flag must be used.",
+        required=True,
+    )
+    index_parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        required=False,
+        help="Directory to write the store to. Defaults to <input_vcf>.tsstore.",
+    )
+    index_parser.add_argument(
+        "--benchmark",
+        dest="benchmark",
+        action="store_true",
+        help="Also store the mutation type and selection coefficient fields written by SLiM, needed for detect --benchmark.",
+        required=False,
+    )
+    index_parser.add_argument(
+        "-y",
+        "--yaml",
+        metavar="YAML_CONFIG",
+        required=True,
+        dest="yaml_file",
+        help="YAML config file with all required options defined.",
+    )
+
     # make_training_features.py
     mtf_parser = subparsers.add_parser(
         name="condense",
@@ -111,9 +199,18 @@ def ts_main():
         "--outfile",
         required=False,
         type=str,
-        default="training_data.pkl",
+        default="training_data",
         dest="outfile",
-        help="Pickle file to dump dictionaries with training data to. Should probably end with .pkl.",
+        help="Directory to stream training data shards to, read lazily by train and plot_training. \
+            Paths ending in .pkl or .pickle get a single pickle of dictionaries instead, like older versions wrote.",
+    )
+    mtf_parser.add_argument(
+        "--overwrite",
+        required=False,
+        action="store_true",
+        dest="overwrite",
+        help="Start an existing training store over and condense every replicate again, instead of only ones that are new or changed since the last run. \
+            Needed to reuse a store condensed with other settings.",
     )
     mtf_parser.add_argument(
         "--subsample-inds",
@@ -209,7 +306,7 @@ def ts_main():
         dest="training_data",
         type=str,
         required=True,
-        help="Pickle file containing data formatted with make_training_features.py.",
+        help="Training data store (or pickle) written by condense.",
     )
     nets_parser.add_argument(
         "-s",
@@ -262,7 +359,7 @@ def ts_main():
         "-i",
         "--input-vcf",
         dest="input_vcf",
-        help="Merged VCF to scan for sweeps. Must be merged VCF where files are merged in order from earliest to latest sampling time, -0 flag must be used.",
+        help="Merged VCF (or genotype store made with `timesweeper index`) to scan for sweeps. Must be merged VCF where files are merged in order from earliest to latest sampling time, -0 flag must be used.",
         required=True,
     )
     sweeps_parser.add_argument(
@@ -288,6 +385,46 @@ def ts_main():
             Otherwise the mutation type will not be looked for in the VCF entry nor reported with results.",
         required=False,
     )
+    sweeps_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of processes to split the genome across. If > 1 the input is scanned in regions using its tabix index \
+            (built if missing) and TF threads are split evenly between workers.",
+    )
+    sweeps_parser.add_argument(
+        "--shard-size",
+        dest="shard_size",
+        type=int,
+        default=5000000,
+        required=False,
+        help="Size in bp of the regions each worker scans at a time when using --workers.",
+    )
+    sweeps_parser.add_argument(
+        "--hft-workers",
+        dest="hft_workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of processes to build HFT windows across when using --hft without --workers. \
+            Haplotypes are shared with the workers through shared memory and models are only loaded in the main process.",
+    )
+    sweeps_parser.add_argument(
+        "--region",
+        dest="region",
+        action="append",
+        required=False,
+        help="Only predict on SNPs in this region, given as chrom:start-end (1-based, inclusive). \
+            Can be given multiple times. Only the region and enough flanking SNPs for full windows are read using the tabix index.",
+    )
+    sweeps_parser.add_argument(
+        "--regions-bed",
+        dest="regions_bed",
+        required=False,
+        help="BED file of regions to predict on, same as giving each line with --region.",
+    )
     sweeps_parser.add_argument(
         "-y",
         "--yaml",
@@ -338,7 +475,7 @@ def ts_main():
         metavar="INPUT PICKLE",
         type=str,
         required=True,
-        help="Pickle file containing dictionary of structure dict[sweep][rep]['aft'] created by make_training_features.py.",
+        help="Training data store written by condense, or a pickle containing dictionary of structure dict[sweep][rep]['aft'] created by make_training_features.py.",
     )
     input_plot_parser.add_argument(
         "--save-example",
@@ -368,7 +505,7 @@ def ts_main():
         metavar="INPUT VCF FILE",
         type=str,
         required=True,
-        help="Merged time-series VCF file to pull SNPs and frequencies from.",
+        help="Merged time-series VCF file (or genotype store made with `timesweeper index`) to pull SNPs and frequencies from.",
     )
     freq_plot_parser.add_argument(
         "-o",
@@ -459,6 +596,10 @@ def ts_main():
         from timesweeper import process_vcfs
         process_vcfs.main(ua)    
 
+    elif ua.mode == "index":
+        from timesweeper import index_store
+        index_store.main(ua)
+
     elif ua.mode == "condense":
         from timesweeper import make_training_features
         make_training_features.main(ua)    
@@ -1,14 +1,21 @@
 import math
+import multiprocessing as mp
 import os
+from collections import Counter
+from functools import partial
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pickle as pkl
 import pandas as pd
 from tensorflow.keras.models import load_model
 from tqdm import tqdm
 
-from timesweeper.make_training_features import prep_ts_aft, get_window_idxs
+from timesweeper import process_vcfs as pv
+from timesweeper.make_training_features import prep_ts_aft_from_counts
 from timesweeper.utils import snp_utils as su
+from timesweeper.utils import store_utils as stu
+from timesweeper.utils import gen_utils as gu
 from timesweeper.utils.gen_utils import read_config, get_logger
 from timesweeper.utils import hap_utils as hu
 
@@ -16,184 +23,286 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 
 logger = get_logger("find_sweeps")
 
+# Number of windows handed to the models at a time, bounds memory of the window tensor
+PRED_BATCH_SIZE = 4096
+# Number of chunks each pipeline stage may run ahead of the next one
+PIPELINE_DEPTH = 2
+# Number of consecutive windows each HFT worker task builds, tasks overlap by win_size - 1 SNPs
+HFT_RANGE_SIZE = 256
 
-def write_preds(scenarios, mut_types, results_dict, outfile, scaler, benchmark, true_class):
+
+def write_preds(scenarios, mut_types, results, outfile, scaler, benchmark, true_class, append=False):
     """
     Writes NN predictions to file.
 
     Args:
-        results_dict (dict): SNP NN prediction scores and window edges.
+        results (dict): Columnar SNP NN prediction scores and window edges, see run_aft_windows().
         outfile (str): File to write results to.
+        append (bool): Append to an existing outfile without a header, for chunks after the first.
     """
-    lab_dict = {idx: s for idx, s in enumerate(scenarios)}
+    snps = results["snps"]
+    class_probs = results["class_probs"]
+    classes = np.array(scenarios)[np.argmax(class_probs, axis=1)]
+    scaled_s = [
+        scaler.inverse_transform(np.asarray(p).reshape(-1, 1)).flatten()
+        for p in results["reg_preds"]
+    ]
+
+    pred_dict = {"Chrom": snps["chrom"], "BP": snps["pos"]}
     if benchmark:
-        chroms, bps, mut_type, true_sel_coeff = zip(*results_dict.keys())
-    else:
-        chroms, bps = zip(*results_dict.keys())
+        pred_dict["Mut_Type"] = snps["mt"]
+        pred_dict["True_Class"] = np.where(
+            np.isin(snps["mt"], mut_types), true_class, scenarios[0]
+        )
+    pred_dict["Pred_Class"] = classes
+    if benchmark:
+        pred_dict["True_Sel_Coeff"] = snps["s"]
+    pred_dict["Win_Start"] = results["win_start"]
+    pred_dict["Win_End"] = results["win_end"]
 
-    class_scores = [[i[0][j] for i in results_dict.values()] for j in range(len(scenarios))]
-    reg_preds = [[i[j+1] for i in results_dict.values()] for j in range(len(scenarios))]
-    left_edges = [i[-2] for i in results_dict.values()]
-    right_edges = [i[-1] for i in results_dict.values()]
-    classes = [lab_dict[np.argmax(i[0])] for i in results_dict.values()]
-    scaled_s = [scaler.inverse_transform(np.array(p).reshape(-1, 1)).squeeze().flatten() for p in reg_preds]
+    for j, s in enumerate(scenarios):
+        pred_dict[f"{s}_Prob"] = class_probs[:, j]
 
-    if benchmark:
-        true_classes = []
-        for i in mut_type:
-            if i in mut_types:
-                true_classes.append(true_class)
-            else:
-                true_classes.append(scenarios[0])
-
-        pred_dict = {                
-                "Chrom": chroms,
-                "BP": bps,
-                "Mut_Type": mut_type,
-                "True_Class": true_classes,
-                "Pred_Class": classes,
-                "True_Sel_Coeff": true_sel_coeff,
-                "Win_Start": left_edges,
-                "Win_End": right_edges}
-        
-        for s,c in zip(scenarios, class_scores):
-            pred_dict[f"{s}_Prob"] = c
-            
-        for s,c in zip(scenarios[1:], scaled_s):
-            pred_dict[f"{s}_selcoeff_pred"] = c
-
-        predictions = pd.DataFrame(pred_dict)
-    
-    else:
-        pred_dict = {                
-                "Chrom": chroms,
-                "BP": bps,
-                "Pred_Class": classes,
-                "Win_Start": left_edges,
-                "Win_End": right_edges}
-        
-        for s,c in zip(scenarios, class_scores):
-            pred_dict[f"{s}_Prob"] = c
-            
-        for s,c in zip(scenarios[1:], scaled_s):
-            pred_dict[f"{s}_selcoeff_pred"] = c
-
-        predictions = pd.DataFrame(pred_dict)
+    for s, c in zip(scenarios[1:], scaled_s):
+        pred_dict[f"{s}_selcoeff_pred"] = c
 
+    predictions = pd.DataFrame(pred_dict)
     predictions.sort_values(["Chrom", "BP"], inplace=True)
 
-    predictions.to_csv(outfile, header=True, index=False, sep="\t")
+    mode = "a" if append else "w"
+    predictions.to_csv(outfile, mode=mode, header=not append, index=False, sep="\t")
 
     bed_df = predictions[["Chrom", "Win_Start", "Win_End", "BP"]]
     bed_df.to_csv(
-        outfile.replace(".csv", ".bed"), mode="a", header=False, index=False, sep="\t"
+        outfile.replace(".csv", ".bed"), mode=mode, header=False, index=False, sep="\t"
     )
 
 
+def make_results(snps, centers, buffer, class_probs, reg_preds):
+    """
+    Bundles predictions for each window center into columnar arrays.
+
+    Args:
+        snps (np.arr): Structured array of SNP info, see su.make_loc_arr().
+        centers (np.arr): Index of the central SNP of each window.
+        buffer (int): Number of SNPs on either side of the center.
+        class_probs (np.arr): Class probabilities of shape (windows, classes).
+        reg_preds (list[np.arr]): Selection coefficient predictions, one array per regression model.
+
+    Returns:
+        dict: snps, class_probs, reg_preds, win_start, and win_end arrays, all indexed by window.
+    """
+    return {
+        "snps": snps[centers],
+        "class_probs": class_probs,
+        "reg_preds": reg_preds,
+        "win_start": snps["pos"][centers - buffer],
+        "win_end": snps["pos"][centers + buffer],
+    }
+
+
+def iter_window_batches(arr, win_size, batch_size=PRED_BATCH_SIZE):
+    """
+    Slides a window along the SNP axis of a (timepoints, snps) array without copying it.
+
+    Args:
+        arr (np.arr): Time-series array with SNPs on axis 1.
+        win_size (int): Number of SNPs in each window, centered on the SNP being predicted.
+        batch_size (int, optional): Number of windows to yield at a time.
+
+    Yields:
+        np.arr: Contiguous batch of windows with shape (windows, timepoints, win_size), one per center in order.
+    """
+    buffer = math.floor(win_size / 2)
+    # (timepoints, windows, win) view -> (windows, timepoints, win) view, nothing copied yet
+    windows = np.moveaxis(sliding_window_view(arr, 2 * buffer + 1, axis=1), 1, 0)
+    for start in range(0, len(windows), batch_size):
+        yield np.ascontiguousarray(windows[start : start + batch_size])
+
+
+def predict_batches(batches, class_model, reg_models):
+    """
+    Runs the class and regression models over each batch, so only one batch is in memory at a time.
+
+    Args:
+        batches (iterable[np.arr]): Batches of input windows.
+        class_model (Keras.model): Classification model.
+        reg_models (dict[str, Keras.model]): Regression models keyed by scenario.
+
+    Returns:
+        tuple[np.arr, list[np.arr]]: Class probabilities and predictions of each regression model.
+    """
+    class_probs = []
+    reg_preds = [[] for _ in reg_models]
+    for batch in batches:
+        class_probs.append(class_model.predict(batch, verbose=0))
+        for preds, model in zip(reg_preds, reg_models.values()):
+            preds.append(model.predict(batch, verbose=0))
+
+    return np.concatenate(class_probs), [np.concatenate(p) for p in reg_preds]
+
+
 def run_aft_windows(
-    snps, genos, samp_sizes, win_size, class_model, reg_models
+    snps, ts_aft, win_size, class_model, reg_models
 ):
     """
     Iterates through windows of MAF time-series matrix and predicts using NN.
 
     Args:
-        snps (list[tup(chrom, pos,  mut)]): Tuples of information for each SNP. Contains mut only if benchmarking == True.
-        genos (allel.GenotypeArray): Genotypes of all samples.
-        samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
+        snps (np.arr): Structured array of SNP info, see su.make_loc_arr(). Contains mt and s only if benchmarking == True.
+        ts_aft (np.arr): Minor allele frequency time-series of shape (timepoints, snps), see prep_ts_aft_from_counts().
         win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
         model (Keras.model): Keras model to use for prediction.
 
     Returns:
-        dict: Prediction values in the form of dict[snps[center]]
-        np.arr: the central-most window, either based on mutation type or closest to half size of chrom.
+        dict: Columnar predictions and window edges, see make_results().
+    """
+    buffer = math.floor(win_size / 2)
+    centers = np.arange(buffer, len(snps) - buffer)
+
+    batches = tqdm(
+        iter_window_batches(ts_aft, win_size),
+        total=math.ceil(len(centers) / PRED_BATCH_SIZE),
+        desc="Predicting on AFT windows",
+    )
+    class_probs, reg_preds = predict_batches(batches, class_model, reg_models)
+
+    return make_results(snps, centers, buffer, class_probs, reg_preds)
+
+
+def hft_range_worker(bounds, shared_haps, samp_sizes, win_size, n_classes=None):
+    """
+    Builds HFTs of a contiguous range of windows from haplotypes in shared memory.
+
+    Args:
+        bounds (tuple[int, int]): First and one past the last window to build, indexed by the window's first SNP.
+        shared_haps (tuple): Handle of the (snps, chromosomes) haplotype array, see gu.share_array().
+        samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
+        win_size (int): Number of SNPs in each window.
+        n_classes (int, optional): Number of HFT columns to keep, see hu.hft_from_classes().
+
+    Returns:
+        np.arr: HFTs of shape (windows, timepoints, n_classes or sum(samp_sizes)).
+    """
+    start, stop = bounds
+    shm, haps = gu.attach_shared_array(*shared_haps)
+    try:
+        return np.stack(
+            list(
+                hu.iter_rolling_hfts(
+                    haps[start : stop + win_size - 1], samp_sizes, win_size, n_classes
+                )
+            )
+        )
+    finally:
+        del haps
+        shm.close()
+
+
+def iter_hft_batches(
+    haps,
+    ploidy,
+    samp_sizes,
+    win_size,
+    batch_size=PRED_BATCH_SIZE,
+    pool=None,
+    n_classes=None,
+):
     """
-    ts_aft = prep_ts_aft(genos, samp_sizes)
+    Rolls a window along the haplotypes and yields HFTs of consecutive centers in batches of batch_size windows.
+    With a pool each batch is split into contiguous ranges of windows built by the workers, and the next batch is
+        built while the current one is being predicted on.
 
-    # Iterate over SNP windows and predict
+    Args:
+        haps (np.arr): Haplotypes of shape (snps, chromosomes).
+        ploidy (int): Ploidy of samples.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        win_size (int): Number of SNPs in each window, centered on the SNP being predicted.
+        batch_size (int, optional): Number of windows to yield at a time.
+        pool (multiprocessing.Pool, optional): Workers from gu.make_shared_pool(). Defaults to building HFTs in this process.
+        n_classes (int, optional): Number of HFT columns to keep, needs to match how NN was trained. See hu.hft_from_classes().
+
+    Yields:
+        np.arr: Batch of HFTs with shape (windows, timepoints, n_classes or sum(samp_sizes) * ploidy), one per center in order.
+    """
     buffer = math.floor(win_size / 2)
+    hap_sizes = [i * ploidy for i in samp_sizes]
+    if pool is None:
+        hfts = hu.iter_rolling_hfts(haps, hap_sizes, 2 * buffer + 1, n_classes)
+        while True:
+            batch = [hft for _, hft in zip(range(batch_size), hfts)]
+            if not batch:
+                return
+
+            yield np.stack(batch)
+
+    n_windows = len(haps) - 2 * buffer
+    # Workers map the haplotypes instead of getting a pickled copy with every task
+    shm, shared_haps = gu.share_array(haps)
+    build_range = partial(
+        hft_range_worker,
+        shared_haps=shared_haps,
+        samp_sizes=hap_sizes,
+        win_size=2 * buffer + 1,
+        n_classes=n_classes,
+    )
 
-    centers = range(buffer, len(snps) - buffer)
-    left_edges = []
-    right_edges = []
-    data = []
-    for center in tqdm(centers, desc="Predicting on AFT windows"):
-        try:
-            win_idxs = get_window_idxs(center, win_size)
-            window = ts_aft[:, win_idxs]
-            data.append(window)
-            left_edges.append(snps[win_idxs[0]][1])
-            right_edges.append(snps[win_idxs[-1]][1])
-
-        except Exception as e:
-            logger.warning(f"Center {snps[center]} raised error {e}")
-
-    class_probs = class_model.predict(np.stack(data))
-    reg_preds = [model.predict(np.stack(data)) for model in reg_models.values()]
-    
-    results_dict = {}
-    for center, res in zip(centers, zip(
-        class_probs, *reg_preds, left_edges, right_edges
-    )):
-        results_dict[snps[center]] = res
-
-    return results_dict
+    def submit(start):
+        stop = min(start + batch_size, n_windows)
+        ranges = [
+            (i, min(i + HFT_RANGE_SIZE, stop)) for i in range(start, stop, HFT_RANGE_SIZE)
+        ]
+        return pool.map_async(build_range, ranges)
+
+    try:
+        pending = submit(0) if n_windows > 0 else None
+        for start in range(0, n_windows, batch_size):
+            ready = pending
+            if start + batch_size < n_windows:
+                pending = submit(start + batch_size)
+            yield np.concatenate(ready.get())
+    finally:
+        shm.close()
+        shm.unlink()
 
 
 def run_hft_windows(
-    snps, haps, ploidy, samp_sizes, win_size, class_model, reg_models
+    snps,
+    haps,
+    ploidy,
+    samp_sizes,
+    win_size,
+    class_model,
+    reg_models,
+    hft_pool=None,
+    hft_classes=None,
 ):
     """
     Iterates through windows of MAF time-series matrix and predicts using NN.
     Args:
-        snps (list[tup(chrom, pos,  mut)]): Tuples of information for each SNP. Contains mut only if benchmarking == True.
+        snps (np.arr): Structured array of SNP info, see su.make_loc_arr(). Contains mt and s only if benchmarking == True.
         haps (np.arr): Haplotypes of all samples.
         samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
         win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
         model (Keras.model): Keras model to use for prediction.
+        hft_pool (multiprocessing.Pool, optional): Workers to build HFTs across, see iter_hft_batches().
+        hft_classes (int, optional): Number of HFT columns to keep, see iter_hft_batches().
     Returns:
-        dict: Prediction values in the form of dict[snps[center]]
-        np.arr: the central-most window, either based on mutation type or closest to half size of chrom.
+        dict: Columnar predictions and window edges, see make_results().
     """
-    results_dict = {}
     buffer = math.floor(win_size / 2)
-    centers = range(buffer, len(snps) - buffer)
-    left_edges = []
-    right_edges = []
-    data = []
-    for center in tqdm(centers, desc="Predicting on HFT windows"):
-        win_idxs = get_window_idxs(center, win_size)
-        window = np.swapaxes(haps[win_idxs, :], 0, 1)
-        str_window = hu.haps_to_strlist(window)
-        hft = hu.getTSHapFreqs(str_window, [i * ploidy for i in samp_sizes])
-        data.append(hft)
-        left_edges.append(snps[win_idxs[0]][1])
-        right_edges.append(snps[win_idxs[-1]][1])
-
-    class_probs = class_model.predict(np.stack(data))
-    reg_preds = [model.predict(np.stack(data)) for model in reg_models.values()]
-    
-    results_dict = {}
-    for center, res in zip(centers, zip(
-        class_probs, *reg_preds, left_edges, right_edges
-    )):
-        results_dict[snps[center]] = res
-
-    return results_dict
-
-
-def get_window_idxs(center_idx, win_size):
-    """
-    Gets the win_size number of snps around a central snp.
-
-    Args:
-        center_idx (int): Index of the central SNP to use for the window.
-        win_size (int): Size of window to use around the SNP, optimally odd number.
+    centers = np.arange(buffer, len(snps) - buffer)
+
+    batches = tqdm(
+        iter_hft_batches(
+            haps, ploidy, samp_sizes, win_size, pool=hft_pool, n_classes=hft_classes
+        ),
+        total=math.ceil(len(centers) / PRED_BATCH_SIZE),
+        desc="Predicting on HFT windows",
+    )
+    class_probs, reg_preds = predict_batches(batches, class_model, reg_models)
 
-    Returns:
-        list: Indices of all SNPs to grab for the feature matrix.
-    """
-    half_window = math.floor(win_size / 2)
-    return list(range(center_idx - half_window, center_idx + half_window + 1))
+    return make_results(snps, centers, buffer, class_probs, reg_preds)
 
 
 def load_nn(model_path, summary=False):
@@ -219,6 +328,400 @@ def get_swp(filename, scenarios):
         if s in filename:
             return s
 
+
+def load_models(work_dir, experiment_name, scenarios, data_type):
+    """
+    Loads the classification model and the regression model of each sweep scenario for a data type.
+
+    Args:
+        work_dir (str): Working directory models were trained in.
+        experiment_name (str): Experiment identifier used in model names.
+        scenarios (list[str]): Scenarios from the config, first is assumed to be neutral.
+        data_type (str): "aft" or "hft".
+
+    Returns:
+        tuple[Keras.model, dict[str, Keras.model]]: Class model and regression models keyed by scenario.
+    """
+    class_model = load_model(f"{work_dir}/trained_models/{experiment_name}_Timesweeper_Class_{data_type}")
+    reg_models = {scenario: load_model(f"{work_dir}/trained_models/REG_{experiment_name}_{scenario}_Timesweeper_Reg_{data_type}") for scenario in scenarios[1:]}
+
+    return class_model, reg_models
+
+
+def featurize_chunk(chunk, samp_sizes, win_size, benchmark, hft):
+    """
+    Builds everything the models need from a chunk, without touching the models.
+
+    Args:
+        chunk (dict): VCF dict-like chunk from a single chromosome.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
+        benchmark (bool): Whether to look for Mut_Type or not.
+        hft (bool): Whether to also pull haplotypes for HFT prediction.
+
+    Returns:
+        dict: Data type to (snps, features) tuple, empty if chunk is too small for a window.
+    """
+    features = {}
+    if chunk is None or len(chunk["variants/POS"]) < win_size:
+        return features
+
+    ts_counts, snps = su.vcf_to_ts_counts(chunk, samp_sizes, benchmark)
+    features["aft"] = (snps, prep_ts_aft_from_counts(ts_counts))
+
+    if hft:
+        haps, snps = su.vcf_to_haps(chunk, benchmark)
+        features["hft"] = (snps, haps)
+
+    return features
+
+
+def predict_features(
+    features, samp_sizes, ploidy, win_size, models, hft_pool=None, hft_classes=None
+):
+    """
+    Predicts on every full window of featurized chunk.
+
+    Args:
+        features (dict): Data type to (snps, features) as given by featurize_chunk().
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        ploidy (int): Ploidy of samples.
+        win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
+        models (dict): Data type to (class model, regression models) as given by load_models().
+        hft_pool (multiprocessing.Pool, optional): Workers to build HFTs across, see iter_hft_batches().
+        hft_classes (int, optional): Number of HFT columns to keep, see iter_hft_batches().
+
+    Returns:
+        dict: Data type to prediction results.
+    """
+    predictions = {}
+    if "aft" in features:
+        snps, ts_aft = features["aft"]
+        predictions["aft"] = run_aft_windows(snps, ts_aft, win_size, *models["aft"])
+
+    if "hft" in features:
+        snps, haps = features["hft"]
+        predictions["hft"] = run_hft_windows(
+            snps,
+            haps,
+            ploidy,
+            samp_sizes,
+            win_size,
+            *models["hft"],
+            hft_pool,
+            hft_classes,
+        )
+
+    return predictions
+
+
+def predict_chunk(chunk, samp_sizes, ploidy, win_size, benchmark, models, hft_classes=None):
+    """
+    Predicts on every full window of a chunk for each data type models are given for.
+
+    Args:
+        chunk (dict): VCF dict-like chunk from a single chromosome.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        ploidy (int): Ploidy of samples.
+        win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
+        benchmark (bool): Whether to look for Mut_Type or not.
+        models (dict): Data type to (class model, regression models) as given by load_models().
+        hft_classes (int, optional): Number of HFT columns to keep, see iter_hft_batches().
+
+    Returns:
+        dict: Data type to prediction results, empty if chunk is too small for a window.
+    """
+    features = featurize_chunk(chunk, samp_sizes, win_size, benchmark, "hft" in models)
+    return predict_features(
+        features, samp_sizes, ploidy, win_size, models, hft_classes=hft_classes
+    )
+
+
+def split_regions(regions, shard_size):
+    """
+    Splits regions into contiguous, non-overlapping shards of at most shard_size bp.
+
+    Args:
+        regions (list[tuple[str, int, int]]): (chrom, start, end) regions, 1-based inclusive. Start and end may be None for a whole contig.
+        shard_size (int): Size of each shard in bp.
+
+    Returns:
+        list[tuple[str, int, int]]: (chrom, start, end) for each shard, 1-based inclusive.
+    """
+    shards = []
+    for chrom, start, end in regions:
+        if start is None:
+            shards.append((chrom, None, None))
+            continue
+
+        for shard_start in range(start, end + 1, shard_size):
+            shards.append((chrom, shard_start, min(shard_start + shard_size - 1, end)))
+
+    return shards
+
+
+def make_shards(contigs, shard_size):
+    """
+    Splits contigs into contiguous, non-overlapping regions.
+
+    Args:
+        contigs (dict): Contig name to length (or None if unknown) as given by su.get_contigs().
+        shard_size (int): Size of each region in bp.
+
+    Returns:
+        list[tuple[str, int, int]]: (chrom, start, end) for each shard, 1-based inclusive. Contigs of unknown length are a single (chrom, None, None) shard.
+    """
+    return split_regions(
+        [(chrom, 1, length) if length else (chrom, None, None) for chrom, length in contigs.items()],
+        shard_size,
+    )
+
+
+def get_regions(ua, contigs):
+    """
+    Collects the intervals given with --region and --regions-bed.
+
+    Args:
+        ua (argparse.Namespace): Detect arguments.
+        contigs (dict): Contig name to length (or None if unknown) as given by su.get_contigs().
+
+    Returns:
+        list[tuple[str, int, int]]: Merged (chrom, start, end) intervals, 1-based inclusive, on contigs present in the input.
+    """
+    regions = [su.parse_region(r) for r in ua.region or []]
+    if ua.regions_bed:
+        regions += su.read_bed_regions(ua.regions_bed)
+
+    resolved = []
+    for chrom, start, end in regions:
+        if chrom not in contigs:
+            logger.warning(f"Region on {chrom} skipped, contig isn't in {ua.input_vcf}")
+            continue
+
+        # chrom or chrom:start run to the end of the contig
+        start = 1 if start is None else start
+        end = end or contigs[chrom] or np.iinfo(np.int32).max
+        resolved.append((chrom, start, end))
+
+    return su.merge_regions(resolved) if resolved else []
+
+
+# Each worker process keeps its own models, loaded once by init_worker()
+_worker_models = {}
+
+
+def init_worker(work_dir, experiment_name, scenarios, hft, tf_threads):
+    """Limits TF to its share of the node's cores and loads models for a worker process."""
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(tf_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    _worker_models["aft"] = load_models(work_dir, experiment_name, scenarios, "aft")
+    if hft:
+        _worker_models["hft"] = load_models(work_dir, experiment_name, scenarios, "hft")
+
+
+def read_shard(
+    shard, vcf_file, contigs, samp_sizes, win_size, benchmark, hft, site_filter=None, filter_stats=None
+):
+    """
+    Reads a shard with win_size // 2 flanking SNPs, so every SNP inside of it (and only those) can be a window center.
+
+    Args:
+        shard (tuple[str, int, int]): (chrom, start, end) to read, 1-based inclusive.
+        vcf_file (str): Indexed VCF or genotype store.
+        contigs (dict): Contig name to length (or None if unknown) as given by su.get_contigs().
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
+        benchmark (bool): Whether to look for Mut_Type or not.
+        hft (bool): Whether genotypes are needed for haplotypes, otherwise only allele counts are read where possible.
+        site_filter (callable, optional): Site filter applied before flanks are counted, see su.filter_sites().
+        filter_stats (collections.Counter, optional): Updated with the number of sites in the shard each filter removed.
+
+    Returns:
+        dict: VCF dict-like chunk, None if the shard has no SNPs.
+    """
+    chrom, start, end = shard
+    return su.read_region_with_flanks(
+        vcf_file,
+        chrom,
+        start,
+        end,
+        win_size // 2,
+        benchmark,
+        samp_sizes=None if hft else samp_sizes,
+        chrom_len=contigs[chrom],
+        site_filter=site_filter,
+        filter_stats=filter_stats,
+    )
+
+
+def shard_worker(
+    shard,
+    vcf_file,
+    contigs,
+    samp_sizes,
+    ploidy,
+    win_size,
+    benchmark,
+    site_filter=None,
+    hft_classes=None,
+):
+    """Reads a shard with win_size // 2 flanking SNPs and predicts on all SNPs inside of it. Returns predictions and site filter counts."""
+    filter_stats = Counter()
+    chunk = read_shard(
+        shard,
+        vcf_file,
+        contigs,
+        samp_sizes,
+        win_size,
+        benchmark,
+        "hft" in _worker_models,
+        site_filter,
+        filter_stats,
+    )
+
+    return (
+        predict_chunk(
+            chunk, samp_sizes, ploidy, win_size, benchmark, _worker_models, hft_classes
+        ),
+        filter_stats,
+    )
+
+
+def iter_serial_features(ua, samp_sizes, win_size, site_filter=None, filter_stats=None):
+    """Streams through the whole input in chunks and featurizes each one."""
+    # Chunks are stitched with a halo of SNPs so windows spanning chunk seams aren't dropped
+    # AFT only needs allele counts, genotypes are only kept around if HFT needs haplotypes
+    vcf_iter = su.get_vcf_iter(
+        ua.input_vcf, ua.benchmark, samp_sizes=None if ua.hft else samp_sizes
+    )
+    if site_filter:
+        # Filter before stitching so halos are made of sites that passed
+        vcf_iter = (site_filter(chunk[0], stats=filter_stats) for chunk in vcf_iter)
+    for chunk_idx, chunk in enumerate(su.stitch_vcf_chunks(vcf_iter, win_size)):
+        logger.info(f"Processing VCF chunk {chunk_idx}")
+        yield featurize_chunk(chunk, samp_sizes, win_size, ua.benchmark, ua.hft)
+
+
+def iter_serial_predictions(
+    ua,
+    samp_sizes,
+    ploidy,
+    win_size,
+    models,
+    site_filter=None,
+    filter_stats=None,
+    hft_pool=None,
+    hft_classes=None,
+):
+    """
+    Predicts on the whole input in a single process.
+    Reading and featurizing runs in a background thread, so chunk k+1 is parsed while chunk k is in the models.
+    """
+    for features in gu.iter_in_thread(
+        iter_serial_features(ua, samp_sizes, win_size, site_filter, filter_stats),
+        maxsize=PIPELINE_DEPTH,
+    ):
+        yield predict_features(
+            features, samp_sizes, ploidy, win_size, models, hft_pool, hft_classes
+        )
+
+
+def iter_region_predictions(
+    ua,
+    vcf_file,
+    contigs,
+    shards,
+    samp_sizes,
+    ploidy,
+    win_size,
+    models,
+    site_filter=None,
+    filter_stats=None,
+    hft_pool=None,
+    hft_classes=None,
+):
+    """Predicts on just the given shards of an indexed input in a single process, reading ahead in a background thread."""
+    features_iter = (
+        featurize_chunk(
+            read_shard(
+                shard,
+                vcf_file,
+                contigs,
+                samp_sizes,
+                win_size,
+                ua.benchmark,
+                ua.hft,
+                site_filter,
+                filter_stats,
+            ),
+            samp_sizes,
+            win_size,
+            ua.benchmark,
+            ua.hft,
+        )
+        for shard in shards
+    )
+    for features in gu.iter_in_thread(features_iter, maxsize=PIPELINE_DEPTH):
+        yield predict_features(
+            features, samp_sizes, ploidy, win_size, models, hft_pool, hft_classes
+        )
+
+
+def iter_sharded_predictions(
+    ua,
+    yaml_data,
+    vcf_file,
+    contigs,
+    shards,
+    samp_sizes,
+    ploidy,
+    win_size,
+    site_filter=None,
+    filter_stats=None,
+    hft_classes=None,
+):
+    """Predicts on regions of the tabix-indexed input (or store) across worker processes."""
+    logger.info(f"Scanning {len(shards)} regions across {ua.workers} workers")
+
+    tf_threads = max(1, mp.cpu_count() // ua.workers)
+    with mp.Pool(
+        ua.workers,
+        initializer=init_worker,
+        initargs=(
+            yaml_data["work dir"],
+            yaml_data["experiment name"],
+            yaml_data["scenarios"],
+            ua.hft,
+            tf_threads,
+        ),
+    ) as pool:
+        # imap keeps shards in coordinate order
+        for predictions, shard_stats in tqdm(
+            pool.imap(
+                partial(
+                    shard_worker,
+                    vcf_file=vcf_file,
+                    contigs=contigs,
+                    samp_sizes=samp_sizes,
+                    ploidy=ploidy,
+                    win_size=win_size,
+                    benchmark=ua.benchmark,
+                    site_filter=site_filter,
+                    hft_classes=hft_classes,
+                ),
+                shards,
+            ),
+            total=len(shards),
+            desc="Scanning regions",
+        ):
+            if filter_stats is not None:
+                filter_stats.update(shard_stats)
+            yield predictions
+
+
 def main(ua):
     yaml_data = read_config(ua.yaml_file)
     samp_sizes = yaml_data["sample sizes"]
@@ -228,10 +731,8 @@ def main(ua):
     work_dir = yaml_data["work dir"]
     experiment_name = yaml_data["experiment name"]
     mut_types = yaml_data["mut types"]
+    hft_classes = hu.get_n_hft_classes(yaml_data)
 
-    class_aft_model = load_model(f"{work_dir}/trained_models/{experiment_name}_Timesweeper_Class_aft")
-    reg_aft_models = {scenario: load_model(f"{work_dir}/trained_models/REG_{experiment_name}_{scenario}_Timesweeper_Reg_aft") for scenario in scenarios[1:]}
-    
     with open(f"{work_dir}/trained_models/{experiment_name}_selcoeff_scaler.pkl", "rb") as ifile:
         scaler = pkl.load(ifile)
 
@@ -239,38 +740,99 @@ def main(ua):
         true_class = get_swp(ua.input_vcf, scenarios)
     else:
         true_class = None
-    
-    # Chunk and iterate for NN predictions to not take up too much space
-    vcf_iter = su.get_vcf_iter(ua.input_vcf, ua.benchmark)
-    for chunk_idx, chunk in enumerate(vcf_iter):
-        chunk = chunk[0]  # Why you gotta do me like that, skallel?
-        logger.info(f"Processing VCF chunk {chunk_idx}")
 
-        # aft
-        genos, snps = su.vcf_to_genos(chunk, ua.benchmark)
-        aft_predictions = run_aft_windows(
-            snps,
-            genos,
+    site_filters = su.get_site_filters(yaml_data)
+    site_filter = None
+    filter_stats = Counter()
+    if site_filters:
+        logger.info(f"Filtering sites with {site_filters}")
+        site_filter = partial(
+            su.filter_sites, samp_sizes=samp_sizes, ploidy=ploidy, filters=site_filters
+        )
+
+    restrict = bool(ua.region or ua.regions_bed)
+    if ua.workers > 1 or restrict:
+        # Regions are pulled with the tabix index (or straight from a store)
+        if stu.is_store(ua.input_vcf):
+            vcf_file = ua.input_vcf
+        else:
+            vcf_file = pv.get_indexed_vcf(ua.input_vcf)
+        contigs = su.get_contigs(vcf_file)
+        if restrict:
+            shards = split_regions(get_regions(ua, contigs), ua.shard_size)
+        else:
+            shards = make_shards(contigs, ua.shard_size)
+
+    if ua.workers > 1:
+        if ua.hft_workers > 1:
+            logger.warning("--hft-workers is ignored with --workers, HFTs are already built across shard workers")
+        hft_pool = None
+        predictions_iter = iter_sharded_predictions(
+            ua,
+            yaml_data,
+            vcf_file,
+            contigs,
+            shards,
             samp_sizes,
+            ploidy,
             win_size,
-            class_aft_model,
-            reg_aft_models,
+            site_filter,
+            filter_stats,
+            hft_classes,
         )
-        write_preds(scenarios, mut_types, aft_predictions, f"{ua.output_dir}/{experiment_name}_aft.csv", scaler, ua.benchmark, true_class)
+    else:
+        hft_pool = None
+        if ua.hft and ua.hft_workers > 1:
+            # Forked before TF spins up any threads, HFT workers only need numpy
+            hft_pool = gu.make_shared_pool(ua.hft_workers)
 
-        # hft
+        models = {"aft": load_models(work_dir, experiment_name, scenarios, "aft")}
         if ua.hft:
-            class_hft_model = load_model(f"{work_dir}/trained_models/{experiment_name}_Timesweeper_Class_hft")
-            reg_hft_models = {scenario: load_model(f"{work_dir}/trained_models/REG_{experiment_name}_{scenario}_Timesweeper_Reg_hft") for scenario in scenarios[1:]}
-     
-            haps, snps = su.vcf_to_haps(chunk, ua.benchmark)
-            hft_predictions = run_hft_windows(
-                snps,
-                haps,
+            models["hft"] = load_models(work_dir, experiment_name, scenarios, "hft")
+
+        if restrict:
+            predictions_iter = iter_region_predictions(
+                ua,
+                vcf_file,
+                contigs,
+                shards,
+                samp_sizes,
                 ploidy,
+                win_size,
+                models,
+                site_filter,
+                filter_stats,
+                hft_pool,
+                hft_classes,
+            )
+        else:
+            predictions_iter = iter_serial_predictions(
+                ua,
                 samp_sizes,
+                ploidy,
                 win_size,
-                class_hft_model,
-                reg_hft_models,
+                models,
+                site_filter,
+                filter_stats,
+                hft_pool,
+                hft_classes,
             )
-            write_preds(scenarios, mut_types, hft_predictions, f"{ua.output_dir}/{experiment_name}_hft.csv", scaler, ua.benchmark, true_class)
+
+    written = set()
+
+    def write_chunk(predictions):
+        for data_type, preds in predictions.items():
+            outfile = f"{ua.output_dir}/{experiment_name}_{data_type}.csv"
+            write_preds(scenarios, mut_types, preds, outfile, scaler, ua.benchmark, true_class, outfile in written)
+            written.add(outfile)
+
+    # Chunk k-1 is flushed to disk by a writer thread while chunk k is predicted on
+    try:
+        gu.consume_in_thread(write_chunk, predictions_iter, maxsize=PIPELINE_DEPTH)
+    finally:
+        if hft_pool is not None:
+            hft_pool.terminate()
+
+    if site_filters:
+        for name in site_filters:
+            logger.info(f"Site filter '{name}' removed {filter_stats[name]} sites")
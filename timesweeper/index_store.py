@@ -0,0 +1,87 @@
+import os
+import shutil
+
+import numpy as np
+
+from timesweeper.utils import snp_utils as su
+from timesweeper.utils import store_utils as stu
+from timesweeper.utils.gen_utils import get_logger, read_config
+
+logger = get_logger("index_store")
+
+
+def get_store_path(input_vcf, outdir=None):
+    """Default store location is next to the VCF, e.g. foo.vcf.gz -> foo.vcf.gz.tsstore."""
+    if outdir:
+        return outdir
+    return f"{input_vcf}.tsstore"
+
+
+def build_store(input_vcf, store_dir, samp_sizes, ploidy, benchmark):
+    """
+    Parses a merged time-series VCF once and writes it to a chunked, memory-mappable store.
+    Each chunk holds CHROM/POS/GT (and MT/S if benchmarking) plus per-timepoint allele counts.
+
+    Args:
+        input_vcf (str): Merged VCF to convert.
+        store_dir (str): Directory to write the store to. An existing genotype store there is replaced, anything else is refused.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        ploidy (int): Ploidy of samples.
+        benchmark (bool): Whether to store Mut_Type and selection coefficient fields.
+
+    Returns:
+        dict: Manifest of the written store.
+    """
+    if stu.is_store(store_dir) and not stu.is_training_store(store_dir):
+        shutil.rmtree(store_dir)
+    elif os.path.exists(store_dir) and (
+        not os.path.isdir(store_dir) or os.listdir(store_dir)
+    ):
+        raise ValueError(f"{store_dir} exists and isn't a genotype store, refusing to replace it")
+    os.makedirs(store_dir, exist_ok=True)
+
+    samples = su.read_vcf_samples(input_vcf)
+    if sum(samp_sizes) != len(samples):
+        logger.warning(
+            f"Sample sizes sum to {sum(samp_sizes)} but VCF has {len(samples)} samples."
+        )
+
+    chunk_entries = []
+    for chunk_idx, chunk in enumerate(su.get_vcf_iter(input_vcf, benchmark)):
+        chunk = chunk[0]  # Why you gotta do me like that, skallel?
+        logger.info(f"Indexing VCF chunk {chunk_idx}")
+
+        chunk[su.TS_COUNTS_FIELD] = su.count_ts_alleles(
+            su.get_geno_arr(chunk), samp_sizes
+        ).astype(np.int32)
+        chunk_entries.append(stu.write_store_chunk(store_dir, chunk_idx, chunk))
+
+    manifest = {
+        "version": stu.STORE_VERSION,
+        "source": os.path.abspath(input_vcf),
+        "samples": samples,
+        "sample sizes": list(samp_sizes),
+        "ploidy": ploidy,
+        "fields": su.get_fields(benchmark) + [su.TS_COUNTS_FIELD],
+        "chunks": chunk_entries,
+    }
+    stu.write_manifest(store_dir, manifest)
+
+    return manifest
+
+
+def main(ua):
+    yaml_data = read_config(ua.yaml_file)
+    store_dir = get_store_path(ua.input_vcf, ua.output)
+
+    manifest = build_store(
+        ua.input_vcf,
+        store_dir,
+        yaml_data["sample sizes"],
+        yaml_data["ploidy"],
+        ua.benchmark,
+    )
+    n_variants = sum(c["n_variants"] for c in manifest["chunks"])
+    logger.info(
+        f"Wrote {n_variants} variants in {len(manifest['chunks'])} chunks to {store_dir}"
+    )
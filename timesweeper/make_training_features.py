@@ -4,29 +4,30 @@ import multiprocessing as mp
 import os
 import pickle
 import sys
+import warnings
+from functools import partial
 from glob import glob
-from itertools import cycle
 from random import sample
 
 import pandas as pd
-import allel
 import numpy as np
 from numpy.random import default_rng
 from tqdm import tqdm
 
 from timesweeper.utils import snp_utils as su
+from timesweeper.utils import store_utils as stu
+from timesweeper.utils import gen_utils as gu
 from timesweeper.utils.gen_utils import (get_rep_id,
                                          get_scenario_from_filename,
                                          read_config)
-from timesweeper.utils.hap_utils import getTSHapFreqs, haps_to_strlist
+from timesweeper.utils.hap_utils import get_n_hft_classes, get_ts_hap_freqs
 
 logging.basicConfig()
 logger = logging.getLogger("make_training_feats")
 logger.setLevel("INFO")
 
-import warnings
-
-warnings.filterwarnings("error")
+# Number of finished replicates that may wait on the writer before results stop being pulled from the pool
+WRITER_QUEUE_SIZE = 64
 
 
 def draw_rand_center_offset(max_offset=700):
@@ -115,65 +116,71 @@ def prep_ts_aft(genos, samp_sizes):
     Returns:
         np.arr: MAF array to use for predictions. Shape is (timepoints, MAF).
     """
-    # Prep genos into time-series format and calculate Maft
-    ts_genos = su.split_arr(genos, samp_sizes)
+    return prep_ts_aft_from_counts(su.count_ts_alleles(genos, samp_sizes))
 
-    min_alleles, first_genos, last_genos = su.get_vel_minor_alleles(
-        ts_genos, np.max(genos)
-    )
 
-    ts_maft = []
-    for timepoint in ts_genos:
-        _genos = []
-        _genotypes = allel.GenotypeArray(timepoint).count_alleles(
-            max_allele=min_alleles.max()
-        )
+def prep_ts_aft_from_counts(ts_counts):
+    """
+    Creates MAF feature matrices from per-timepoint allele counts, no genotypes needed.
 
-        for snp, min_allele_idx in zip(_genotypes, min_alleles):
-            maf = su.calc_maft(snp, min_allele_idx)
-            _genos.append(maf)
+    Args:
+        ts_counts (np.arr): Allele counts with shape (snps, timepoints, alleles), see su.count_ts_alleles().
 
-        ts_maft.append(_genos)
+    Returns:
+        np.arr: MAF array to use for predictions. Shape is (timepoints, MAF).
+    """
+    # Only consider alleles actually present, counts may be padded out to su.MAX_ALLELE
+    present = np.flatnonzero(np.any(ts_counts, axis=(0, 1)))
+    n_alleles = present.max() + 1 if len(present) else 1
+    ts_counts = ts_counts[:, :, :n_alleles]
 
-    return np.stack(ts_maft)
+    min_alleles = su.get_vel_minor_alleles_from_counts(ts_counts)
 
+    # Totals only include alleles up to the highest minor allele index, as they always have
+    return su.calc_ts_maft(ts_counts[:, :, : min_alleles.max() + 1], min_alleles)
 
-def get_aft_central_window(
-    snps, genos, samp_sizes, win_size, missingness, mut_types, offset
-):
+
+def get_center_idx(snps, buffer, mut_types):
     """
-    Check for whether a non-control mutation type is present. If not, return the central-most mutation.
+    Finds the first SNP with a non-control mutation type that has a full window around it.
 
     Args:
-        snps (list[tup(chrom, pos,  mut)]): Tuples of information for each SNP.
-        genos (allel.GenotypeArray): Genotypes of all samples.
-        samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
-        win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
-        scenario (str): Entry from the scenarios config option.
-        missingness (float): Parameter of binomial distribution to pull missingness from.
+        snps (np.arr): Structured array of SNP info, see su.make_loc_arr().
+        buffer (int): Number of SNPs needed on either side of the center.
         mut_types (list[int]): List of mutation types that are not considered the "control" case.
+
     Returns:
-        np.arr: The central-most window, either based on mutation type or closest to half size of chrom.
-        float: Selection coefficient.
+        int: Index of the SNP to center the window on, falls back to the middle of the possible centers.
     """
-    ts_aft = prep_ts_aft(genos, samp_sizes)
+    centers = np.arange(buffer, len(snps) - buffer)
+    center_idx = int(len(centers) / 2)
 
-    buffer = int(win_size / 2)
-    centers = range(buffer, len(snps) - buffer)
+    if "mt" in snps.dtype.names:
+        is_mut = np.flatnonzero(np.isin(snps["mt"][centers], mut_types))
+        if len(is_mut):
+            center_idx = int(centers[is_mut[0]])
 
-    center_idx = int(len(centers) / 2)
+    return center_idx
 
-    try:
-        for center in centers:
-            if snps[center][2] in mut_types:
-                center_idx = center
-                break
-            else:
-                pass
-    except:
-        pass
 
-    sel_coeff = snps[center_idx][3]
+def get_central_idx(snps, win_size, mut_types, offset):
+    """
+    Picks the center of the training window of a replicate, shared by every feature type built from it.
+
+    Args:
+        snps (np.arr): Structured array of SNP info, see su.make_loc_arr().
+        win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
+        mut_types (list[int]): List of mutation types that are not considered the "control" case.
+        offset (int): Whether to randomly shift a third of the windows off of the central SNP.
+
+    Returns:
+        int: Index of the central SNP, either based on mutation type or closest to half size of chrom.
+        float: Selection coefficient of the unshifted central SNP.
+        int: Number of SNPs the center was shifted by.
+    """
+    buffer = int(win_size / 2)
+    center_idx = get_center_idx(snps, buffer, mut_types)
+    sel_coeff = snps["s"][center_idx]
 
     if offset:
         rng = default_rng(
@@ -187,70 +194,103 @@ def get_aft_central_window(
     else:
         rand_offset = 0
 
-    win_idxs = get_window_idxs(center_idx, win_size)
+    return center_idx, sel_coeff, rand_offset
 
-    window = ts_aft[:, win_idxs]
-    center_aft = window
 
-    missing_center_aft = add_missingness(
-        center_aft, m_rate=missingness
-    )  # If no missingness, will just return
+def get_training_windows(yaml_data):
+    """
+    Reads the optional "training windows" block of the config, extra windows to pull from each replicate.
+    E.g. {"shoulders": [-250, 250], "neutral": 2, "neutral distance": 1000} adds shoulder windows centered 250 SNPs on either
+        side of the sweep and 2 neutral windows at least 1000 SNPs away from it.
 
-    return missing_center_aft, sel_coeff, rand_offset
+    Args:
+        yaml_data (dict): Config.
 
+    Returns:
+        dict: shoulders, neutral, and neutral distance settings, only the center window is pulled if empty.
+    """
+    windows = yaml_data.get("training windows") or {}
+    unknown = set(windows) - {"shoulders", "neutral", "neutral distance"}
+    if unknown:
+        raise ValueError(f"Unknown training windows options {unknown}")
+    if windows.get("neutral") and not windows.get("neutral distance"):
+        raise ValueError("training windows needs a neutral distance to pull neutral windows")
+
+    return windows
 
-def get_hft_central_window(snps, haps, samp_sizes, win_size, mut_types, offset):
+
+def get_window_offsets(sweep_idx, rand_offset, n_snps, win_size, windows):
     """
-    Iterates through windows of MAF time-series matrix and gets the central window.
-    Does not have as many utility functions as AFT such as missingness and variable sorting methods.
+    Plans the windows to pull from a replicate, relative to its sweep site.
 
     Args:
-        snps (list[tup(chrom, pos,  mut)]): Tuples of information for each SNP.
-        haps (np.arr): Haplotypes of all samples.
-        samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
+        sweep_idx (int): Index of the SNP under selection (or the middle SNP), see get_central_idx().
+        rand_offset (int): Offset of the center window, see get_central_idx().
+        n_snps (int): Number of SNPs in the replicate.
         win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
+        windows (dict): Extra windows, see get_training_windows().
+
     Returns:
-        np.arr: The central-most window, either based on mutation type or closest to half size of chrom.
+        list[tuple[str, int]]: (label, offset from sweep_idx) of each window, center first.
+            Shoulder and neutral windows that don't fit in the replicate are left out.
     """
     buffer = int(win_size / 2)
-    centers = range(buffer, len(snps) - buffer)
+    offsets = [("center", rand_offset)]
+    offsets += [("shoulder", int(o)) for o in windows.get("shoulders", [])]
 
-    center_idx = int(len(centers) / 2)
+    if windows.get("neutral"):
+        centers = np.arange(buffer, n_snps - buffer)
+        far = centers[np.abs(centers - sweep_idx) >= windows["neutral distance"]]
+        rng = default_rng(int.from_bytes(os.urandom(4), byteorder="little"))
+        picks = rng.choice(far, min(windows["neutral"], len(far)), replace=False)
+        offsets += [("neutral", int(c - sweep_idx)) for c in np.sort(picks)]
 
-    try:
-        for center in centers:
-            if snps[center][2] in mut_types:
-                center_idx = center
-                break
-            else:
-                pass
-    except:
-        pass
+    return [
+        (label, o)
+        for label, o in offsets
+        if label == "center" or buffer <= sweep_idx + o < n_snps - buffer
+    ]
 
-    sel_coeff = snps[center_idx][3]
 
-    if offset:
-        rng = default_rng(
-            np.random.seed(int.from_bytes(os.urandom(4), byteorder="little"))
-        )
-        if rng.uniform(1, 3, 1)[0] > 2:
-            rand_offset = draw_rand_center_offset()
-            center_idx += rand_offset
+def get_aft_window(ts_aft, center_idx, win_size, missingness):
+    """
+    Pulls the AFT of the window around center_idx.
 
-        else:
-            rand_offset = 0
-    else:
-        rand_offset = 0
+    Args:
+        ts_aft (np.arr): MAF array of the whole replicate, see prep_ts_aft().
+        center_idx (int): Index of the central SNP, see get_central_idx().
+        win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
+        missingness (float): Parameter of binomial distribution to pull missingness from.
 
-    win_idxs = get_window_idxs(center_idx, win_size)
-    window = np.swapaxes(haps[win_idxs, :], 0, 1)
-    str_window = haps_to_strlist(window)
-    central_hfs = getTSHapFreqs(str_window, samp_sizes)
+    Returns:
+        np.arr: MAF window of shape (timepoints, win_size).
+    """
+    window = ts_aft[:, get_window_idxs(center_idx, win_size)]
+
+    return add_missingness(window, m_rate=missingness)  # If no missingness, will just return
+
+
+def get_hft_window(haps, samp_sizes, center_idx, win_size, n_classes=None):
+    """
+    Builds the HFT of the window around center_idx.
+    Does not have as many utility functions as AFT such as missingness and variable sorting methods.
+
+    Args:
+        haps (allel.HaplotypeArray): Haplotypes of all samples.
+        samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
+        center_idx (int): Index of the central SNP, see get_central_idx().
+        win_size (int): Number of SNPs to use for each prediction. Needs to match how NN was trained.
+        n_classes (int, optional): Number of HFT columns to keep, see hap_utils.hft_from_classes().
+
+    Returns:
+        np.arr: HFT of shape (timepoints, n_classes or sum(samp_sizes)).
+    """
+    window = np.swapaxes(haps[get_window_idxs(center_idx, win_size), :], 0, 1)
 
-    return central_hfs, sel_coeff, rand_offset
+    return get_ts_hap_freqs(window, samp_sizes, n_classes)
 
 
-def aft_worker(
+def condense_worker(
     in_vcf,
     mut_types,
     scenarios,
@@ -259,28 +299,78 @@ def aft_worker(
     win_size,
     offset,
     missingness,
+    data_types=("aft",),
+    ploidy=2,
     verbose=False,
     params=None,
+    n_classes=None,
+    windows=None,
 ):
+    """
+    Reads a replicate once and builds every requested feature type of every window from the same calldata.
+
+    Args:
+        in_vcf (str): Merged VCF of the replicate.
+        data_types (tuple[str]): Feature types to build, "aft" and/or "hft".
+        windows (dict, optional): Extra windows to pull, see get_training_windows(). Defaults to just the center window.
+
+    Returns:
+        list[tuple]: (rep id, scenario, dict of data type to features, selection coefficient, center offset, window label) of each \
+            window, the center window first. Neutral windows are labelled with the first scenario and no selection. None if the replicate can't be used.
+    """
     benchmark = True  # Want to get all the info we can from sims in training
     try:
         id = get_rep_id(in_vcf)
         scenario = get_scenario_from_filename(in_vcf, scenarios)
 
-        vcf = su.read_vcf(in_vcf, samps_list, benchmark)
-        genos, snps = su.vcf_to_genos(vcf, benchmark)
+        # A VCF the readers warn about is dropped, see the UserWarning handler below
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", UserWarning)
+            vcf = su.read_vcf(in_vcf, samps_list, benchmark)
+            genos, snps = su.vcf_to_genos(vcf, benchmark)
 
-        central_aft, sel_coeff, rand_offset = get_aft_central_window(
-            snps, genos, samp_sizes, win_size, missingness, mut_types, offset
+        center_idx, sel_coeff, rand_offset = get_central_idx(
+            snps, win_size, mut_types, offset
         )
-    
+
         if params is not None:
             sel_coeff = params[(params["rep"] == int(id)) & (params["sweep"] == scenario)]["selCoeff"].values[0]
 
         if "neut" not in scenario.lower() and sel_coeff == 0.0:
             raise Exception
 
-        return id, scenario, central_aft, sel_coeff, rand_offset
+        # Features of the whole replicate are built once and every window is sliced out of them
+        if "aft" in data_types:
+            ts_aft = prep_ts_aft(genos, samp_sizes)
+        if "hft" in data_types:
+            # Haplotypes are a view of the same calldata, nothing is re-read
+            haps = genos.to_haplotypes()
+
+        sweep_idx = center_idx - rand_offset
+        examples = []
+        for label, win_offset in get_window_offsets(
+            sweep_idx, rand_offset, len(snps), win_size, windows or {}
+        ):
+            feats = {}
+            if "aft" in data_types:
+                feats["aft"] = get_aft_window(
+                    ts_aft, sweep_idx + win_offset, win_size, missingness
+                )
+            if "hft" in data_types:
+                feats["hft"] = get_hft_window(
+                    haps,
+                    [ploidy * i for i in samp_sizes],
+                    sweep_idx + win_offset,
+                    win_size,
+                    n_classes,
+                )
+
+            if label == "neutral":
+                examples.append((id, scenarios[0], feats, 0.0, win_offset, label))
+            else:
+                examples.append((id, scenario, feats, sel_coeff, win_offset, label))
+
+        return examples
 
     except UserWarning as Ue:
         print(Ue)
@@ -294,46 +384,66 @@ def aft_worker(
         return None
 
 
-def hft_worker(
-    in_vcf,
-    mut_types,
-    scenarios,
-    samp_sizes,
-    samps_list,
-    win_size,
-    offset,
-    ploidy=2,
-    verbose=False,
-    params=None,
-):
-    benchmark = True
-    try:
-        id = get_rep_id(in_vcf)
-        scenario = get_scenario_from_filename(in_vcf, scenarios)
+def condense_path(in_vcf, worker):
+    """Runs worker on a replicate and tags its examples with its path, results come back out of order."""
+    return in_vcf, worker(in_vcf)
 
-        vcf = su.read_vcf(in_vcf, samps_list, benchmark)
-        haps, snps = su.vcf_to_haps(vcf, benchmark)
 
-        central_hft, sel_coeff, rand_offset = get_hft_central_window(
-            snps, haps, [ploidy * i for i in samp_sizes], win_size, mut_types, offset
-        )
+def iter_condensed(worker, filelist, threads, data_types, no_progress=False):
+    """
+    Condenses replicates across a pool of processes, yielding each one as soon as it's done.
 
-        if params is not None:
-            sel_coeff = params[(params["rep"] == int(id)) & (params["sweep"] == scenario)]["selCoeff"].values[0]
+    Args:
+        worker (callable): condense_worker() with everything but the replicate path filled in.
+        filelist (list[str]): Replicates to condense.
+        threads (int): Number of processes.
+        data_types (tuple[str]): Feature types being built, for the progress bar.
+        no_progress (bool, optional): Don't show a progress bar.
+
+    Yields:
+        tuple[str, list]: Replicate path and output of condense_worker(), in order of completion.
+    """
+    with mp.Pool(threads) as pool:
+        # Unordered, so a slow replicate doesn't hold finished ones back in memory, and progress counts completions
+        work_res = pool.imap_unordered(partial(condense_path, worker=worker), filelist, chunksize=4)
+        if not no_progress:
+            work_res = tqdm(
+                work_res,
+                desc=f"Formatting {'/'.join(data_types).upper()} training data",
+                total=len(filelist),
+            )
 
-        return id, scenario, central_hft, sel_coeff, rand_offset
+        yield from work_res
 
-    except UserWarning as Ue:
-        # print(Ue)
-        return None
 
-    except Exception as e:
-        if verbose:
-            logger.warning(f"Could not process {in_vcf}")
-            logger.warning(f"Exception: {e}")
-            sys.stdout.flush()
-            sys.stderr.flush()
-        return None
+def is_pickle_path(outfile):
+    """Outfiles ending in .pkl or .pickle get the legacy single pickle instead of a training store."""
+    return outfile.endswith((".pkl", ".pickle"))
+
+
+def write_pickle(outfile, results, scenarios):
+    """
+    Collects condensed replicates into the legacy dict[scenario][rep][data type/sel_coeff/center_offset] pickle.
+
+    Args:
+        outfile (str): Pickle file to write.
+        results (iterable[tuple[str, list]]): Replicate path and output of condense_worker(), see iter_condensed(). Only center windows are kept.
+        scenarios (list[str]): Scenarios from the config.
+    """
+    pickle_dict = {}
+    for s in scenarios:
+        pickle_dict[s] = {}
+
+    for _, examples in results:
+        if examples:
+            rep, scenario, feats, s, off, _ = examples[0]
+
+            pickle_dict[scenario][rep] = dict(feats)
+            pickle_dict[scenario][rep]["sel_coeff"] = s
+            pickle_dict[scenario][rep]["center_offset"] = off
+
+    with open(outfile, "wb") as ofile:
+        pickle.dump(pickle_dict, ofile)
 
 
 def main(ua):
@@ -375,99 +485,67 @@ def main(ua):
 
     filelist = glob(f"{work_dir}/vcfs/*/*/merged.vcf", recursive=True)
 
-    aft_work_args = zip(
-        filelist,
-        cycle([mut_types]),
-        cycle([scenarios]),
-        cycle([samp_sizes]),
-        cycle([samps_list]),
-        cycle([win_size]),
-        cycle([offset]),
-        cycle([ua.missingness]),
-        cycle([ua.verbose]),
-        cycle([params]),
+    data_types = ("aft", "hft") if ua.hft else ("aft",)
+    windows = get_training_windows(yaml_data)
+
+    if not is_pickle_path(ua.outfile):
+        # Everything that changes the features, a store condensed with other settings isn't appended to
+        config = {
+            "win_size": win_size,
+            "sample sizes": samp_sizes,
+            "ploidy": ploidy,
+            "mut types": mut_types,
+            "scenarios": scenarios,
+            # Random subsamples differ every run, they're kept in the manifest instead, see below
+            "samples": None if ua.subsample_inds else samps_list,
+            "subsample inds": ua.subsample_inds,
+            "allow shoulders": offset,
+            "missingness": ua.missingness,
+            "hft classes": get_n_hft_classes(yaml_data),
+            "training windows": windows,
+            "params": os.path.abspath(ua.paramsfile) if ua.paramsfile else None,
+        }
+        manifest = stu.open_training_store(ua.outfile, data_types, config, ua.overwrite)
+        if ua.subsample_inds:
+            samps_list = stu.get_store_samples(ua.outfile, manifest, samps_list)
+
+    worker = partial(
+        condense_worker,
+        mut_types=mut_types,
+        scenarios=scenarios,
+        samp_sizes=samp_sizes,
+        samps_list=samps_list,
+        win_size=win_size,
+        offset=offset,
+        missingness=ua.missingness,
+        data_types=data_types,
+        ploidy=int(ploidy),
+        verbose=ua.verbose,
+        params=params,
+        n_classes=get_n_hft_classes(yaml_data),
+        windows=windows,
     )
-    hft_work_args = zip(
-        filelist,
-        cycle([mut_types]),
-        cycle([scenarios]),
-        cycle([samp_sizes]),
-        cycle([samps_list]),
-        cycle([win_size]),
-        cycle([offset]),
-        cycle([int(ploidy)]),
-        cycle([ua.verbose]),
-        cycle([params]),
+    if is_pickle_path(ua.outfile):
+        if windows:
+            raise ValueError("training windows need a training store, pickles hold one window per replicate")
+
+        print("[INFO] Starting run")
+        results = iter_condensed(worker, filelist, threads, data_types, ua.no_progress)
+        write_pickle(ua.outfile, results, scenarios)
+        return
+
+    todo = stu.get_pending_replicates(manifest, filelist)
+    logger.info(
+        f"{len(filelist) - len(todo)} of {len(filelist)} replicates are already condensed in {ua.outfile}"
     )
-    print("[INFO] Starting run")
-    debug = False
-    if debug:
-        aft_work_res = []
-        for i in tqdm(aft_work_args, desc="AFT", total=len(filelist)):
-            aft_work_res.append(aft_worker(*i))
-        
-        hft_work_res = []
-        for i in tqdm(hft_work_args, desc="HFT", total=len(filelist)):
-            hft_work_res.append(hft_worker(*i))
 
-    else:
-        pool = mp.Pool(threads)
-        if ua.no_progress:
-            aft_work_res = pool.starmap(aft_worker, aft_work_args, chunksize=4,)
-
-            if ua.hft:
-                hft_work_res = pool.starmap(hft_worker, hft_work_args, chunksize=4,)
-
-            pool.close()
-        else:
-            aft_work_res = pool.starmap(
-                aft_worker,
-                tqdm(
-                    aft_work_args,
-                    desc="Formatting AFT training data",
-                    total=len(filelist),
-                ),
-                chunksize=4,
-            )
-            if ua.hft:
-                hft_work_res = pool.starmap(
-                    hft_worker,
-                    tqdm(
-                        hft_work_args,
-                        desc="Formatting HFT training data",
-                        total=len(filelist),
-                    ),
-                    chunksize=4,
-                )
-            pool.close()
-
-    pickle_dict = {}
-    for s in scenarios:
-        pickle_dict[s] = {}
-
-    for res in aft_work_res:
-        if res:
-            rep, scenario, aft, s, off = res
-
-            pickle_dict[scenario][rep] = {}
-            pickle_dict[scenario][rep]["aft"] = aft
-            pickle_dict[scenario][rep]["sel_coeff"] = s
-            pickle_dict[scenario][rep]["center_offset"] = off
-
-    if ua.hft:
-        for res in hft_work_res:
-            try:
-                if res:
-                    rep, scenario, hft, s, off = res
-                    if rep in pickle_dict[scenario].keys():
-                        pickle_dict[scenario][rep]["hft"] = hft
-                        pickle_dict[scenario][rep]["sel_coeff"] = s
-                        pickle_dict[scenario][rep]["center_offset"] = off
-
-            except KeyError as e:
-                print(e)
-                print(res)
-                pass
-
-    with open(ua.outfile, "wb") as outfile:
-        pickle.dump(pickle_dict, outfile)
+    print("[INFO] Starting run")
+    # Shards are written by a writer thread while finished replicates keep coming in
+    manifest = gu.drain_in_thread(
+        partial(stu.append_training_store, ua.outfile, manifest),
+        iter_condensed(worker, todo, threads, data_types, ua.no_progress),
+        maxsize=WRITER_QUEUE_SIZE,
+    )
+    logger.info(
+        f"{manifest['n_examples']} windows in {len(manifest['shards'])} shards in {ua.outfile}"
+    )
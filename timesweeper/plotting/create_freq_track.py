@@ -3,7 +3,6 @@ from timesweeper.utils.gen_utils import get_logger, read_config
 import numpy as np
 import allel
 import os
-from tqdm import tqdm
 
 
 def calc_freq_diffs(genos, snps, samp_sizes):
@@ -13,17 +12,14 @@ def calc_freq_diffs(genos, snps, samp_sizes):
 
     Args:
         genos (allel.GenotypeArray): Genotype array of all timepoints.
-        snps (list[tuple[chrom, pos]]): Location of each SNP in the VCF iterable. Index-matched with genos.
+        snps (np.arr): Structured array with the location of each SNP in the VCF iterable, see su.make_loc_arr(). Index-matched with genos.
         samp_sizes (list[int]): Sample sizes of each timepoint, used for indexing the genotype arrays by timepoint.
 
     Returns:
         tuple[tuple[tuple[chrom, pos], minor_freq_changes, major_freq_changes]]: Tuple of all details needed to create bedfile.
     """
     ts_genos = su.split_arr(genos, samp_sizes)
-    min_alleles = su.get_vel_minor_alleles(ts_genos, np.max(genos))
-
-    # [(snp, min_change, maj_change)]
-    freq_diffs = []
+    min_alleles, _, _ = su.get_vel_minor_alleles(ts_genos, np.max(genos))
 
     first_counts = allel.GenotypeArray(ts_genos[0]).count_alleles(
         max_allele=min_alleles.max()
@@ -32,21 +28,20 @@ def calc_freq_diffs(genos, snps, samp_sizes):
         max_allele=min_alleles.max()
     )
 
-    for snp_idx, min_allele_idx in tqdm(
-        zip(range(len(first_counts)), min_alleles),
-        total=len(first_counts),
-        desc="Calculating frequency diffs:",
-    ):
-        first_min_af = su.calc_maft(first_counts[snp_idx], min_allele_idx)
-        first_maj_af = 1 - first_min_af
-
-        last_min_af = su.calc_maft(last_counts[snp_idx], min_allele_idx)
-        last_maj_af = 1 - last_min_af
-
-        minor_freq_changes = last_min_af - first_min_af
-        major_freq_changes = last_maj_af - first_maj_af
+    first_min_af, last_min_af = su.calc_ts_maft(
+        np.stack([first_counts, last_counts], axis=1), min_alleles
+    )
+    minor_freq_changes = last_min_af - first_min_af
+    major_freq_changes = (1 - last_min_af) - (1 - first_min_af)
 
-        freq_diffs.append((snps[snp_idx], minor_freq_changes, major_freq_changes))
+    # [(snp, min_change, maj_change)]
+    freq_diffs = list(
+        zip(
+            zip(snps["chrom"], snps["pos"]),
+            minor_freq_changes,
+            major_freq_changes,
+        )
+    )
 
     return freq_diffs
 
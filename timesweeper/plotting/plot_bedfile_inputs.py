@@ -4,11 +4,11 @@ import os
 import warnings
 from itertools import cycle
 
-import allel
 import matplotlib.colors
 import matplotlib.pyplot as plt
 import numpy as np
 
+from timesweeper.make_training_features import prep_ts_aft
 from timesweeper.utils import snp_utils as su
 from timesweeper.utils.gen_utils import read_config
 
@@ -65,7 +65,7 @@ def parse_ua():
         "-i",
         "--input-vcf",
         dest="input_vcf",
-        help="Merged VCF to scan for sweeps. Must be merged VCF where files are merged in order from earliest to latest sampling time, -0 flag must be used.",
+        help="Merged VCF (tabix-indexed, or a genotype store made with `timesweeper index`) to pull regions from. Must be merged VCF where files are merged in order from earliest to latest sampling time, -0 flag must be used.",
         required=True,
     )
     uap.add_argument(
@@ -116,8 +116,10 @@ def parse_ua():
 
 def worker(_reg, vcf, samp_sizes, plotDir):
     reg = f"{_reg[0]}:{_reg[1]}-{_reg[2]}"
-    fields = ["variants/CHROM", "variants/POS", "calldata/GT"]
-    vcf_reg = allel.read_vcf(vcf, fields=fields, region=reg)
+    vcf_reg = su.read_vcf_region(vcf, reg, benchmark=False)
+    if vcf_reg is None:
+        return
+
     genos, snps = su.vcf_to_genos(vcf_reg, benchmark=False)
     aft = prep_ts_aft(genos, samp_sizes)
     aft = np.swapaxes(aft, 0, 1)
@@ -6,6 +6,7 @@ import matplotlib.colors
 import matplotlib.pyplot as plt
 import numpy as np
 
+from timesweeper.utils import store_utils as stu
 from timesweeper.utils.gen_utils import read_config
 
 mpl.use("Agg")
@@ -88,6 +89,17 @@ def readData(picklefile, data_type):
         Tuple[list[np.arr], list[np.arr], list[np.arr]]: Lists of arrays for processing for scenarios.
     """
 
+    if stu.is_training_store(picklefile):
+        if data_type.lower() not in stu.read_manifest(picklefile)["data types"]:
+            return {}
+
+        # Pull each scenario's replicates straight out of the memory-mapped shards
+        scenarios = dict.fromkeys(stu.read_training_labels(picklefile)["scenario"])
+        return {
+            s: stu.read_training_data(picklefile, data_type.lower(), [s])["data"]
+            for s in scenarios
+        }
+
     pikl_dict = pickle.load(open(picklefile, "rb"))
     sweep_types = pikl_dict.keys()
     data_dict = {}
@@ -111,6 +123,9 @@ def getMeanMatrix(data):
 
 def get_mat_types(picklefile):
     """Simple search for input data types for flexibility"""
+    if stu.is_training_store(picklefile):
+        return stu.read_manifest(picklefile)["data types"] + ["sel_coeff", "center_offset"]
+
     pikl_dict = pickle.load(open(picklefile, "rb"))
 
     return list(pikl_dict[list(pikl_dict.keys())[0]]["1"].keys())
@@ -135,6 +150,8 @@ def main(ua):
 
         raw_data = {}
         data_dict = readData(ua.input_pickle, mat_type)
+        if not data_dict:
+            continue
 
         for lab in data_dict:
             raw_data[lab] = np.stack(data_dict[lab]).transpose(0, 2, 1)
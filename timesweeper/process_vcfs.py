@@ -1,37 +1,285 @@
 import multiprocessing as mp
 import os
+import re
 import subprocess
+import time
+from collections import deque
+from functools import partial
 from glob import glob
-from itertools import cycle
+
+import numpy as np
+from tqdm import tqdm
+
+from timesweeper.utils.gen_utils import get_logger, read_config
+
+logger = get_logger("process_vcfs")
 
 
 # VCF Processing
-def read_multivcf(input_vcf):
-    """Reads in file and returns as list of strings."""
+VCF_HEADER = "##fileformat=VCFv4.2"
+PASS_FILTER = '##FILTER=<ID=PASS,Description="All filters passed">'
+# INFO fields kept from every timepoint, same as bcftools merge --info-rules 'MT:join,S:join'
+JOINED_INFO = ["MT", "S"]
+# INFO fields bcftools recounts from the merged genotypes when the header defines them
+COUNTED_INFO = ["AN", "AC"]
+
+
+def read_multivcf(input_vcf, num_tps, header=VCF_HEADER):
+    """
+    Streams a multivcf (SLiM appends one VCF per sampling point to the same file) and parses each VCF it holds.
+    Only the last num_tps VCFs are kept, earlier ones are left over from restarts.
+
+    Args:
+        input_vcf (str): Multivcf to read.
+        num_tps (int): Number of timepoints sampled.
+        header (str, optional): First line of each VCF. Defaults to VCF_HEADER.
+
+    Returns:
+        list[dict]: Header lines, sample names, and records of each timepoint, see parse_vcf_lines().
+    """
+    vcfs = deque(maxlen=num_tps)
     with open(input_vcf, "r") as input_file:
-        raw_lines = [i.strip() for i in input_file.readlines()]
+        lines = None
+        for line in input_file:
+            line = line.rstrip("\n")
+            if line == header:
+                if lines is not None:
+                    vcfs.append(parse_vcf_lines(lines))
+                lines = []
+            if lines is not None and line:
+                lines.append(line)
+
+        if lines is not None:
+            vcfs.append(parse_vcf_lines(lines))
+
+    return list(vcfs)
+
+
+def parse_vcf_lines(vcf_lines):
+    """
+    Splits the lines of a single VCF into header, samples, and records keyed by site.
+    Sites are keyed by (CHROM, POS, REF, ALT) and the number of times that site was already seen,
+        so repeated mutations at the same site are matched in order across timepoints.
+
+    Args:
+        vcf_lines (list[str]): Lines of the VCF.
+
+    Returns:
+        dict: "header" lines before #CHROM, "samples" names, and "records" mapping each site to its
+            first 9 columns and the tab-joined genotype columns.
+    """
+    header, samples, records = [], [], {}
+    for line in vcf_lines:
+        if line.startswith("##"):
+            header.append(line)
+        elif line.startswith("#CHROM"):
+            samples = line.split("\t")[9:]
+        else:
+            fields = line.split("\t", 9)
+            site = (fields[0], fields[1], fields[3], fields[4])
+            dup = 0
+            while (*site, dup) in records:
+                dup += 1
+            genos = fields[9] if len(fields) > 9 else ""
+            records[(*site, dup)] = (fields[:9], genos)
+
+    return {"header": header, "samples": samples, "records": records}
+
+
+def get_ref_genos(vcf, ploidy):
+    """Genotype columns for a timepoint that doesn't have a site, homozygous ref like bcftools merge -0."""
+    return "\t".join(["/".join(["0"] * ploidy)] * len(vcf["samples"]))
+
+
+def get_ploidy(vcfs):
+    """Ploidy of the first genotype found, defaults to diploid."""
+    for vcf in vcfs:
+        for _, genos in vcf["records"].values():
+            if genos:
+                return len(re.split("[/|]", genos.split("\t", 1)[0]))
+
+    return 2
+
+
+def get_info_types(header):
+    """Type of each INFO field defined in the header, e.g. {"S": "Float"}."""
+    info_types = {}
+    for line in header:
+        if line.startswith("##INFO="):
+            info_id = re.search("ID=([^,>]+)", line)
+            info_type = re.search("Type=([^,>]+)", line)
+            if info_id and info_type:
+                info_types[info_id.group(1)] = info_type.group(1)
+
+    return info_types
+
+
+def format_float(value):
+    """Writes a float the way htslib does, single precision printed with %g."""
+    if value == ".":
+        return value
+
+    return f"{float(np.float32(value)):g}"
+
+
+def merge_info(infos, info_types):
+    """
+    Merges the INFO column of a site across timepoints, same as bcftools merge --info-rules 'MT:join,S:join'.
+    Fields are taken from the first timepoint that has them, JOINED_INFO fields are joined across all of them
+        and moved after the others. COUNTED_INFO fields are left out, merge_multivcf() recounts them.
+
+    Args:
+        infos (list[str]): INFO column of each timepoint that has the site, in timepoint order.
+        info_types (dict[str, str]): Type of each INFO field in the header, see get_info_types().
+
+    Returns:
+        list[str]: Merged INFO fields.
+    """
+    fields, joined = {}, {key: [] for key in JOINED_INFO}
+    for info in infos:
+        for item in info.split(";"):
+            key, *value = item.split("=", 1)
+            if key == "." or (key in COUNTED_INFO and key in info_types):
+                continue
+            if value and info_types.get(key) == "Float":
+                value = [",".join(format_float(v) for v in value[0].split(","))]
+            if key in joined:
+                joined[key].extend(value)
+            elif key not in fields:
+                fields[key] = value
+
+    merged = ["=".join([key, *value]) for key, value in fields.items()]
+    merged.extend(f"{key}={','.join(values)}" for key, values in joined.items() if values)
+
+    return merged
+
+
+def count_alleles(genos, n_alts):
+    """
+    Allele number and count of each ALT allele over all genotype columns, like bcftools recalculates them.
+
+    Args:
+        genos (list[str]): Tab-joined genotype columns of each timepoint.
+        n_alts (int): Number of ALT alleles at the site.
+
+    Returns:
+        tuple[int, list[int]]: Number of called alleles and count of each ALT allele.
+    """
+    alleles = [
+        allele
+        for cols in genos
+        for col in cols.split("\t")
+        for allele in re.split("[/|]", col.split(":", 1)[0])
+        if allele != "."
+    ]
+    counts = [0] * n_alts
+    for allele in alleles:
+        if 0 < int(allele) <= n_alts:
+            counts[int(allele) - 1] += 1
+
+    return len(alleles), counts
+
 
-    return raw_lines
+def merge_qual(quals):
+    """Highest QUAL of the site across timepoints, missing if none of them have one."""
+    quals = [float(qual) for qual in quals if qual != "."]
+    if not quals:
+        return "."
 
+    return format_float(max(quals))
 
-def split_multivcf(vcf_lines, header):
-    """Splits the lines of multi-vcf file into list of vcf entries by <header> using itertools."""
-    header_idxs = [i for i in range(len(vcf_lines)) if vcf_lines[i] == header]
 
-    split_vcfs = []
-    for idx in range(len(header_idxs[:-1])):
-        split_vcfs.append(vcf_lines[header_idxs[idx] : header_idxs[idx + 1]])
+def merge_samples(vcfs):
+    """
+    Sample names of the merged VCF in timepoint order.
+    Duplicated names are prefixed with the (1-based) timepoint number, same as bcftools merge --force-samples.
+    """
+    seen, merged = set(), []
+    for tp, vcf in enumerate(vcfs):
+        for samp in vcf["samples"]:
+            name = samp if samp not in seen else f"{tp + 1}:{samp}"
+            seen.add(name)
+            merged.append(name)
+
+    return merged
 
-    split_vcfs.append(vcf_lines[header_idxs[-1] :])
 
-    return split_vcfs
+def merge_header(vcfs):
+    """
+    Header lines of all timepoints in order of first appearance, without duplicates.
+    The PASS filter goes right after ##fileformat if it isn't defined, like htslib adds it.
+    """
+    header = list(dict.fromkeys(line for vcf in vcfs for line in vcf["header"]))
+    if not any(line.startswith("##FILTER=<ID=PASS,") for line in header):
+        header.insert(1 if header else 0, PASS_FILTER)
+
+    return header
 
 
-def write_vcfs(vcf_lines, vcf_dir):
-    """Writes list of vcf entries to numerically-sorted vcf files."""
-    for idx, lines in enumerate(vcf_lines):
-        with open(os.path.join(vcf_dir, f"{idx}.vcf"), "w") as outfile:
-            outfile.writelines("\n".join(lines))
+def get_contig_order(header):
+    """Position of each contig in the ##contig header lines, records are sorted by it like bcftools sort."""
+    contigs = [
+        re.search("ID=([^,>]+)", line).group(1)
+        for line in header
+        if line.startswith("##contig=")
+    ]
+
+    return {contig: idx for idx, contig in enumerate(contigs)}
+
+
+def merge_multivcf(vcfs, outfile):
+    """
+    Horizontally merges the VCF of each timepoint into a single VCF, in memory and without bcftools.
+    Equivalent to sorting each timepoint and running bcftools merge -0 --force-samples --info-rules 'MT:join,S:join':
+        sites missing from a timepoint are homozygous ref there, QUAL is the highest of all timepoints,
+        and AN/AC are recounted if the header defines them.
+    Unlike bcftools, records at the same position with different ALTs are never combined into one multiallelic
+        record, so every record stays a single SLiM mutation with its own MT and S.
+
+    Args:
+        vcfs (list[dict]): Parsed VCF of each timepoint, oldest first, see read_multivcf().
+        outfile (str): Merged VCF to write.
+    """
+    header = merge_header(vcfs)
+    info_types = get_info_types(header)
+    contig_order = get_contig_order(header)
+    ploidy = get_ploidy(vcfs)
+    ref_genos = [get_ref_genos(vcf, ploidy) for vcf in vcfs]
+
+    # Sites in order of first appearance, stable-sorted by contig and position
+    sites = list(dict.fromkeys(site for vcf in vcfs for site in vcf["records"]))
+    sites.sort(
+        key=lambda site: (contig_order.get(site[0], len(contig_order)), int(site[1]))
+    )
+
+    with open(outfile, "w") as ofile:
+        for line in header:
+            ofile.write(line + "\n")
+        ofile.write(
+            "\t".join(
+                ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+                + merge_samples(vcfs)
+            )
+            + "\n"
+        )
+
+        for site in sites:
+            present = [vcf["records"][site] for vcf in vcfs if site in vcf["records"]]
+            fields = list(present[0][0])
+            genos = [
+                vcf["records"][site][1] if site in vcf["records"] else ref
+                for vcf, ref in zip(vcfs, ref_genos)
+            ]
+            fields[5] = merge_qual([p[0][5] for p in present])
+            info = merge_info([p[0][7] for p in present], info_types)
+            if any(key in info_types for key in COUNTED_INFO):
+                n_alleles, counts = count_alleles(genos, len(fields[4].split(",")))
+                if "AN" in info_types:
+                    info.append(f"AN={n_alleles}")
+                if "AC" in info_types:
+                    info.append(f"AC={','.join(map(str, counts))}")
+            fields[7] = ";".join(info) or "."
+            ofile.write("\t".join(fields + genos) + "\n")
 
 
 def index_vcf(vcf):
@@ -57,19 +305,26 @@ def index_vcf(vcf):
     )
 
 
-def merge_vcfs(vcf_dir):
-    num_files = len(glob(f"{vcf_dir}/*.vcf.sorted.gz"))
-    if num_files == 1:
-        cmd = f"""zcat {f"{vcf_dir}/0.vcf.sorted.gz"} > {vcf_dir}/merged.vcf"""
+def get_indexed_vcf(vcf):
+    """
+    Returns path to a bgzipped, tabix-indexed version of vcf (or indexed BCF) for region queries.
+    Existing .tbi/.csi indices are used as-is, otherwise one is built with tabix, bcftools, or index_vcf().
+    """
+    if any(os.path.exists(f"{vcf}{ext}") for ext in [".tbi", ".csi"]):
+        return vcf
 
-    else:
-        cmd = f"""bcftools merge -Ov -0 \
-                --force-samples --info-rules 'MT:join,S:join' \
-                {" ".join([f"{vcf_dir}/{i}.vcf.sorted.gz" for i in range(num_files)])} > \
-                {vcf_dir}/merged.vcf \
-                """
+    if vcf.endswith(".bcf"):
+        subprocess.run(["bcftools", "index", "-f", vcf], check=True)
+        return vcf
 
-    subprocess.run(cmd, shell=True)
+    if vcf.endswith(".gz"):
+        subprocess.run(["tabix", "-f", "-p", "vcf", vcf], check=True)
+        return vcf
+
+    if not os.path.exists(f"{vcf}.sorted.gz.tbi"):
+        index_vcf(vcf)
+
+    return f"{vcf}.sorted.gz"
 
 
 def get_num_inds(vcf_file):
@@ -79,13 +334,6 @@ def get_num_inds(vcf_file):
     return int(num_ind)
 
 
-def cleanup_intermed(vcf_dir):
-    for ifile in glob(f"{vcf_dir}/*"):
-        if "merged" not in ifile and "final" not in ifile:
-            pass
-            os.remove(ifile)
-
-
 def make_vcf_dir(input_vcf):
     """Creates directory named after vcf basename."""
     dirname = os.path.basename(input_vcf).split(".")[0]
@@ -104,33 +352,113 @@ def make_vcf_dir(input_vcf):
     return vcf_dir
 
 
+def merge_replicate(input_vcf, num_tps):
+    """
+    Splits a SLiM multivcf by timepoint and merges it into <input_vcf basename>/merged.vcf.
+
+    Args:
+        input_vcf (str): Multivcf to process.
+        num_tps (int): Number of timepoints sampled, only the last num_tps VCFs in the file are used.
+
+    Returns:
+        str: Path to the merged VCF.
+    """
+    # Split into multiples after SLiM just concats to same file
+    vcfs = read_multivcf(input_vcf, num_tps)
+    if len(vcfs) < num_tps:
+        raise ValueError(f"Found {len(vcfs)} VCFs, expected {num_tps} timepoints")
+
+    # Creates subdir for each rep
+    vcf_dir = make_vcf_dir(input_vcf)
+    merged_vcf = os.path.join(vcf_dir, "merged.vcf")
+    merge_multivcf(vcfs, merged_vcf)
+
+    return merged_vcf
+
+
 def process_vcfs(input_vcf, num_tps):
+    """Runs merge_replicate() after a simulation, logging which replicate failed before re-raising the error."""
     try:
-        # Split into multiples after SLiM just concats to same file
-        raw_lines = read_multivcf(input_vcf)
-        split_lines = split_multivcf(raw_lines, "##fileformat=VCFv4.2")
-        if len(split_lines) > 0:
-            split_lines = split_lines[len(split_lines) - num_tps :]
+        merge_replicate(input_vcf, num_tps)
 
-            # Creates subdir for each rep
-            vcf_dir = make_vcf_dir(input_vcf)
-            write_vcfs(split_lines, vcf_dir)
+    except Exception:
+        logger.error(f"Couldn't process {input_vcf}")
+        raise
 
-            # Now index and merge
-            [index_vcf(vcf) for vcf in glob(f"{vcf_dir}/*.vcf")]
-            merge_vcfs(vcf_dir)
 
-            cleanup_intermed(vcf_dir)
+def process_worker(input_vcf, num_tps):
+    """
+    Runs merge_replicate() in a pool, catching errors so they can be collected by main().
+
+    Returns:
+        tuple[str, int, str]: Replicate path, its size in bytes, and the error it failed with or None.
+    """
+    try:
+        n_bytes = os.path.getsize(input_vcf)
+        merge_replicate(input_vcf, num_tps)
+        return input_vcf, n_bytes, None
 
     except Exception as e:
-        print(f"[ERROR] Couldn't process {e}")
-        pass
+        return input_vcf, 0, f"{type(e).__name__}: {e}"
+
+
+def get_num_tps(yaml_data):
+    """Number of timepoints from the config, the length of "sample sizes" or sim_custom's "num_sample_points"."""
+    if "sample sizes" in yaml_data:
+        return len(yaml_data["sample sizes"])
+    elif "num_sample_points" in yaml_data:
+        return int(yaml_data["num_sample_points"])
+    else:
+        raise ValueError(
+            "Config needs either 'sample sizes' or 'num_sample_points' to know how many timepoints were sampled."
+        )
+
+
+def write_fail_list(fail_list, failures):
+    """Writes each failed replicate and its error as a tsv, can be used to rerun or clean them up."""
+    with open(fail_list, "w") as ofile:
+        for input_vcf, error in sorted(failures):
+            ofile.write(f"{input_vcf}\t{error}\n")
 
 
 def main(ua):
-    vcflist = glob(f"{ua.in_dir}/*/*/*.multivcf")
+    yaml_data = read_config(ua.yaml_file)
+    num_tps = get_num_tps(yaml_data)
+    fail_list = ua.fail_list or os.path.join(ua.in_dir, "process_failures.tsv")
 
-    with mp.Pool(ua.threads) as p:
-        p.map(vcflist, cycle([ua.num_tps]))
+    # Longest first, so the biggest replicates don't start last and leave the rest of the pool idle
+    vcflist = sorted(
+        glob(f"{ua.in_dir}/*/*/*.multivcf"), key=os.path.getsize, reverse=True
+    )
+    logger.info(f"Processing {len(vcflist)} multivcfs with {num_tps} timepoints each")
 
-    print("[INFO] Done")
+    failures = []
+    with mp.Pool(ua.threads) as p:
+        # One replicate per task, size ordering is lost if workers grab them in chunks
+        work_res = p.imap_unordered(
+            partial(process_worker, num_tps=num_tps), vcflist, chunksize=1
+        )
+        with tqdm(
+            total=len(vcflist),
+            desc="Merging multivcfs",
+            unit="rep",
+            disable=ua.no_progress,
+        ) as pbar:
+            n_bytes, start = 0, time.perf_counter()
+            for input_vcf, size, error in work_res:
+                if error:
+                    failures.append((input_vcf, error))
+                n_bytes += size
+                pbar.update()
+                pbar.set_postfix(
+                    MB_per_s=f"{n_bytes / 1e6 / (time.perf_counter() - start):.1f}",
+                    failed=len(failures),
+                )
+
+    write_fail_list(fail_list, failures)
+    if failures:
+        logger.warning(
+            f"{len(failures)} of {len(vcflist)} replicates failed, see {fail_list}"
+        )
+
+    logger.info("Done")
@@ -3,11 +3,12 @@ import multiprocessing as mp
 import os
 import subprocess
 import argparse
-from glob import glob
 
 import numpy as np
 import yaml
 
+from timesweeper import process_vcfs as pv
+
 logging.basicConfig()
 logger = logging.getLogger("sim_custom")
 
@@ -61,12 +62,16 @@ def make_d_block(
     inds_per_tp,
     physLen,
     verbose=False,
+    burn_in_file=None,
+    save_burn_in=False,
 ):
     """
     This is meant to be a very customizeable block of text for adding custom args to SLiM as constants.
     Can add other functions to this module and call them here e.g. pulling selection coeff from a dist.
     This block MUST INCLUDE the 'sweep' and 'outFile' params, and at the very least the outFile must be used as output for outputVCFSample.
     Please note that when feeding strings as a constant you must escape them since this is a shell process.
+    If burn_in_file is given it's passed as 'burnInFile', the script should start from it, or save its burn-in to it
+        and stop if 'saveBurnIn' is also defined. See constant_population.slim.
     """
     selCoeff = randomize_selCoeff_uni()
     if num_sample_points == 1:
@@ -87,6 +92,12 @@ def make_d_block(
     -d physLen={physLen} \
     -d seed={np.random.randint(0, 1e16)} \
     """
+    if burn_in_file:
+        d_block += f"""-d "burnInFile='{burn_in_file}'" \
+    """
+    if save_burn_in:
+        d_block += """-d saveBurnIn=T \
+    """
     if verbose:
         logger.info(f"Using the following constants with SLiM: {d_block}")
 
@@ -106,136 +117,96 @@ def simulate(slim_path, d_block, slimfile, logfile):
         logger.error(e.output)
 
 
-# VCF Processing
-def read_multivcf(input_vcf):
-    """Reads in file and returns as list of strings."""
-    with open(input_vcf, "r") as input_file:
-        raw_lines = [i.strip() for i in input_file.readlines()]
-
-    return raw_lines
-
-
-def split_multivcf(vcf_lines, header):
-    """Splits the lines of multi-vcf file into list of vcf entries by <header> using itertools."""
-    header_idxs = [i for i in range(len(vcf_lines)) if vcf_lines[i] == header]
-
-    split_vcfs = []
-    for idx in range(len(header_idxs[:-1])):
-        split_vcfs.append(vcf_lines[header_idxs[idx] : header_idxs[idx + 1]])
-
-    split_vcfs.append(vcf_lines[header_idxs[-1] :])
+def simulate_prep(
+    vcf_file, num_sample_points, slimfile, slim_path, d_block, logfile, dumpFile
+):
+    """
+    Simulates a single replicate and merges its timepoints, one task in the pool run by main().
 
-    return split_vcfs
+    Returns:
+        tuple[str, str]: Multivcf path and the error merging it failed with, or None.
+    """
+    simulate(slim_path, d_block, slimfile, logfile)
+    if os.path.exists(dumpFile):
+        os.remove(dumpFile)
 
+    _, _, error = pv.process_worker(vcf_file, num_sample_points)
+    if os.path.exists(vcf_file):
+        os.remove(vcf_file)
 
-def write_vcfs(vcf_lines, vcf_dir):
-    """Writes list of vcf entries to numerically-sorted vcf files."""
-    for idx, lines in enumerate(vcf_lines):
-        with open(os.path.join(vcf_dir, f"{idx}.vcf"), "w") as outfile:
-            outfile.writelines("\n".join(lines))
+    return vcf_file, error
 
 
-def index_vcf(vcf):
+def make_burn_ins(
+    n_burn_ins,
+    burn_in_dir,
+    slim_file,
+    slim_path,
+    num_sample_points,
+    inds_per_tp,
+    physLen,
+    threads,
+):
     """
-    Indexes and sorts vcf file.
-    Commands are run separately such that processes complete before the next one starts.
+    Simulates a pool of independent neutral burn-ins for replicates to start from, the script saves them when given 'saveBurnIn'.
+    Population files already in burn_in_dir are reused, so runs over separate --rep-range's share them.
+
+    Args:
+        n_burn_ins (int): Number of burn-ins to keep.
+        burn_in_dir (str): Directory to save population files and logs to.
+        slim_file (str): SLiM script, has to handle 'burnInFile' and 'saveBurnIn'.
+        slim_path (str): SLiM executable.
+        num_sample_points (int): Number of timepoints.
+        inds_per_tp (int): Individuals sampled at each timepoint.
+        physLen (int): Length of the simulated chromosome.
+        threads (int): Number of burn-ins to run at once.
+
+    Returns:
+        list[str]: Population files of all finished burn-ins.
     """
-    bgzip_cmd = f"bgzip -c {vcf} > {vcf}.gz"
-    tabix_cmd = f"tabix -f -p vcf {vcf}.gz"
-    bcftools_cmd = f"bcftools sort -Ov {vcf}.gz | bgzip -f > {vcf}.sorted.gz"
-    tabix_2_cmd = f"tabix -f -p vcf {vcf}.sorted.gz"
-    subprocess.run(
-        bgzip_cmd, shell=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL
-    )
-    subprocess.run(
-        tabix_cmd.split(), stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL
-    )
-    subprocess.run(
-        bcftools_cmd, shell=True, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL
-    )
-    subprocess.run(
-        tabix_2_cmd.split(), stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL
-    )
-
-
-def merge_vcfs(vcf_dir):
-    num_files = len(glob(f"{vcf_dir}/*.vcf.sorted.gz"))
-    if num_files == 1:
-        cmd = f"""zcat {f"{vcf_dir}/0.vcf.sorted.gz"} > {vcf_dir}/merged.vcf"""
+    os.makedirs(burn_in_dir, exist_ok=True)
+    burn_ins = [os.path.join(burn_in_dir, f"{i}.bin") for i in range(n_burn_ins)]
 
-    else:
-        cmd = f"""bcftools merge -Ov -0 \
-                --force-samples --info-rules 'MT:join,S:join' \
-                {" ".join([f"{vcf_dir}/{i}.vcf.sorted.gz" for i in range(num_files)])} > \
-                {vcf_dir}/merged.vcf \
-                """
-
-    subprocess.run(cmd, shell=True)
-
-
-def get_num_inds(vcf_file):
-    num_ind = subprocess.check_output(
-        """awk '{if ($1 == "#CHROM"){print NF-9; exit}}' """ + vcf_file, shell=True,
+    mp_args = []
+    for i, burn_in_file in enumerate(burn_ins):
+        if os.path.exists(burn_in_file):
+            continue
+
+        d_block = make_d_block(
+            "neut",
+            os.path.join(burn_in_dir, f"{i}.multivcf"),
+            os.path.join(burn_in_dir, f"{i}.multiMsOut"),
+            os.path.join(burn_in_dir, f"{i}.dump"),
+            num_sample_points,
+            inds_per_tp,
+            physLen,
+            False,
+            burn_in_file=f"{burn_in_file}.tmp",
+            save_burn_in=True,
+        )
+        mp_args.append(
+            (slim_path, d_block, slim_file, os.path.join(burn_in_dir, f"{i}.log"))
+        )
+
+    logger.info(
+        f"Simulating {len(mp_args)} burn-ins, reusing {n_burn_ins - len(mp_args)}"
     )
-    return int(num_ind)
-
+    if mp_args:
+        with mp.Pool(processes=min(threads, len(mp_args))) as pool:
+            pool.starmap(simulate, mp_args, chunksize=1)
 
-def cleanup_intermed(vcf_dir):
-    for ifile in glob(f"{vcf_dir}/*"):
-        if "merged" not in ifile and "final" not in ifile:
-            pass
-            os.remove(ifile)
+    # SLiM's exit status is lost to the log, burn-ins that finished are the ones that saved their population
+    for burn_in_file in burn_ins:
+        if os.path.exists(f"{burn_in_file}.tmp"):
+            os.replace(f"{burn_in_file}.tmp", burn_in_file)
 
+    burn_ins = [i for i in burn_ins if os.path.exists(i)]
+    if not burn_ins:
+        raise RuntimeError(
+            f"None of the burn-ins in {burn_in_dir} finished, see the logs there."
+        )
 
-def make_vcf_dir(input_vcf):
-    """Creates directory named after vcf basename."""
-    dirname = os.path.basename(input_vcf).split(".")[0]
-    dirpath = os.path.dirname(input_vcf)
-    vcf_dir = os.path.join(dirpath, dirname)
-    if os.path.exists(vcf_dir):
-        for ifile in glob(f"{vcf_dir}/*"):
-            os.remove(ifile)
-
-    os.makedirs(vcf_dir, exist_ok=True)
-
-    final_vcf = f"{input_vcf}.final"
-    if os.path.exists(final_vcf):
-        os.rename(final_vcf, f"{vcf_dir}/{final_vcf.split('/')[-1]}")
-
-    return vcf_dir
-
-
-def process_vcfs(input_vcf, num_tps):
-    try:
-        # Split into multiples after SLiM just concats to same file
-        raw_lines = read_multivcf(input_vcf)
-        split_lines = split_multivcf(raw_lines, "##fileformat=VCFv4.2")
-        if len(split_lines) > 0:
-            split_lines = split_lines[len(split_lines) - num_tps :]
-
-            # Creates subdir for each rep
-            vcf_dir = make_vcf_dir(input_vcf)
-            write_vcfs(split_lines, vcf_dir)
-
-            # Now index and merge
-            [index_vcf(vcf) for vcf in glob(f"{vcf_dir}/*.vcf")]
-            merge_vcfs(vcf_dir)
-
-            cleanup_intermed(vcf_dir)
-
-    except Exception as e:
-        print(f"[ERROR] Couldn't process {e}")
-        pass
-    
-    
-def simulate_prep(
-    vcf_file, num_sample_points, slimfile, slim_path, d_block, logfile, dumpFile
-):
-    simulate(slim_path, d_block, slimfile, logfile)
-    os.remove(dumpFile)
-
-    process_vcfs(vcf_file, num_sample_points)
-    os.remove(vcf_file)
+    return burn_ins
 
 
 def main(ua):
@@ -289,6 +260,20 @@ def main(ua):
         for sweep in sweeps:
             os.makedirs(f"{i}/{sweep}", exist_ok=True)
 
+    burn_ins = []
+    if ua.burn_ins:
+        burn_ins = make_burn_ins(
+            ua.burn_ins,
+            f"{work_dir}/burn_ins/{os.path.basename(slim_file).split('.')[0]}",
+            slim_file,
+            slim_path,
+            num_sample_points,
+            inds_per_tp,
+            physLen,
+            ua.threads,
+        )
+    rng = np.random.default_rng()
+
     mp_args = []
     # Inject info into SLiM script and then simulate, store params for reproducibility
     if rep_range:  # Take priority
@@ -312,6 +297,7 @@ def main(ua):
                 inds_per_tp,
                 physLen,
                 False,
+                burn_in_file=str(rng.choice(burn_ins)) if burn_ins else None,
             )
 
             mp_args.append(
@@ -326,8 +312,16 @@ def main(ua):
                 )
             )
 
-    pool = mp.Pool(processes=ua.threads)
-    pool.starmap(simulate_prep, mp_args, chunksize=1)
+    with mp.Pool(processes=ua.threads) as pool:
+        work_res = pool.starmap(simulate_prep, mp_args, chunksize=1)
+
+    failures = [(vcf_file, error) for vcf_file, error in work_res if error]
+    fail_list = f"{work_dir}/sim_failures.tsv"
+    pv.write_fail_list(fail_list, failures)
+    if failures:
+        logger.warning(
+            f"{len(failures)} of {len(mp_args)} simulations failed, see {fail_list}"
+        )
 
 if __name__=="__main__":
     sim_c_parser = argparse.ArgumentParser()
@@ -347,6 +341,14 @@ if __name__=="__main__":
         help="<start, stop>. If used, only range(start, stop) will be simulated for reps. \
             This is to allow for easy SLURM parallel simulations.",
     )
+    sim_c_parser.add_argument(
+        "--burn-ins",
+        required=False,
+        type=int,
+        dest="burn_ins",
+        help="Simulate this many neutral burn-ins once and start every replicate from a random one with a fresh seed, instead of each replicate simulating its own. \
+            The SLiM script has to handle the burnInFile and saveBurnIn constants, see constant_population.slim.",
+    )
     sim_c_parser.add_argument(
         "-y",
         "--yaml",
@@ -4,14 +4,15 @@ import multiprocessing as mp
 import os
 import re
 import subprocess
-import sys
-from glob import glob
+from functools import partial
 from itertools import cycle
 
 import numpy as np
 import pandas as pd
+from tqdm import tqdm
 
-from timesweeper import simulate_custom as sc
+from timesweeper import process_vcfs as pv
+from timesweeper.utils import tree_utils
 from timesweeper.utils.gen_utils import read_config
 
 logging.basicConfig(level=logging.INFO)
@@ -43,6 +44,14 @@ def get_slim_info(slim_lines):
     max_years_b0 = max(get_ints(slim_lines, """defineConstant("_T",""")) #Number of years BP to sim after burn in
     physLen = get_ints(slim_lines, """defineConstant("chromosome_length",""")[0]
 
+    first_biggest = get_ancestral_size(slim_lines)
+    burn_in_gens = first_biggest * burn_time_mult
+
+    return Q, gen_time, max_years_b0, round(burn_in_gens), physLen
+
+
+def get_ancestral_size(slim_lines):
+    """Largest population size of the first epoch, unscaled. The burn-in and recapitation are both based on it."""
     pop_sizes_line = [i for i in slim_lines if "_N" in i][0]
     pop_sizes_start = slim_lines.index(pop_sizes_line) + 2
     # The 4,3 will need to be more flexible
@@ -53,14 +62,14 @@ def get_slim_info(slim_lines):
     for i in slim_lines[pop_sizes_start:pop_sizes_end]:
         sizes.append([int(s) for s in re.split("\W+", i) if s.isdigit()])
 
-    first_biggest = max([i[0] for i in sizes])
-    burn_in_gens = first_biggest * burn_time_mult
-
-    return Q, gen_time, max_years_b0, round(burn_in_gens), physLen
+    return max([i[0] for i in sizes])
 
 
-def inject_constants(raw_lines, sweep, recombRate, selCoeff, sel_gen, end_gen, mut_rate, dumpfile):
-    """Adds in sweep type, selection coefficient, and some other details."""
+def inject_constants(raw_lines, sweep, recombRate, selCoeff, sel_gen, end_gen, mut_rate, dumpfile, trees_file=None):
+    """
+    Adds in sweep type, selection coefficient, and some other details.
+    With a trees_file the tree sequence is written there and no neutral mutations are simulated, they're overlaid after recapitation.
+    """
     raw_lines.insert(
         raw_lines.index("    initializeMutationRate(mutation_rate);"),
         f"\tdefineConstant('sweep', '{sweep}');",
@@ -87,13 +96,31 @@ def inject_constants(raw_lines, sweep, recombRate, selCoeff, sel_gen, end_gen, m
         f"""    sim.registerLateEvent(NULL, "{{dbg(self.source); checkOnSweep(); }}", {sel_gen}, {end_gen});"""
     )
 
-    raw_lines[raw_lines.index('    defineConstant("mutation_rate", Q * 0);')] = f'    defineConstant("mutation_rate", Q * {mut_rate});'
+    raw_lines[raw_lines.index('    defineConstant("mutation_rate", Q * 0);')] = f'    defineConstant("mutation_rate", Q * {0 if trees_file else mut_rate});'
+
+    if trees_file:
+        trees_lines = [i for i in raw_lines if 'defineConstant("trees_file",' in i]
+        if trees_lines:
+            raw_lines[raw_lines.index(trees_lines[0])] = f'    defineConstant("trees_file", "{trees_file}");'
+        else:
+            raw_lines.insert(
+                raw_lines.index("    initializeMutationRate(mutation_rate);"),
+                f'    defineConstant("trees_file", "{trees_file}");'
+            )
     
     return raw_lines
 
 
-def sanitize_slim(raw_lines):
-    """Removes sections of code inserted by stdpopsim that aren't needed."""
+def sanitize_slim(raw_lines, tree_seq=False):
+    """
+    Removes sections of code inserted by stdpopsim that aren't needed.
+    With tree_seq, tree-sequence recording and sampling are kept and the burn-in is dropped, recapitation replaces it.
+    """
+    if tree_seq:
+        burn_in_line = [i for i in raw_lines if 'defineConstant("burn_in",' in i][0]
+        raw_lines[raw_lines.index(burn_in_line)] = '    defineConstant("burn_in", 0);'
+        return raw_lines
+
     raw_lines.pop(raw_lines.index("    sim.treeSeqOutput(trees_file);"))
     raw_lines.pop(raw_lines.index("    initializeTreeSeq();"))
     raw_lines.pop(
@@ -102,8 +129,8 @@ def sanitize_slim(raw_lines):
     return raw_lines
 
 
-def inject_sampling(raw_lines, pop, samp_counts, gens, outfile_path):
-    """Injects the actual sampling block that outputs to VCF."""
+def inject_sampling(raw_lines, pop, samp_counts, gens, outfile_path, tree_seq=False):
+    """Injects the actual sampling block that outputs to VCF, with tree_seq samples are remembered in the tree sequence instead."""
     samp_eps_line = [i for i in raw_lines if "sampling_episodes" in i][0]
     # Start of sampling_episodes constant idx
     samp_eps_start = raw_lines.index(samp_eps_line)  
@@ -121,7 +148,7 @@ def inject_sampling(raw_lines, pop, samp_counts, gens, outfile_path):
     new_lines.append("\t" + f"), c(3, {len(gens)})));")
 
     for line in raw_lines:
-        if "treeSeqRememberIndividuals" in line:
+        if "treeSeqRememberIndividuals" in line and not tree_seq:
             raw_lines[
                 raw_lines.index(line)
             ] = f"""\t\t\t"{pop}.outputVCFSample("+n+", replace=F, filePath='{outfile_path}', append=T);}}","""
@@ -133,17 +160,24 @@ def inject_sampling(raw_lines, pop, samp_counts, gens, outfile_path):
     return finished_lines
 
 
-def make_sel_blocks(sweep, sel_gen, pop, dumpFileName):
+def get_restart_gen(sweep, sel_gen):
+    """Generation the dumpfile is saved at, replicates restart from there if the sweep is lost."""
     if sweep == "ssv":
-        restart_gen = sel_gen - 500
+        return sel_gen - 500
     else:
-        restart_gen = sel_gen
+        return sel_gen
+
+
+def make_sel_blocks(sweep, sel_gen, pop, dumpFileName, tree_seq=False):
+    restart_gen = get_restart_gen(sweep, sel_gen)
+    # Tree-sequence runs have to be saved with their tables to restart from, readFromPopulationFile loads .trees files the same way
+    save_call = "treeSeqOutput" if tree_seq else "outputFull"
 
     intro_block = f"""
     \n{restart_gen} late(){{
         // save the state of the simulation 
         print("SAVING TO " + "{dumpFileName}" + " at generation " + sim.generation);
-        sim.outputFull("{dumpFileName}");
+        sim.{save_call}("{dumpFileName}");
 
         if (sweep == "sdn")
         {{    
@@ -294,38 +328,351 @@ def write_slim(finished_lines, slim_file, rep, work_dir):
     return new_file_name
 
 
-def run_slim(slimfile, slim_path):
+def run_slim(slimfile, slim_path, timeout=None):
+    """
+    Runs a SLiM script, raising if it fails.
+
+    Args:
+        slimfile (str): Script to run.
+        slim_path (str): SLiM executable.
+        timeout (float, optional): Seconds to let SLiM run before it's killed. Defaults to no limit.
+    """
     cmd = f"{slim_path} {slimfile}"
+    subprocess.run(
+        cmd.split(),
+        check=True,
+        timeout=timeout,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+
+def simulate_replicate(
+    slimfile, slim_path, vcf_file, dumpfile, num_tps, timeout=None, recap_args=None
+):
+    """
+    Simulates a single replicate and merges its timepoints as soon as SLiM is done, one task in the pool run by main().
+
+    Args:
+        slimfile (str): Script to run, see write_slim().
+        slim_path (str): SLiM executable.
+        vcf_file (str): Multivcf the script writes to.
+        dumpfile (str): Dumpfile the script writes to, removed along with vcf_file after processing.
+        num_tps (int): Number of timepoints sampled.
+        timeout (float, optional): Seconds to let SLiM run before it's killed. Defaults to no limit.
+        recap_args (dict, optional): Keyword args of tree_utils.recapitate_replicate() besides outfile and num_tps,
+            for scripts made with tree_seq. The tree sequence is removed after processing. Defaults to merging vcf_file.
+
+    Returns:
+        tuple[str, str]: Script path and the error it failed with, or None.
+    """
+    tmp_files = [vcf_file, dumpfile]
+    if recap_args:
+        tmp_files.append(recap_args["trees_file"])
+
     try:
-        subprocess.check_output(cmd.split())
+        run_slim(slimfile, slim_path, timeout)
+        if recap_args:
+            merged_vcf = os.path.join(pv.make_vcf_dir(vcf_file), "merged.vcf")
+            tree_utils.recapitate_replicate(
+                outfile=merged_vcf, num_tps=num_tps, **recap_args
+            )
+        else:
+            pv.merge_replicate(vcf_file, num_tps)
+        error = None
+
+    except subprocess.TimeoutExpired:
+        error = f"SLiM timed out after {timeout}s"
     except subprocess.CalledProcessError as e:
-        logger.error(e.output)
+        stderr = e.stderr.decode(errors="replace").strip().splitlines()
+        error = f"SLiM exited with {e.returncode}: {stderr[-1] if stderr else ''}"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
 
-    sys.stdout.flush()
-    sys.stderr.flush()
+    finally:
+        for ifile in tmp_files:
+            if os.path.exists(ifile):
+                os.remove(ifile)
 
+    return slimfile, error
 
-def process_vcfs(input_vcf, num_tps):
-    try:
-        # Split into multiples after SLiM just concats to same file
-        raw_lines = sc.read_multivcf(input_vcf)
-        split_lines = sc.split_multivcf(raw_lines, "##fileformat=VCFv4.2")
-        if len(split_lines) > 0:
-            split_lines = split_lines[len(split_lines) - num_tps :]
 
-            # Creates subdir for each rep
-            vcf_dir = sc.make_vcf_dir(input_vcf)
-            sc.write_vcfs(split_lines, vcf_dir)
+def get_burn_in_gen(slim_file):
+    """Generation shared burn-ins are saved at, the one right before the burn-in of a stdpopsim script ends."""
+    Q, _, _, burn_in_gens, _ = get_slim_info(sanitize_slim(get_slim_code(slim_file)))
+    return int(round(burn_in_gens / Q)) - 1
+
+
+def add_burn_in_save(finished_lines, burn_in_gen, burn_in_file):
+    """Ends a script after its burn-in, saving the population so replicates can start from it."""
+    return finished_lines + [
+        f"\n{burn_in_gen} late() {{",
+        f'    sim.outputFull("{burn_in_file}", binary=T);',
+        "    sim.simulationFinished();",
+        "}",
+    ]
+
 
-            # Now index and merge
-            [sc.index_vcf(vcf) for vcf in glob(f"{vcf_dir}/*.vcf")]
-            sc.merge_vcfs(vcf_dir)
+def add_burn_in_load(finished_lines, burn_in_file):
+    """
+    Starts a script from a saved burn-in instead of simulating it.
+    Reading the population file sets the generation, so everything before the end of the burn-in is skipped.
+    The run is reseeded after loading so replicates sharing a burn-in diverge right away.
+    """
+    return finished_lines + [
+        "\n1 late() {",
+        f'    sim.readFromPopulationFile("{burn_in_file}");',
+        "    setSeed(rdunif(1, 0, asInteger(2^32) - 1));",
+        "}",
+    ]
 
-            sc.cleanup_intermed(vcf_dir)
+
+def burn_in_task(task, slim_path, timeout=None):
+    """Runs a burn-in script and moves its population file into place once it's complete."""
+    script, burn_in_file = task
+    try:
+        run_slim(script, slim_path, timeout)
+        os.replace(f"{burn_in_file}.tmp", burn_in_file)
+        return burn_in_file, None
 
     except Exception as e:
-        print(f"[ERROR] Couldn't process {e}")
-        pass
+        return burn_in_file, f"{type(e).__name__}: {e}"
+
+
+def make_burn_ins(
+    n_burn_ins,
+    burn_in_dir,
+    slim_file,
+    pop,
+    sample_sizes,
+    years_sampled,
+    sel_gen,
+    sel_coeff_bounds,
+    mut_rate,
+    slim_path,
+    threads,
+    timeout=None,
+):
+    """
+    Simulates a pool of independent neutral burn-ins for replicates to start from, see add_burn_in_load().
+    Population files already in burn_in_dir are reused, so runs over separate --rep-range's share them.
+
+    Args:
+        n_burn_ins (int): Number of burn-ins to keep.
+        burn_in_dir (str): Directory to save population files to.
+        slim_file (str): stdpopsim SLiM script.
+        pop (str): Population sampled.
+        sample_sizes (list[int]): Individuals sampled at each timepoint.
+        years_sampled (list[int]): Years before present sampled.
+        sel_gen (int): Generations before sampling selection starts.
+        sel_coeff_bounds (list[float]): Selection coefficient bounds.
+        mut_rate (float): Mutation rate.
+        slim_path (str): SLiM executable.
+        threads (int): Number of burn-ins to run at once.
+        timeout (float, optional): Seconds to let each SLiM run go before it's killed. Defaults to no limit.
+
+    Returns:
+        list[str]: Population files of all finished burn-ins.
+    """
+    os.makedirs(burn_in_dir, exist_ok=True)
+    burn_in_gen = get_burn_in_gen(slim_file)
+    burn_ins = [os.path.join(burn_in_dir, f"{i}.bin") for i in range(n_burn_ins)]
+
+    burn_in_tasks = []
+    for i, burn_in_file in enumerate(burn_ins):
+        if os.path.exists(burn_in_file):
+            continue
+
+        finished_lines, _ = make_slim_lines(
+            slim_file,
+            "neut",
+            f"burn_in_{i}",
+            pop,
+            sample_sizes,
+            years_sampled,
+            sel_gen,
+            sel_coeff_bounds,
+            mut_rate,
+            os.path.join(burn_in_dir, f"{i}.multivcf"),
+            os.path.join(burn_in_dir, f"{i}.dump"),
+        )
+        finished_lines = add_burn_in_save(
+            finished_lines, burn_in_gen, f"{burn_in_file}.tmp"
+        )
+        script = write_slim(finished_lines, slim_file, f"burn_in_{i}", burn_in_dir)
+        burn_in_tasks.append((script, burn_in_file))
+
+    logger.info(
+        f"Simulating {len(burn_in_tasks)} burn-ins to generation {burn_in_gen}, reusing {n_burn_ins - len(burn_in_tasks)}"
+    )
+    if burn_in_tasks:
+        with mp.Pool(min(threads, len(burn_in_tasks))) as pool:
+            work_res = pool.imap_unordered(
+                partial(burn_in_task, slim_path=slim_path, timeout=timeout),
+                burn_in_tasks,
+                chunksize=1,
+            )
+            for burn_in_file, error in work_res:
+                if error:
+                    logger.warning(f"Burn-in {burn_in_file} failed: {error}")
+
+    burn_ins = [i for i in burn_ins if os.path.exists(i)]
+    if not burn_ins:
+        raise RuntimeError(f"None of the burn-ins in {burn_in_dir} finished.")
+
+    return burn_ins
+
+
+def sim_task(task, slim_path, num_tps, timeout=None):
+    """Unpacks a (script, multivcf, dumpfile, recap_args) task for simulate_replicate() so it can be used with imap_unordered."""
+    slimfile, vcf_file, dumpfile, recap_args = task
+    return simulate_replicate(
+        slimfile,
+        slim_path,
+        vcf_file,
+        dumpfile,
+        num_tps,
+        timeout=timeout,
+        recap_args=recap_args,
+    )
+
+
+def make_slim_lines(
+    slim_file,
+    sweep,
+    rep,
+    pop,
+    sample_sizes,
+    years_sampled,
+    sel_gen,
+    sel_coeff_bounds,
+    mut_rate,
+    vcf_file,
+    dumpfile,
+    verbose=False,
+    trees_file=None,
+):
+    """
+    Injects sampling, selection, and randomized parameters for a single replicate into a stdpopsim SLiM script.
+    With a trees_file the script skips the burn-in and writes a tree sequence to be recapitated instead of vcf_file.
+
+    Returns:
+        list[str]: Lines of the replicate's script.
+        tuple: Parameters of the replicate, one row of the params file written by main().
+    """
+    tree_seq = trees_file is not None
+
+    # Info scraping and calculations
+    raw_lines = get_slim_code(slim_file)
+    raw_lines = sanitize_slim(raw_lines, tree_seq)
+
+    Q, gen_time, max_years_b0, burn_in_gens, physLen = get_slim_info(raw_lines)
+
+    # Pull from variable time of selection before sampling to make more robust
+    rand_sel_gen = randomize_selTime(sel_gen, 200 / Q)
+
+    burn_in_gens = int(round(burn_in_gens / Q))
+
+    # Convert from earliest year from bp to gens
+    end_gen = int(round((max_years_b0) / gen_time / Q))
+
+    # Written out each step for clarity, sdn to keep track of otherwise
+    # Find the earliest time before present, convert to useable times
+    furthest_from_pres = max(years_sampled)
+    abs_year_beg = max_years_b0 - furthest_from_pres
+
+    sel_gen_time = (
+        int(((abs_year_beg / gen_time) - rand_sel_gen) / Q)
+    ) + burn_in_gens
+    if tree_seq and sel_gen_time < 1:
+        # Without a burn-in there's nothing to simulate before the first tick
+        logger.warning(
+            f"Selection would start {1 - sel_gen_time} ticks before the recorded tree sequence, starting it at tick 1."
+        )
+        sel_gen_time = 1
+
+    if sel_coeff_bounds[0] == sel_coeff_bounds[1]:
+        sel_coeff = sel_coeff_bounds[0] * Q
+    else:
+        sel_coeff = randomize_selCoeff_uni(*sel_coeff_bounds) * Q
+
+    recombRate = randomize_recombRate()
+
+    # Logger vars
+    if verbose:
+        logger.info("Timesweeper SLiM Injection")
+        logger.info(f"Q Scaling Value: {Q}")
+        logger.info(f"Gen Time: {gen_time}")
+        logger.info(f"Simulated Chrom Length: {physLen}")
+        logger.info(f"Burn in years: {burn_in_gens * gen_time}")
+        logger.info(f"Burn in gens: {burn_in_gens}")
+        logger.info(f"Number Years Simulated (post-burn): {max_years_b0}")
+        logger.info(f"Number Gens Simulated (post-burn): {end_gen}")
+        logger.info(
+            f"Number Years Simulated (inc. burn): {max_years_b0 + (burn_in_gens * gen_time)}"
+        )
+        logger.info(
+            f"Number gens simulated (inc. burn): {end_gen + burn_in_gens}"
+        )
+        logger.info(f"Selection type: {sweep}")
+        logger.info(f"Selection coeff: {sel_coeff}")
+        logger.info(f"Recomb Rate: {recombRate}")
+        logger.info(f"Selection start gen: {sel_gen_time}")
+        logger.info(f"Number of timepoints: {len(years_sampled)}")
+        logger.info(
+            f"""Sample sizes (individuals): 
+            {" ".join([str(i) for i in sample_sizes])}"""
+        )
+        logger.info(
+            f"Years before present (1950) sampled: {' '.join([str(i) for i in years_sampled])}"
+        )
+        logger.info(
+            f"Gens before present (1950) sampled: {' '.join([str(int(i / gen_time / Q)) for i in years_sampled])}",
+        )
+
+    params = (
+        sweep,
+        rep,
+        Q,
+        gen_time,
+        physLen,
+        burn_in_gens,
+        max_years_b0 + (burn_in_gens * gen_time),
+        sel_coeff,
+        sel_gen_time,
+        years_sampled,
+        sample_sizes,
+        recombRate,
+    )
+
+    # Injection
+    prepped_lines = inject_constants(
+        raw_lines,
+        sweep,
+        recombRate,
+        sel_coeff,
+        sel_gen_time,
+        end_gen + burn_in_gens,
+        mut_rate,
+        dumpfile,
+        trees_file,
+    )
+
+    sampling_lines = inject_sampling(
+        prepped_lines,
+        pop,
+        sample_sizes,
+        years_sampled,
+        vcf_file,
+        tree_seq,
+    )
+
+    selection_lines = make_sel_blocks(sweep, sel_gen_time, pop, dumpfile, tree_seq)
+    finished_lines = []
+    finished_lines.extend(sampling_lines)
+    finished_lines.extend(selection_lines)
+
+    return finished_lines, params
 
 
 def clean_args(ua):
@@ -419,9 +766,35 @@ def main(ua):
         for sweep in sweeps:
             os.makedirs(f"{i}/{sweep}", exist_ok=True)
 
+    burn_ins = []
+    if ua.burn_ins:
+        burn_ins = make_burn_ins(
+            ua.burn_ins,
+            f"{work_dir}/burn_ins/{os.path.basename(slim_file).split('.')[0]}",
+            slim_file,
+            pop,
+            sample_sizes,
+            years_sampled,
+            sel_gen,
+            sel_coeff_bounds,
+            mut_rate,
+            slim_path,
+            threads,
+            ua.timeout,
+        )
+        burn_in_gen = get_burn_in_gen(slim_file)
+    rng = np.random.default_rng()
+
+    # ssv needs standing variation from a forward-simulated burn-in, so only neut and sdn are recapitated
+    recap_sweeps = []
+    if ua.recapitate:
+        tree_utils.check_tree_seq_libs()
+        recap_sweeps = ["neut", "sdn"]
+        ancestral_size = get_ancestral_size(get_slim_code(slim_file))
+
     # Inject info into SLiM script and then simulate, store params for reproducibility
     sim_params = []
-    script_list = []
+    sim_tasks = []
 
     if rep_range:  # Take priority
         replist = range(int(rep_range[0]), int(rep_range[1]))
@@ -431,129 +804,93 @@ def main(ua):
     for rep in replist:
         for sweep in sweeps:
 
-            # Info scraping and calculations
-            raw_lines = get_slim_code(slim_file)
-            raw_lines = sanitize_slim(raw_lines)
-
-            Q, gen_time, max_years_b0, burn_in_gens, physLen = get_slim_info(raw_lines)
-
-            # Pull from variable time of selection before sampling to make more robust
-            rand_sel_gen = randomize_selTime(sel_gen, 200 / Q)
-
-            burn_in_gens = int(round(burn_in_gens / Q))
-
-            # Convert from earliest year from bp to gens
-            end_gen = int(round((max_years_b0) / gen_time / Q))
-
-            # Written out each step for clarity, sdn to keep track of otherwise
-            # Find the earliest time before present, convert to useable times
-            furthest_from_pres = max(years_sampled)
-            abs_year_beg = max_years_b0 - furthest_from_pres
-
-            sel_gen_time = (
-                int(((abs_year_beg / gen_time) - rand_sel_gen) / Q)
-            ) + burn_in_gens
-
-            if sel_coeff_bounds[0] == sel_coeff_bounds[1]:
-                sel_coeff = sel_coeff_bounds[0] * Q
-            else:
-                sel_coeff = randomize_selCoeff_uni(*sel_coeff_bounds) * Q
-
-            recombRate = randomize_recombRate()
-
-            # Logger vars
-            if verbose:
-                logger.info("Timesweeper SLiM Injection")
-                logger.info(f"Q Scaling Value: {Q}")
-                logger.info(f"Gen Time: {gen_time}")
-                logger.info(f"Simulated Chrom Length: {physLen}")
-                logger.info(f"Burn in years: {burn_in_gens * gen_time}")
-                logger.info(f"Burn in gens: {burn_in_gens}")
-                logger.info(f"Number Years Simulated (post-burn): {max_years_b0}")
-                logger.info(f"Number Gens Simulated (post-burn): {end_gen}")
-                logger.info(
-                    f"Number Years Simulated (inc. burn): {max_years_b0 + (burn_in_gens * gen_time)}"
-                )
-                logger.info(
-                    f"Number gens simulated (inc. burn): {end_gen + burn_in_gens}"
-                )
-                logger.info(f"Selection type: {sweep}")
-                logger.info(f"Selection coeff: {sel_coeff}")
-                logger.info(f"Recomb Rate: {recombRate}")
-                logger.info(f"Selection start gen: {sel_gen_time}")
-                logger.info(f"Number of timepoints: {len(years_sampled)}")
-                logger.info(
-                    f"""Sample sizes (individuals): 
-                    {" ".join([str(i) for i in sample_sizes])}"""
-                )
-                logger.info(
-                    f"Years before present (1950) sampled: {' '.join([str(i) for i in years_sampled])}"
-                )
-                logger.info(
-                    f"Gens before present (1950) sampled: {' '.join([str(int(i / gen_time / Q)) for i in years_sampled])}",
-                )
-
-            sim_params.append(
-                (
-                    sweep,
-                    rep,
-                    Q,
-                    gen_time,
-                    physLen,
-                    burn_in_gens,
-                    max_years_b0 + (burn_in_gens * gen_time),
-                    sel_coeff,
-                    sel_gen_time,
-                    years_sampled,
-                    sample_sizes,
-                )
-            )
-
+            recap = sweep in recap_sweeps
             dumpfile = f"{dumpfile_dir}/{sweep}/{rep}.dump"
+            trees_file = None
+            if recap:
+                dumpfile += ".trees"
+                trees_file = f"{vcf_dir}/{sweep}/{rep}.trees"
 
-            # Injection
-            prepped_lines = inject_constants(
-                raw_lines,
+            finished_lines, params = make_slim_lines(
+                slim_file,
                 sweep,
-                recombRate,
-                sel_coeff,
-                sel_gen_time,
-                end_gen + burn_in_gens,
-                mut_rate,
-                dumpfile,
-            )
-
-            sampling_lines = inject_sampling(
-                prepped_lines,
+                rep,
                 pop,
                 sample_sizes,
                 years_sampled,
+                sel_gen,
+                sel_coeff_bounds,
+                mut_rate,
                 f"{vcf_dir}/{sweep}/{rep}.multivcf",
+                dumpfile,
+                verbose,
+                trees_file,
             )
 
-            selection_lines = make_sel_blocks(sweep, sel_gen_time, pop, dumpfile)
-            finished_lines = []
-            finished_lines.extend(sampling_lines)
-            finished_lines.extend(selection_lines)
+            # Replicates that would restart from before the end of the burn-in simulate their own
+            burn_in_file = None
+            if (
+                not recap
+                and burn_ins
+                and get_restart_gen(sweep, params[8]) > burn_in_gen
+            ):
+                burn_in_file = str(rng.choice(burn_ins))
+                finished_lines = add_burn_in_load(finished_lines, burn_in_file)
+            sim_params.append(params + (burn_in_file, recap))
+
+            # SLiM ticks are Q generations of a population Q times smaller, same scaling as the script
+            recap_args = None
+            if recap:
+                Q = params[2]
+                recap_args = {
+                    "trees_file": trees_file,
+                    "ancestral_Ne": max(1, round(ancestral_size / Q)),
+                    "recomb_rate": tree_utils.scale_recomb_rate(params[11], Q),
+                    "mut_rate": Q * mut_rate,
+                    "chrom_len": params[4],
+                }
 
             script_path = write_slim(
                 finished_lines, slim_file, rep, f"{script_dir}/{sweep}"
             )
-            script_list.append(script_path)
+            sim_tasks.append(
+                (
+                    script_path,
+                    f"{vcf_dir}/{sweep}/{rep}.multivcf",
+                    dumpfile,
+                    recap_args,
+                )
+            )
 
     print(f"Reps simulated: {replist}")
 
-    for script in script_list:
-        run_slim(script, slim_path)
-
-    # Process VCFs and Cleanup
-    for rep in replist:
-        for sweep in sweeps:
-            vcf_file = f"{vcf_dir}/{sweep}/{rep}.multivcf"
-            process_vcfs(vcf_file, len(sample_sizes))
-            os.remove(vcf_file)
-            dumpFile = f"{dumpfile_dir}/{sweep}/{rep}.dump"
-            os.remove(dumpFile)
+    # Each replicate is merged by the same task that simulated it, so processing overlaps with other simulations
+    failures = []
+    with mp.Pool(threads) as pool:
+        work_res = pool.imap_unordered(
+            partial(
+                sim_task,
+                slim_path=slim_path,
+                num_tps=len(sample_sizes),
+                timeout=ua.timeout,
+            ),
+            sim_tasks,
+            chunksize=1,
+        )
+        for script, error in tqdm(
+            work_res, desc="Simulating", total=len(sim_tasks), unit="rep"
+        ):
+            if error:
+                failures.append((script, error))
+                if verbose:
+                    logger.warning(f"{script} failed: {error}")
+
+    fail_list = f"{work_dir}/sim_failures.tsv"
+    pv.write_fail_list(fail_list, failures)
+    if failures:
+        logger.warning(
+            f"{len(failures)} of {len(sim_tasks)} simulations failed, see {fail_list}"
+        )
 
     # Save params
     if not os.path.exists(f"{work_dir}/params"):
@@ -572,10 +909,15 @@ def main(ua):
             "sel_gen",
             "years_bp_sampled",
             "samp_sizes",
+            "recomb_rate",
+            "burn_in",
+            "recapitated",
         ],
     )
     params_df.to_csv(
-        f"{work_dir}/params/sim_{'_'.join(rep_range)}_params.tsv", sep="\t", index=False
+        f"{work_dir}/params/sim_{replist.start}_{replist.stop}_params.tsv",
+        sep="\t",
+        index=False,
     )
 
     logger.info(f"Simulations finished, parameters saved to {work_dir}/sim_params.csv.")
@@ -4,8 +4,18 @@ from timesweeper.utils.gen_utils import (
     get_rep_id,
     add_file_label,
     read_config,
+    iter_in_thread,
+    consume_in_thread,
+    drain_in_thread,
+    make_shared_pool,
+)
+from timesweeper.make_training_features import get_window_idxs
+from timesweeper.find_sweeps_vcf import (
+    make_shards,
+    iter_window_batches,
+    iter_hft_batches,
+    split_regions,
 )
-from timesweeper.find_sweeps_vcf import get_window_idxs
 import pytest
 
 scenarios = ["sdn", "ssv" "neutral"]
@@ -30,3 +40,81 @@ def test_get_window_idxs():
 
 def test_add_file_label():
     assert add_file_label("foo/bar.baz", "buzz") == "foo/bar_buzz.baz"
+
+
+def test_make_shards():
+    assert make_shards({"1": 25, "2": None}, 10) == [
+        ("1", 1, 10),
+        ("1", 11, 20),
+        ("1", 21, 25),
+        ("2", None, None),
+    ]
+
+
+def test_split_regions():
+    assert split_regions([("1", 5, 24), ("2", 3, 3)], 10) == [
+        ("1", 5, 14),
+        ("1", 15, 24),
+        ("2", 3, 3),
+    ]
+
+
+def test_iter_window_batches():
+    ts_aft = np.arange(3 * 12).reshape(3, 12)
+    windows = np.concatenate(list(iter_window_batches(ts_aft, 5, batch_size=3)))
+    expected = np.stack([ts_aft[:, get_window_idxs(c, 5)] for c in range(2, 10)])
+    assert np.array_equal(windows, expected)
+
+
+def test_iter_in_thread():
+    assert list(iter_in_thread(iter(range(10)), maxsize=2)) == list(range(10))
+
+    def fail():
+        yield 1
+        raise ValueError("bad chunk")
+
+    with pytest.raises(ValueError):
+        list(iter_in_thread(fail()))
+
+
+def test_consume_in_thread():
+    seen = []
+    consume_in_thread(seen.append, range(10), maxsize=2)
+    assert seen == list(range(10))
+
+
+def test_drain_in_thread():
+    def batch_sums(items):
+        sums, batch = [], []
+        for item in items:
+            batch.append(item)
+            if len(batch) == 3:
+                sums.append(sum(batch))
+                batch = []
+        return sums + [sum(batch)]
+
+    assert drain_in_thread(batch_sums, range(10), maxsize=2) == [3, 12, 21, 9]
+
+    def fail(items):
+        next(items)
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        drain_in_thread(fail, range(100), maxsize=1)
+
+
+def test_iter_hft_batches_pool(monkeypatch):
+    # Several ranges per batch, so range seams are covered
+    monkeypatch.setattr("timesweeper.find_sweeps_vcf.HFT_RANGE_SIZE", 3)
+    rng = np.random.default_rng(0)
+    haps = rng.integers(0, 2, size=(40, 12), dtype=np.int8)
+    serial = list(iter_hft_batches(haps, 2, [2, 2, 2], 5, batch_size=7))
+
+    pool = make_shared_pool(2)
+    try:
+        pooled = list(iter_hft_batches(haps, 2, [2, 2, 2], 5, batch_size=7, pool=pool))
+    finally:
+        pool.terminate()
+
+    assert [b.shape for b in pooled] == [b.shape for b in serial]
+    assert all(np.array_equal(p, s) for p, s in zip(pooled, serial))
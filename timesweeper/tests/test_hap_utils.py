@@ -0,0 +1,63 @@
+from timesweeper.utils import hap_utils as hu
+import numpy as np
+import pytest
+
+# fmt: off
+haps = np.array([[0, 0, 0, 0],
+                 [1, 1, 0, 0],
+                 [1, 1, 1, 1],
+                 [1, -1, 0, 0],
+                 [1, 1, 1, 1],
+                 [1, 1, 1, 1]])
+# fmt: on
+
+
+def test_hamming_dists():
+    packed = hu.pack_haps(haps)
+    assert np.array_equal(hu.hamming_dists(packed, packed[2]), [4, 2, 0, 3, 0, 0])
+
+
+def test_hamming_dists_multiword():
+    long_haps = np.zeros((2, 130), dtype=int)
+    long_haps[1, [0, 64, 129]] = 2
+    packed = hu.pack_haps(long_haps)
+    assert np.array_equal(hu.hamming_dists(packed, packed[0]), [0, 3])
+
+
+def test_get_ts_hap_freqs():
+    # [1111] sweeps to fixation so is column 0, then [1100], [1n00], [0000] by distance to it
+    hft = hu.get_ts_hap_freqs(haps, [2, 2, 2])
+    assert np.allclose(
+        hft,
+        [
+            [0, 0.5, 0, 0.5, 0, 0],
+            [0.5, 0, 0.5, 0, 0, 0],
+            [1, 0, 0, 0, 0, 0],
+        ],
+    )
+    assert np.array_equal(hu.getTSHapFreqs(hu.haps_to_strlist(haps), [2, 2, 2]), hft)
+
+
+def test_iter_rolling_hfts():
+    rng = np.random.default_rng(0)
+    long_haps = rng.integers(-1, 2, size=(70, 30))
+    hfts = list(hu.iter_rolling_hfts(long_haps, [10, 10, 10], 65))
+    assert len(hfts) == 6
+    for start, hft in enumerate(hfts):
+        window = np.swapaxes(long_haps[start : start + 65], 0, 1)
+        assert np.array_equal(hft, hu.get_ts_hap_freqs(window, [10, 10, 10]))
+
+
+@pytest.mark.parametrize("n_classes", [2, 6, 8])
+def test_hft_classes(n_classes):
+    full = hu.get_ts_hap_freqs(haps, [2, 2, 2])
+    hft = hu.get_ts_hap_freqs(haps, [2, 2, 2], n_classes)
+    assert hft.shape == (3, n_classes)
+    assert np.array_equal(hft, hu.resize_hft(full, n_classes))
+
+
+def test_get_n_hft_classes():
+    assert hu.get_n_hft_classes({}) is None
+    assert hu.get_n_hft_classes({"hft classes": 50}) == 50
+    with pytest.raises(ValueError):
+        hu.get_n_hft_classes({"hft classes": 0})
@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+from timesweeper import index_store as ist
+from timesweeper.utils import store_utils as stu
+
+TEST_VCF = os.path.join(os.path.dirname(__file__), "data", "merged.vcf")
+
+
+def test_build_store_replaces_only_stores(tmp_path):
+    store_dir = str(tmp_path / "store")
+    manifest = ist.build_store(TEST_VCF, store_dir, [4, 4], 2, True)
+    assert sum(c["n_variants"] for c in manifest["chunks"]) == 60
+
+    # Rebuilding over a store replaces it
+    ist.build_store(TEST_VCF, store_dir, [4, 4], 2, False)
+    assert stu.is_store(store_dir)
+
+    other = tmp_path / "results"
+    other.mkdir()
+    (other / "keep.txt").write_text("keep")
+    with pytest.raises(ValueError, match="isn't a genotype store"):
+        ist.build_store(TEST_VCF, str(other), [4, 4], 2, False)
+    assert (other / "keep.txt").read_text() == "keep"
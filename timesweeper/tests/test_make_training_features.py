@@ -1,6 +1,13 @@
-from timesweeper. import make_training_features as mtf
+import os
+import shutil
+from argparse import Namespace
+
+from timesweeper import make_training_features as mtf
+from timesweeper.utils import store_utils as stu
 import numpy as np
 
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
 
 def test_add_missingness_0():
     assert np.array_equal(mtf.add_missingness(np.ones((3, 4)), 0), np.ones((3, 4)))
@@ -20,3 +27,51 @@ def test_check_freq_increase_true():
 def test_check_freq_increase_false():
     test_afs = np.array([[0.1, 0.1, 0.1], [0.1, 0.1, 0.1]]).T
     assert mtf.check_freq_increase(test_afs, 0.25) == False
+
+
+def test_condense_subsample_inds_resumes(tmp_path):
+    for sweep in ["neut", "sdn"]:
+        rep_dir = tmp_path / "vcfs" / sweep / "0"
+        rep_dir.mkdir(parents=True)
+        shutil.copy(os.path.join(DATA_DIR, "merged.vcf"), rep_dir / "merged.vcf")
+
+    yaml_file = tmp_path / "config.yaml"
+    yaml_file.write_text(
+        f"""
+scenarios: ["neut", "sdn"]
+mut types: [2]
+work dir: {tmp_path}
+sample sizes: [4, 4]
+ploidy: 2
+win_size: 11
+"""
+    )
+    store_dir = str(tmp_path / "train")
+    ua = Namespace(
+        yaml_file=str(yaml_file),
+        threads=1,
+        outfile=store_dir,
+        overwrite=False,
+        subsample_inds=2,
+        subsample_tps=None,
+        og_tps=None,
+        missingness=0.0,
+        freq_inc_thr=0.0,
+        allow_shoulders=None,
+        paramsfile=None,
+        hft=False,
+        no_progress=True,
+        verbose=False,
+    )
+
+    mtf.main(ua)
+    manifest = stu.read_manifest(store_dir)
+    assert manifest["n_examples"] == 2
+    assert len(manifest["samples"]) == 4
+
+    # The subsample is reused, so the store is kept and nothing is condensed again
+    mtf.main(ua)
+    rerun = stu.read_manifest(store_dir)
+    assert rerun["n_examples"] == 2
+    assert rerun["shards"] == manifest["shards"]
+    assert rerun["samples"] == manifest["samples"]
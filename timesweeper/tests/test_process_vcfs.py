@@ -0,0 +1,131 @@
+import os
+import shutil
+
+import pytest
+
+from timesweeper import process_vcfs as pv
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+header = [
+    "##fileformat=VCFv4.2",
+    "##contig=<ID=1,length=1000>",
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ti0\ti1",
+]
+
+
+def make_vcf(records):
+    return header + [
+        "\t".join(["1", pos, ".", "A", "T", "1000", "PASS", info, "GT", genos])
+        for pos, info, genos in records
+    ]
+
+
+def test_process_vcfs(tmp_path):
+    vcfs = [
+        # Left over from a restart, dropped
+        make_vcf([("5", "MID=9;S=0.0;MT=1", "1|1\t1|1")]),
+        make_vcf([("20", "MID=2;S=0.1;MT=2", "0|1\t0|0")]),
+        make_vcf(
+            [
+                ("30", "MID=3;S=0.0;MT=1", "1|0\t0|0"),
+                ("20", "MID=2;S=0.1;MT=2", "1|1\t0|1"),
+            ]
+        ),
+    ]
+    multivcf = tmp_path / "0.multivcf"
+    multivcf.write_text("\n".join(line for vcf in vcfs for line in vcf))
+
+    pv.process_vcfs(str(multivcf), 2)
+
+    lines = (tmp_path / "0" / "merged.vcf").read_text().splitlines()
+    assert lines[:3] == [header[0], pv.PASS_FILTER, header[1]]
+    assert lines[3].split("\t")[9:] == ["i0", "i1", "2:i0", "2:i1"]
+    assert [line.split("\t")[1] for line in lines[4:]] == ["20", "30"]
+    assert lines[4].split("\t")[7:] == [
+        "MID=2;MT=2,2;S=0.1,0.1",
+        "GT",
+        "0|1",
+        "0|0",
+        "1|1",
+        "0|1",
+    ]
+    assert lines[5].split("\t")[7:] == ["MID=3;MT=1;S=0.0", "GT", "0/0", "0/0", "1|0", "0|0"]
+
+
+def test_merge_replicate_fixture(tmp_path):
+    # Leftover restart, repeated mutation at a site, second ALT at the same position,
+    # a site missing from the middle timepoint, and MT/S joined across timepoints.
+    # slim_merged.vcf is the output of bcftools 1.24 on the same timepoints, see merge_multivcf()
+    multivcf = tmp_path / "slim.multivcf"
+    shutil.copy(os.path.join(DATA_DIR, "slim.multivcf"), multivcf)
+
+    merged_vcf = pv.merge_replicate(str(multivcf), 3)
+
+    assert merged_vcf == str(tmp_path / "slim" / "merged.vcf")
+    with open(os.path.join(DATA_DIR, "slim_merged.vcf")) as expected:
+        expected = [line for line in expected if not line.startswith("##bcftools_")]
+    with open(merged_vcf) as merged:
+        assert merged.readlines() == expected
+
+
+def test_merge_multivcf_info(tmp_path):
+    info_header = [
+        "##fileformat=VCFv4.2",
+        '##INFO=<ID=S,Number=.,Type=Float,Description="Selection Coefficient">',
+        '##INFO=<ID=DOM,Number=.,Type=Float,Description="Dominance">',
+        '##INFO=<ID=MT,Number=.,Type=Integer,Description="Mutation Type">',
+        '##INFO=<ID=AC,Number=.,Type=Integer,Description="Allele Count">',
+        '##INFO=<ID=AN,Number=1,Type=Integer,Description="Allele Number">',
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ti0\ti1",
+    ]
+
+    def record(pos, alt, qual, info, genos):
+        return "\t".join(["1", pos, ".", "A", alt, qual, "PASS", info, "GT", genos])
+
+    vcfs = [
+        pv.parse_vcf_lines(info_header + records)
+        for records in [
+            [
+                record("10", "T", "1000", "MID=1;S=0.123456789;DOM=0.50;MT=1;AC=1", "0|1\t0|0"),
+                record("20", "T", "30", "MID=2;S=1e-5;MT=1", "0|1\t0|0"),
+                record("30", "T", "1000", "MID=3;S=12345678;MT=1", "0|1\t1|1"),
+            ],
+            [
+                record("10", "T", "1000", "MID=1;S=0.123456789;DOM=0.25;MT=1;AC=2", "1|1\t0|0"),
+                record("20", "T", "50", "MID=2;S=0.0001;MT=2;DP=5", "0|1\t0|0"),
+                record("30", "T", "1000", "MID=3;S=1234567;MT=1", ".|.\t1|1"),
+                # bcftools would fold this into 1:30 A>T,C, kept apart so MT/S stay per mutation
+                record("30", "C", "1000", "MID=4;S=0.1;MT=2", "0|0\t0|1"),
+            ],
+        ]
+    ]
+    merged_vcf = tmp_path / "merged.vcf"
+    pv.merge_multivcf(vcfs, str(merged_vcf))
+
+    # Same as bcftools merge -0 --force-samples --info-rules 'MT:join,S:join'
+    records = [line.split("\t")[4:8] for line in merged_vcf.read_text().splitlines()[8:]]
+    assert records == [
+        ["T", "1000", "PASS", "MID=1;DOM=0.5;MT=1,1;S=0.123457,0.123457;AN=8;AC=3"],
+        ["T", "50", "PASS", "MID=2;DP=5;MT=1,2;S=1e-05,0.0001;AN=8;AC=2"],
+        ["T", "1000", "PASS", "MID=3;MT=1,1;S=1.23457e+07,1.23457e+06;AN=6;AC=5"],
+        ["C", "1000", "PASS", "MID=4;MT=2;S=0.1;AN=8;AC=1"],
+    ]
+
+
+def test_process_worker(tmp_path):
+    multivcf = tmp_path / "0.multivcf"
+    multivcf.write_text("\n".join(make_vcf([("20", "MT=1", "0|1\t0|0")])))
+
+    input_vcf, _, error = pv.process_worker(str(multivcf), 2)
+    assert input_vcf == str(multivcf)
+    assert error == "ValueError: Found 1 VCFs, expected 2 timepoints"
+    assert pv.process_worker(str(multivcf), 1)[2] is None
+
+
+def test_process_vcfs_raises(tmp_path):
+    multivcf = tmp_path / "0.multivcf"
+    multivcf.write_text("\n".join(make_vcf([("20", "MT=1", "0|1\t0|0")])))
+
+    with pytest.raises(ValueError, match="Found 1 VCFs, expected 2 timepoints"):
+        pv.process_vcfs(str(multivcf), 2)
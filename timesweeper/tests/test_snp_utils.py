@@ -1,6 +1,9 @@
+import os
+
 from timesweeper.utils import snp_utils as su
 import numpy as np
 import allel
+import pytest
 
 # fmt: off
 g = allel.GenotypeArray([[[0, 0], [0, 1]],
@@ -29,3 +32,179 @@ def test_calc_maft():
     assert su.calc_maft(geno_list[0].count_alleles(2)[0], 1) == 0.0
     assert su.calc_maft(geno_list[0].count_alleles(2)[1], 1) == 0.5
     assert su.calc_maft(geno_list[0].count_alleles(2)[2], 2) == 0.5
+
+
+def test_stitch_vcf_chunks():
+    # Two chromosomes split unevenly across three chunks
+    chroms = np.array(["1"] * 25 + ["2"] * 15, dtype=object)
+    pos = np.arange(40)
+    chunks = [
+        {"variants/CHROM": chroms[i:j], "variants/POS": pos[i:j]}
+        for i, j in [(0, 12), (12, 30), (30, 40)]
+    ]
+    centers = []
+    for block in su.stitch_vcf_chunks(iter(chunks), 5):
+        assert len(set(block["variants/CHROM"])) == 1
+        centers.extend(block["variants/POS"][2 : len(block["variants/POS"]) - 2])
+
+    assert centers == list(range(2, 23)) + list(range(27, 38))
+
+
+def test_count_ts_alleles():
+    ts_counts = su.count_ts_alleles(g, [1, 1], max_allele=2)
+    assert ts_counts.shape == (3, 2, 3)
+    assert np.array_equal(ts_counts[:, 0], geno_list[0].count_alleles(2))
+    assert np.array_equal(ts_counts[:, 1], geno_list[1].count_alleles(2))
+
+
+def test_make_loc_arr():
+    vcf = {
+        "variants/CHROM": np.array(["1", "1", "2"], dtype=object),
+        "variants/POS": np.array([10, 20, 5]),
+        "variants/MT": np.array([[1, -1], [2, -1], [1, -1]]),
+        "variants/S": np.array([[0.0, np.nan], [0.05, np.nan], [0.0, np.nan]]),
+    }
+    locs = su.make_loc_arr(vcf, benchmark=True)
+    assert list(locs["chrom"]) == ["1", "1", "2"]
+    assert np.array_equal(locs["pos"], [10, 20, 5])
+    assert np.array_equal(locs["mt"], [1, 2, 1])
+    assert locs["s"][1] == 0.05
+    assert su.make_loc_arr(vcf, benchmark=False).dtype.names == ("chrom", "pos")
+
+
+def test_get_numbers():
+    assert su.get_numbers(su.get_fields(False), 20) == {}
+    assert su.get_numbers(su.get_fields(True), 20) == {
+        "variants/MT": 20,
+        "variants/S": 20,
+    }
+
+
+def test_get_reader_backend():
+    assert su.get_reader_backend("foo.vcf", "allel") == "allel"
+    with pytest.raises(ValueError):
+        su.get_reader_backend("foo.bcf", "allel")
+
+
+def test_merge_regions(tmp_path):
+    bed = tmp_path / "regions.bed"
+    bed.write_text("track name=foo\n2\t0\t10\n1\t99\t200\n1\t150\t300\n1\t400\t500\n")
+    regions = su.read_bed_regions(str(bed))
+    assert regions[0] == ("2", 1, 10)
+    assert su.merge_regions(regions) == [("2", 1, 10), ("1", 100, 300), ("1", 401, 500)]
+
+
+def test_filter_sites():
+    from collections import Counter
+
+    # 3 sites, 2 diploid individuals at each of 2 timepoints
+    gts = np.array(
+        [
+            [[0, 1], [0, 0], [0, 1], [1, 1]],  # passes
+            [[0, 1], [2, 2], [0, 0], [0, 0]],  # triallelic
+            [[0, 0], [-1, -1], [-1, -1], [0, 1]],  # half missing
+        ]
+    )
+    vcf = {"variants/POS": np.array([1, 2, 3]), "calldata/GT": gts}
+    filters = su.get_site_filters({"site filters": {"biallelic": True, "min maf": 0.2, "max missingness": 0.25}})
+    stats = Counter()
+    filtered = su.filter_sites(vcf, [2, 2], 2, filters, stats)
+    assert list(filtered["variants/POS"]) == [1]
+    assert stats == Counter({"biallelic": 1, "min maf": 0, "max missingness": 1})
+    assert filtered[su.TS_COUNTS_FIELD].shape == (1, 2, su.MAX_ALLELE + 1)
+
+
+def test_calc_ts_maft():
+    # (snps, timepoints, alleles), second SNP has no calls at the first timepoint
+    ts_counts = np.array([[[2, 2], [1, 3]], [[0, 0], [4, 0]]])
+    maft = su.calc_ts_maft(ts_counts, np.array([1, 0]))
+    assert np.array_equal(maft, np.array([[0.5, 0.0], [0.75, 1.0]]))
+
+
+TEST_VCF = os.path.join(os.path.dirname(__file__), "data", "merged.vcf")
+
+
+def index_test_vcf(tmp_path, keep_contig_lines=True):
+    """bgzips and tabix-indexes a copy of the bundled test VCF."""
+    pysam = pytest.importorskip("pysam")
+    vcf = tmp_path / "merged.vcf"
+    with open(TEST_VCF) as infile:
+        vcf.write_text(
+            "".join(l for l in infile if keep_contig_lines or not l.startswith("##contig"))
+        )
+    return pysam.tabix_index(str(vcf), preset="vcf", force=True)
+
+
+def test_get_contigs_without_lengths(tmp_path):
+    vcf_gz = index_test_vcf(tmp_path, keep_contig_lines=False)
+    last_pos = 100 + 150 * 59
+
+    # Bounded by the 16 kb linear index entry holding the last record
+    extents = su.get_tabix_extents(vcf_gz)
+    assert extents == {"1": 16384}
+    assert su.get_contigs(vcf_gz) == extents
+    assert su.get_contig_extent(vcf_gz, "1") == last_pos
+
+
+def test_read_region_with_flanks_caps_pad(tmp_path, monkeypatch):
+    vcf_gz = index_test_vcf(tmp_path)
+    reads = []
+    read_vcf_region = su.read_vcf_region
+    monkeypatch.setattr(
+        su, "read_vcf_region", lambda *args, **kw: reads.append(args[1]) or read_vcf_region(*args, **kw)
+    )
+
+    # No SNPs in the region, nothing to look for flanks for
+    assert su.read_region_with_flanks(vcf_gz, "1", 101, 200, 5, False, pad=10) is None
+    assert len(reads) == 1
+
+    # SNPs every 150 bp, the pad stops growing at max_pad and the edge flanks come up short
+    reads.clear()
+    vcf = su.read_region_with_flanks(vcf_gz, "1", 4000, 4200, 5, False, pad=10, max_pad=300)
+    assert reads[-1] == "1:3700-4500"
+    assert list(vcf["variants/POS"]) == [3700, 3850, 4000, 4150, 4300, 4450]
+
+    vcf = su.read_region_with_flanks(vcf_gz, "1", 4000, 4200, 2, False, pad=10)
+    assert list(vcf["variants/POS"]) == [3700, 3850, 4000, 4150, 4300, 4450]
+
+
+def assert_chunks_equal(chunk, expected):
+    assert sorted(chunk) == sorted(expected)
+    for field in expected:
+        assert chunk[field].dtype == expected[field].dtype, field
+        assert chunk[field].shape == expected[field].shape, field
+        if chunk[field].dtype.kind == "f":
+            assert np.array_equal(chunk[field], expected[field], equal_nan=True), field
+        else:
+            assert np.array_equal(chunk[field], expected[field]), field
+
+
+@pytest.mark.parametrize("backend", ["cyvcf2", "pysam"])
+def test_htslib_readers_match_allel(backend, tmp_path):
+    pytest.importorskip(backend)
+
+    assert su.read_vcf_samples(TEST_VCF, backend) == su.read_vcf_samples(TEST_VCF, "allel")
+    for benchmark in [False, True]:
+        assert_chunks_equal(
+            su.read_vcf(TEST_VCF, None, benchmark, backend),
+            su.read_vcf(TEST_VCF, None, benchmark, "allel"),
+        )
+    samples = ["i1", "2:i0", "2:i3"]
+    assert_chunks_equal(
+        su.read_vcf(TEST_VCF, samples, True, backend),
+        su.read_vcf(TEST_VCF, samples, True, "allel"),
+    )
+
+    # Chunk boundaries land in the same places too
+    chunks = list(su.get_vcf_iter(TEST_VCF, True, chunk_length=7, backend=backend))
+    expected = list(su.get_vcf_iter(TEST_VCF, True, chunk_length=7, backend="allel"))
+    assert len(chunks) == len(expected)
+    for (chunk, n, *_), (exp_chunk, exp_n, *_) in zip(chunks, expected):
+        assert_chunks_equal(chunk, exp_chunk)
+        assert n == exp_n
+
+    vcf_gz = index_test_vcf(tmp_path)
+    assert_chunks_equal(
+        su.read_vcf_region(vcf_gz, "1:1000-3000", True, backend=backend),
+        su.read_vcf_region(vcf_gz, "1:1000-3000", True, backend="allel"),
+    )
@@ -0,0 +1,116 @@
+import os
+
+from timesweeper.utils import store_utils as stu
+import numpy as np
+import pytest
+
+chunk = {
+    "variants/CHROM": np.array(["1", "1", "2", "2"], dtype=object),
+    "variants/POS": np.array([10, 20, 5, 15]),
+    "calldata/GT": np.zeros((4, 3, 2), dtype="i1"),
+}
+
+
+def test_store_roundtrip(tmp_path):
+    entry = stu.write_store_chunk(str(tmp_path), 0, chunk)
+    stu.write_manifest(str(tmp_path), {"fields": list(chunk), "chunks": [entry]})
+
+    assert stu.is_store(str(tmp_path))
+    assert entry["chroms"] == ["1", "2"]
+
+    loaded, n_variants, _, _ = next(stu.iter_store_chunks(str(tmp_path)))
+    assert n_variants == 4
+    assert np.array_equal(loaded["variants/POS"], chunk["variants/POS"])
+    assert loaded["calldata/GT"].shape == (4, 3, 2)
+
+
+def test_read_store_region(tmp_path):
+    entry = stu.write_store_chunk(str(tmp_path), 0, chunk)
+    stu.write_manifest(str(tmp_path), {"fields": list(chunk), "chunks": [entry]})
+
+    region = stu.read_store_region(str(tmp_path), "2", 1, 10)
+    assert list(region["variants/POS"]) == [5]
+    assert stu.read_store_region(str(tmp_path), "3") is None
+
+
+def make_replicates(tmp_path, n):
+    paths = []
+    for i in range(n):
+        path = tmp_path / f"{i}.vcf"
+        path.write_text(str(i))
+        paths.append(str(path))
+
+    return paths
+
+
+def condensed(i, n_windows=1):
+    return [
+        (str(i), ["neut", "sdn"][i % 2], {"aft": np.full((3, 5), i)}, 0.1 * i, w, "center" if w == 0 else "shoulder")
+        for w in range(n_windows)
+    ]
+
+
+def test_training_store(tmp_path):
+    paths = make_replicates(tmp_path, 6)
+    results = [condensed(i) for i in range(5)]
+    results.insert(2, None)  # Failed replicates are skipped
+    store_dir = str(tmp_path / "train")
+    manifest = stu.write_training_store(
+        store_dir, zip(paths, results), ["aft"], shard_size=2
+    )
+
+    assert stu.is_training_store(store_dir)
+    assert [s["n_examples"] for s in manifest["shards"]] == [2, 2, 1]
+
+    sdn = stu.read_training_data(store_dir, "aft", ["sdn"])
+    assert list(sdn["rep"]) == ["1", "3"]
+    assert sdn["data"].shape == (2, 3, 5)
+    assert np.array_equal(sdn["data"][:, 0, 0], [1, 3])
+    assert np.allclose(sdn["sel_coeff"], [0.1, 0.3])
+
+
+def test_resume_training_store(tmp_path):
+    paths = make_replicates(tmp_path, 4)
+    store_dir = str(tmp_path / "train")
+    config = {"win_size": 51}
+
+    manifest = stu.open_training_store(store_dir, ["aft"], config)
+    stu.append_training_store(
+        store_dir, manifest, [(p, condensed(i)) for i, p in enumerate(paths[:3])]
+    )
+
+    # Reopened with the same config only the new and changed replicates are left
+    manifest = stu.open_training_store(store_dir, ["aft"], config)
+    (tmp_path / "0.vcf").write_text("changed")
+    todo = stu.get_pending_replicates(manifest, paths)
+    assert todo == [paths[0], paths[3]]
+
+    stu.append_training_store(
+        store_dir, manifest, [(paths[0], condensed(4, 2)), (paths[3], condensed(3))]
+    )
+    labels = stu.read_training_labels(store_dir)
+    assert sorted(labels["rep"]) == ["1", "2", "3", "4", "4"]
+    assert sorted(labels["window"]) == ["center"] * 4 + ["shoulder"]
+    assert stu.read_manifest(store_dir)["n_examples"] == 5
+
+    # Both windows of a replicate map back to it, for splitting by replicate
+    data = stu.read_training_data(store_dir, "aft")
+    assert set(data["replicate"][data["rep"] == "4"]) == {os.path.abspath(paths[0])}
+    assert len(set(data["replicate"])) == 4
+
+    # Another config is refused unless overwritten
+    with pytest.raises(ValueError, match="win_size"):
+        stu.open_training_store(store_dir, ["aft"], {"win_size": 11})
+    manifest = stu.open_training_store(store_dir, ["aft"], {"win_size": 11}, overwrite=True)
+    assert stu.get_pending_replicates(manifest, paths) == paths
+
+
+def test_open_training_store_keeps_other_dirs(tmp_path):
+    other = tmp_path / "results"
+    other.mkdir()
+    (other / "keep.txt").write_text("keep")
+
+    for overwrite in [False, True]:
+        with pytest.raises(ValueError, match="isn't a training store"):
+            stu.open_training_store(str(other), ["aft"], overwrite=overwrite)
+    assert (other / "keep.txt").read_text() == "keep"
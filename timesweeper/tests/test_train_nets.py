@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("sklearn")
+pytest.importorskip("tensorflow")
+
+from timesweeper import train_nets as tn
+
+
+def test_split_partitions():
+    # 3 classes with 20 replicates each, 3 windows per replicate
+    scenarios = ["neut", "sdn", "ssv"]
+    groups = np.array(
+        [f"{sweep}/{rep}" for sweep in scenarios for rep in range(20) for _ in range(3)]
+    )
+    labs = np.eye(3)[np.repeat(np.arange(3), 60)]
+    data = np.arange(len(groups)).reshape(-1, 1)
+    sel_coeffs = np.zeros((len(groups), 1))
+    reps = [g.split("/")[1] for g in groups]
+
+    partitions = tn.split_partitions(data, labs, sel_coeffs, reps, groups)
+    part_data, part_labs = partitions[:3], partitions[3:6]
+
+    assert sum(len(d) for d in part_data) == len(groups)
+    part_groups = [set(groups[d.ravel()]) for d in part_data]
+    for i in range(3):
+        for j in range(i + 1, 3):
+            assert not part_groups[i] & part_groups[j]
+    for d, l in zip(part_data, part_labs):
+        assert np.array_equal(l, labs[d.ravel()])
+        assert set(l.argmax(axis=1)) == {0, 1, 2}
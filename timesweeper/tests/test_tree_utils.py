@@ -0,0 +1,141 @@
+import sys
+
+import numpy as np
+import pytest
+
+from timesweeper.utils import tree_utils as tu
+
+
+def test_write_merged_vcf(tmp_path):
+    outfile = tmp_path / "merged.vcf"
+    # Two timepoints of one diploid each, sites out of order
+    positions = np.array([30, 20])
+    genos = np.array([[1, 0, 0, 1], [0, 2, 1, 1]], dtype=np.int8)
+
+    tu.write_merged_vcf(
+        str(outfile), positions, genos, [1, 1], [[1], [1, 2]], [[0.0], [0.0, 0.1]], 1000
+    )
+
+    lines = outfile.read_text().splitlines()
+    assert "##contig=<ID=1,length=1000>" in lines
+    header = lines[5].split("\t")
+    assert header[9:] == ["i0", "2:i0"]
+    assert lines[6].split("\t") == [
+        "1",
+        "20",
+        ".",
+        "A",
+        "T,C",
+        "1000",
+        "PASS",
+        "MT=1,2;S=0.0,0.1",
+        "GT",
+        "0/2",
+        "1/1",
+    ]
+    assert lines[7].split("\t")[1] == "30"
+    assert lines[7].split("\t")[9:] == ["1/0", "0/1"]
+
+
+def test_scale_recomb_rate():
+    assert np.isclose(tu.scale_recomb_rate(1e-8, 1), 1e-8)
+    assert np.isclose(tu.scale_recomb_rate(1e-8, 10), 1e-7, rtol=1e-6)
+
+
+def make_slim_trees(path):
+    """Two timepoints of 4 diploids remembered 10 ticks apart, roots left uncoalesced and a sweep mutation at 5000."""
+    msprime = pytest.importorskip("msprime")
+    pyslim = pytest.importorskip("pyslim")
+
+    ts = msprime.sim_ancestry(
+        samples=[msprime.SampleSet(4, time=0), msprime.SampleSet(4, time=10)],
+        population_size=100,
+        sequence_length=10000,
+        recombination_rate=1e-4,
+        end_time=30,
+        random_seed=1,
+    )
+    tables = pyslim.annotate(ts, model_type="WF", tick=1).dump_tables()
+    tables.individuals.flags = tables.individuals.flags | pyslim.INDIVIDUAL_REMEMBERED
+
+    site = tables.sites.add_row(position=5000, ancestral_state="")
+    sweep = {
+        "mutation_type": 2,
+        "selection_coeff": 0.1,
+        "subpopulation": 0,
+        "slim_time": 1,
+        "nucleotide": -1,
+    }
+    tables.mutations.add_row(
+        site=site,
+        node=0,
+        derived_state="0",
+        time=0,
+        metadata={"mutation_list": [sweep]},
+    )
+    tables.sort()
+    tables.tree_sequence().dump(path)
+    assert ts.max_root_time == 30  # Not coalesced, recapitation has to finish it
+
+
+def test_recapitate_replicate(tmp_path):
+    trees_file = str(tmp_path / "0.trees")
+    make_slim_trees(trees_file)
+    outfile = tmp_path / "merged.vcf"
+
+    tu.recapitate_replicate(trees_file, str(outfile), 2, 100, 1e-4, 1e-4, 10000, seed=3)
+
+    lines = outfile.read_text().splitlines()
+    samples = lines[5].split("\t")[9:]
+    assert samples == [f"i{i}" for i in range(4)] + [f"2:i{i}" for i in range(4)]
+
+    records = [line.split("\t") for line in lines[6:]]
+    positions = [int(r[1]) for r in records]
+    assert len(records) > 100
+    assert positions == sorted(positions)
+    assert all("|" not in gt for r in records for gt in r[9:])
+
+    sweep = [r for r in records if r[1] == "5001"][0]
+    info = dict(item.split("=") for item in sweep[7].split(";"))
+    assert "2" in info["MT"].split(",") and "0.1" in info["S"].split(",")
+    # Node 0 is the first chromosome of the most recent timepoint
+    alt_idx = info["MT"].split(",").index("2") + 1
+    assert sweep[9 + 4].split("/")[0] == str(alt_idx)
+
+    with pytest.raises(ValueError, match="expected 3 timepoints"):
+        tu.recapitate_replicate(trees_file, str(outfile), 3, 100, 1e-4, 1e-4, 10000)
+
+
+def test_simulate_replicate_recapitated(tmp_path):
+    from timesweeper import simulate_stdpopsim as ss
+
+    src = str(tmp_path / "src.trees")
+    make_slim_trees(src)
+
+    # Stands in for SLiM, writes the tree sequence the script would
+    trees_file = tmp_path / "vcfs" / "0.trees"
+    trees_file.parent.mkdir()
+    fake_slim = tmp_path / "fake_slim.py"
+    fake_slim.write_text(f"import shutil\nshutil.copy({src!r}, {str(trees_file)!r})\n")
+    slimfile = tmp_path / "0.slim"
+    slimfile.write_text("")
+
+    recap_args = {
+        "trees_file": str(trees_file),
+        "ancestral_Ne": 100,
+        "recomb_rate": 1e-4,
+        "mut_rate": 1e-4,
+        "chrom_len": 10000,
+    }
+    script, error = ss.simulate_replicate(
+        str(slimfile),
+        f"{sys.executable} {fake_slim}",
+        str(tmp_path / "vcfs" / "0.multivcf"),
+        str(tmp_path / "0.dump.trees"),
+        2,
+        recap_args=recap_args,
+    )
+
+    assert error is None
+    assert (tmp_path / "vcfs" / "0" / "merged.vcf").exists()
+    assert not trees_file.exists()
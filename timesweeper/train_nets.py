@@ -3,6 +3,7 @@ import os
 import pickle
 import random
 import sys
+from functools import partial
 
 import numpy as np
 import pandas as pd
@@ -20,6 +21,8 @@ from tensorflow.keras.models import save_model
 from timesweeper import models
 
 from timesweeper.plotting import plotting_utils as pu
+from timesweeper.utils import hap_utils as hu
+from timesweeper.utils import store_utils as stu
 from timesweeper.utils.gen_utils import read_config
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
@@ -42,18 +45,44 @@ def scale_sel_coeffs(sel_coef_arr):
     return scaler
 
 
-def get_data(input_pickle, data_type, scenarios):
+def get_data(input_pickle, data_type, scenarios, hft_classes=None):
     """
     Loads data from pickle file and returns as list of labels and data.
 
     Args:
-        input_pickle (str): Path to pickle created with make_training_features module.
+        input_pickle (str): Path to training data store or pickle created with make_training_features module.
         data_type (str): Determines either hfs or aft files to search for.
+        hft_classes (int, optional): Resize HFTs to this many columns, so data condensed without "hft classes" matches the config.
 
     Returns:
         list[str]: List of sweep labels for each sample
+        list[str]: Rep id of each sample.
         np.arr: Array with all data stacked.
+        list[str]: Scenarios.
+        np.arr: Selection coefficient of each sample.
+        np.arr: Replicate each sample was condensed from, samples of the same replicate share it.
     """
+    if stu.is_training_store(input_pickle):
+        transform = None
+        if data_type.lower() == "hft" and hft_classes is not None:
+            transform = partial(hu.resize_hft, n_classes=hft_classes)
+        store_data = stu.read_training_data(
+            input_pickle, data_type.lower(), scenarios, transform
+        )
+        win_types, win_counts = np.unique(store_data["window"], return_counts=True)
+        logger.info(
+            f"{len(store_data['rep'])} windows from {len(set(store_data['replicate']))} replicates: "
+            + ", ".join(f"{n} {w}" for w, n in zip(win_types, win_counts))
+        )
+        return (
+            store_data["scenario"].tolist(),
+            store_data["rep"].tolist(),
+            store_data["data"],
+            list(scenarios),
+            store_data["sel_coeff"].reshape(-1, 1),
+            store_data["replicate"],
+        )
+
     id_list = []
     rep_list = []
     data_list = []
@@ -64,7 +93,10 @@ def get_data(input_pickle, data_type, scenarios):
         sweep_types.append(sweep)
         for rep in pikl_dict[sweep].keys():
             try:
-                data_list.append(np.array(pikl_dict[sweep][rep][data_type.lower()]))
+                data = np.asarray(pikl_dict[sweep][rep][data_type.lower()])
+                if data_type.lower() == "hft" and hft_classes is not None:
+                    data = hu.resize_hft(data, hft_classes)
+                data_list.append(data)
             except:
                 continue
 
@@ -78,58 +110,69 @@ def get_data(input_pickle, data_type, scenarios):
         np.stack(data_list),
         sweep_types,
         np.array(sel_coeffs).reshape(-1, 1),
+        np.array([f"{sweep}/{rep}" for sweep, rep in zip(id_list, rep_list)]),
+    )
+
+
+def split_groups(groups, labels, test_size):
+    """
+    Randomly splits row indices in two, every group's rows landing on the same side.
+    Groups are stratified by their label so each class is represented on both sides.
+
+    Args:
+        groups (np.arr): Group of each row.
+        labels (np.arr): Class of each row, rows of the same group share it.
+        test_size (float): Fraction of groups to put in the second split.
+
+    Returns:
+        Tuple[np.arr, np.arr]: Row indices of each split.
+    """
+    uniq_groups, first_idxs = np.unique(groups, return_index=True)
+    train_groups, test_groups = train_test_split(
+        uniq_groups, test_size=test_size, stratify=labels[first_idxs]
+    )
+    return (
+        np.flatnonzero(np.isin(groups, train_groups)),
+        np.flatnonzero(np.isin(groups, test_groups)),
     )
 
 
-def split_partitions(data, labs, sel_coeffs, reps):
+def split_partitions(data, labs, sel_coeffs, reps, groups):
     """
         Splits all data and labels into partitions for train/val/testing.
+        Windows of the same replicate are correlated, so each replicate goes entirely into one partition.
+        Replicates are stratified by scenario so every class is in every partition.
 
     Args:
         data (np.arr): Data for training model.
         labs (List): List of numeric labels for IDs
         sel_coeffs (List[float]): List of selection coefficients for each rep
+        reps (List[str]): Rep id of each sample.
+        groups (np.arr): Replicate each sample was condensed from, see get_data().
 
     Returns:
         Tuple[List[narr], List[narr], List[narr], List[int], List[int], List[int]]: Train/val/test splits of IDs and labs
     """
-    (
-        train_data,
-        val_data,
-        train_labs,
-        val_labs,
-        train_s,
-        val_s,
-        train_reps,
-        val_reps,
-    ) = train_test_split(data, labs, sel_coeffs, reps, stratify=labs, test_size=0.3)
-    (
-        val_data,
-        test_data,
-        val_labs,
-        test_labs,
-        val_s,
-        test_s,
-        val_reps,
-        test_reps,
-    ) = train_test_split(
-        val_data, val_labs, val_s, val_reps, stratify=val_labs, test_size=0.5
+    groups = np.asarray(groups)
+    classes = np.asarray(labs)
+    if classes.ndim > 1:
+        classes = classes.argmax(axis=1)
+
+    train_idxs, holdout_idxs = split_groups(groups, classes, 0.3)
+    val_sub, test_sub = split_groups(
+        groups[holdout_idxs], classes[holdout_idxs], 0.5
     )
-    return (
-        train_data,
-        val_data,
-        test_data,
-        train_labs,
-        val_labs,
-        test_labs,
-        train_s,
-        val_s,
-        test_s,
-        train_reps,
-        val_reps,
-        test_reps,
+    val_idxs, test_idxs = holdout_idxs[val_sub], holdout_idxs[test_sub]
+
+    partitions = []
+    for arr in data, labs, sel_coeffs:
+        partitions.extend(arr[idxs] for idxs in (train_idxs, val_idxs, test_idxs))
+    partitions.extend(
+        [reps[i] for i in idxs] for idxs in (train_idxs, val_idxs, test_idxs)
     )
 
+    return tuple(partitions)
+
 
 def fit_class_model(
     out_dir,
@@ -469,8 +512,11 @@ def main(ua):
         # Collect all the data
         logger.info("Starting training process.")
 
-        ids, raw_reps, raw_ts_data, sweep_types, raw_sel_coeffs = get_data(
-            ua.training_data, data_type, yaml_data["scenarios"]
+        ids, raw_reps, raw_ts_data, sweep_types, raw_sel_coeffs, raw_groups = get_data(
+            ua.training_data,
+            data_type,
+            yaml_data["scenarios"],
+            hu.get_n_hft_classes(yaml_data),
         )
         lab_dict = {str_id: int_id for int_id, str_id in enumerate(sweep_types)}
 
@@ -483,11 +529,12 @@ def main(ua):
         if ua.subsample_amount:
             subsample_amount = ua.subsample_amount * len(set(ids))
             # Subsample to test for training size effects
-            ts_data, _, ohe_ids, _, sel_coeffs, _, reps, _ = train_test_split(
+            ts_data, _, ohe_ids, _, sel_coeffs, _, reps, _, groups, _ = train_test_split(
                 raw_ts_data,
                 raw_ohe_ids,
                 raw_sel_coeffs,
                 raw_reps,
+                raw_groups,
                 train_size=subsample_amount,
                 stratify=raw_ohe_ids,
             )
@@ -496,6 +543,7 @@ def main(ua):
             ohe_ids = raw_ohe_ids
             reps = raw_reps
             sel_coeffs = raw_sel_coeffs
+            groups = raw_groups
 
         logger.info(f"Data is subsampled to {len(ts_data)}")
 
@@ -533,7 +581,7 @@ def main(ua):
             _train_reps,
             _val_reps,
             test_reps,
-        ) = split_partitions(ts_data, ohe_ids, sel_coeffs, reps)
+        ) = split_partitions(ts_data, ohe_ids, sel_coeffs, reps, groups)
 
         # Time-series model training and evaluation
         logger.info("Training time-series model.")
@@ -3,6 +3,10 @@ import pandas as pd
 import os
 import numpy as np
 import logging
+import queue
+import threading
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
 
 
 def read_config(yaml_file):
@@ -42,3 +46,197 @@ def get_logger(module_name):
     logger.setLevel("INFO")
 
     return logger
+
+
+def iter_in_thread(iterable, maxsize=2):
+    """
+    Runs an iterable in a background thread, keeping at most maxsize items ready ahead of the consumer.
+    Exceptions raised by the iterable are re-raised in the consuming thread.
+
+    Args:
+        iterable (iterable): Producer, e.g. a generator that reads and featurizes chunks.
+        maxsize (int, optional): Bound on the number of items waiting in the queue.
+
+    Yields:
+        Items of iterable, in order.
+    """
+    items = queue.Queue(maxsize)
+    done = object()
+    stop = threading.Event()
+    error = []
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            error.append(e)
+        items.put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        # Unblocks the producer if the consumer bailed out early
+        stop.set()
+
+    thread.join()
+    if error:
+        raise error[0]
+
+
+def consume_in_thread(func, iterable, maxsize=2):
+    """
+    Calls func on every item of iterable from a background thread, so the caller can produce the next item meanwhile.
+    Exceptions raised by func are re-raised once the iterable is exhausted or on the next item handed over.
+
+    Args:
+        func (callable): Consumer, e.g. a function that writes results to disk.
+        iterable (iterable): Items to hand to func, in order.
+        maxsize (int, optional): Bound on the number of items waiting to be consumed.
+    """
+    items = queue.Queue(maxsize)
+    done = object()
+    error = []
+
+    def consume():
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if not error:
+                try:
+                    func(item)
+                except BaseException as e:
+                    error.append(e)
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    try:
+        for item in iterable:
+            if error:
+                break
+            items.put(item)
+    finally:
+        items.put(done)
+        thread.join()
+
+    if error:
+        raise error[0]
+
+
+def drain_in_thread(func, iterable, maxsize=2):
+    """
+    Hands func an iterator over iterable's items and runs it in a background thread, fed from the calling thread.
+    Unlike consume_in_thread() func sees the whole stream, so it can batch items up, e.g. into shards.
+    Exceptions raised by func are re-raised once the iterable is exhausted or on the next item handed over.
+
+    Args:
+        func (callable): Consumer taking an iterator, e.g. a function that writes results to disk.
+        iterable (iterable): Items to hand to func, in order.
+        maxsize (int, optional): Bound on the number of items waiting to be consumed.
+
+    Returns:
+        Return value of func.
+    """
+    items = queue.Queue(maxsize)
+    done = object()
+    result = []
+    error = []
+
+    def iter_items():
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            yield item
+
+    def consume():
+        stream = iter_items()
+        try:
+            result.append(func(stream))
+        except BaseException as e:
+            error.append(e)
+        # Keep draining so the caller never blocks on a consumer that stopped early
+        for _ in stream:
+            pass
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    try:
+        for item in iterable:
+            if error:
+                break
+            items.put(item)
+    finally:
+        items.put(done)
+        thread.join()
+
+    if error:
+        raise error[0]
+
+    return result[0]
+
+
+def make_shared_pool(processes):
+    """
+    Starts a pool of forked workers that can attach to arrays from share_array().
+    Workers share the parent's resource tracker, so blocks are only cleaned up once, by the parent.
+
+    Args:
+        processes (int): Number of worker processes.
+
+    Returns:
+        multiprocessing.Pool: Worker pool, the caller has to terminate() it.
+    """
+    resource_tracker.ensure_running()
+    return mp.get_context("fork").Pool(processes)
+
+
+def share_array(arr):
+    """
+    Copies an array into a new shared memory block so worker processes can read it without it being pickled.
+
+    Args:
+        arr (np.arr): Array to share.
+
+    Returns:
+        tuple[SharedMemory, tuple]: The block, which the caller has to close() and unlink(), and the (name, shape, dtype) \
+            handle to pass to attach_shared_array() in workers.
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def attach_shared_array(name, shape, dtype):
+    """
+    Maps an array shared with share_array() into a worker process started by make_shared_pool().
+
+    Args:
+        name (str): Shared memory block name.
+        shape (tuple): Shape of the array.
+        dtype (str): Dtype of the array.
+
+    Returns:
+        tuple[SharedMemory, np.arr]: The block, to close() once the array is no longer used, and a read-only view of the array.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    arr.flags.writeable = False
+
+    return shm, arr
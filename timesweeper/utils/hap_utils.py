@@ -1,9 +1,13 @@
 import numpy as np
 
+# Number of set bits in each possible byte, for XOR+popcount Hamming distances
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
 
 def getTSHapFreqs(haps, samp_sizes):
     """
     Build haplotype frequency spectrum for a single timepoint.
+    Kept for string haplotypes, see get_ts_hap_freqs() for the array version.
 
     Args:
         haps (list[str]): List of haplotypes read from MS entry.
@@ -11,149 +15,273 @@ def getTSHapFreqs(haps, samp_sizes):
     Returns:
         list[float]: Haplotype frequency spectrum for a single timepoint sorted by the most common hap in entire set.
     """
-    tsHapDicts = calcFreqs(haps, samp_sizes)
-    winningHap = getHighestVelHap(tsHapDicts, haps)
-    hapBag = list(set(haps))
-    hapBag.pop(hapBag.index(winningHap))
+    return get_ts_hap_freqs(strlist_to_haps(haps), samp_sizes)
+
 
-    hapToIndex = {}
-    index = 0
-    hapToIndex[winningHap] = index
+def get_n_hft_classes(yaml_data):
+    """
+    Reads the optional "hft classes" key of the config, the number of HFT columns to keep.
 
-    while len(hapBag) > 0:
-        index += 1
-        mostSimilarHapIndex = getMostSimilarHapIndex(hapBag, winningHap)
-        mostSimilarHap = hapBag.pop(mostSimilarHapIndex)
-        hapToIndex[mostSimilarHap] = index
+    Args:
+        yaml_data (dict): Config.
 
-    hapFreqMat = []
-    i = len(haps) - sum(samp_sizes)  # Skip restarts for sims
-    for j in samp_sizes:
-        currHapFreqs = getHapFreqsForTimePoint(
-            haps[i : i + j], hapToIndex, sum(samp_sizes)
-        )
-        hapFreqMat.append(currHapFreqs)
-        i += j
+    Returns:
+        int: Number of haplotype classes in each HFT, None to keep one column per sampled chromosome.
+    """
+    n_classes = yaml_data.get("hft classes")
+    if n_classes is not None and (not isinstance(n_classes, int) or n_classes < 1):
+        raise ValueError(f"hft classes has to be a positive integer, got {n_classes}")
 
-    return np.array(hapFreqMat)
+    return n_classes
 
 
-def calcFreqs(haps, samp_sizes):
+def get_ts_hap_freqs(haps_arr, samp_sizes, n_classes=None):
     """
-    Calculates haplotype frequencies for all present haplotypes in each timepoint.
+    Build haplotype frequency spectrum of each timepoint from a window of haplotypes.
+    Haplotypes are ordered by Hamming distance to the haplotype with the largest frequency increase over time.
 
     Args:
-        haps (list[str]): List of haplotypes, each is a 1D genotype string
+        haps_arr (np.arr): Haplotypes of shape (chromosomes, snps), missing alleles as -1.
+        samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
+        n_classes (int, optional): Only keep this many columns, see hft_from_classes().
 
     Returns:
-        List[Dict[str: float]]: List of dictionaries for each timepoint in the form of {hap: freq}
+        np.arr: HFT of shape (timepoints, n_classes or sum(samp_sizes)).
     """
-    allFreqs = []
-    i = 0
+    labels, uniq_haps = get_hap_classes(pack_haps(haps_arr))
 
-    # Populate with 0s
-    for j in samp_sizes:
-        freqsInSamp = {}
-        for hap in haps:
-            freqsInSamp[hap] = 0.0
-        for hap in haps[i : i + j]:
-            freqsInSamp[hap] += 1 / j
-        allFreqs.append(freqsInSamp)
-        i += j
+    return hft_from_classes(labels, uniq_haps, samp_sizes, n_classes)
 
-    return allFreqs
 
+def hft_from_classes(labels, uniq_haps, samp_sizes, n_classes=None):
+    """
+    Build the HFT from haplotype class labels.
+    Columns are ranked by distance to the winning hap, so truncating to n_classes keeps the winning hap and its
+        closest relatives and drops the long tail of rare distant haps that are zero in almost every window.
 
-def getHighestVelHap(tsHapDicts, haps):
+    Args:
+        labels (np.arr): Class of each chromosome, see get_hap_classes().
+        uniq_haps (np.arr): Packed haplotype of each class, see get_hap_classes().
+        samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
+        n_classes (int, optional): Number of columns to keep. Defaults to sum(samp_sizes), which never drops a class.
+
+    Returns:
+        np.arr: HFT of shape (timepoints, n_classes or sum(samp_sizes)).
     """
-    Calculates hap frequency differences between min/max freqs for all haps, returns hap with largest change.
+    n_tps = len(samp_sizes)
+    tp_sizes = np.array(samp_sizes)[:, None]
+    sample_tps = np.repeat(np.arange(n_tps), samp_sizes)
+
+    # Velocity is measured from the first chromosome on
+    vel_tps = np.full(len(labels), -1)
+    vel_tps[: len(sample_tps)] = sample_tps[: len(labels)]
+    vel_freqs = count_haps_per_tp(labels, vel_tps, n_tps, len(uniq_haps)) / tp_sizes
+    winning_hap = get_highest_vel_hap(vel_freqs)
+
+    hap_ranks = rank_haps_by_dist(uniq_haps, winning_hap)
+
+    # The HFT skips restarts for sims, only the last sum(samp_sizes) chromosomes are sampled
+    hft_tps = np.full(len(labels), -1)
+    hft_tps[len(labels) - len(sample_tps) :] = sample_tps
+    if n_classes is None:
+        n_classes = len(sample_tps)
+    hap_counts = count_haps_per_tp(hap_ranks[labels], hft_tps, n_tps, n_classes)
+
+    return hap_counts / tp_sizes
+
+
+def resize_hft(hft, n_classes):
+    """
+    Truncates or zero-pads the columns of HFTs built without n_classes, same as building them with it.
 
     Args:
-        tsHapDicts (List[Dict{str: float}]): List of timepoint dicts with structure {hap: freq}
-        haps (List[str]): Haplotype strings
+        hft (np.arr): HFT(s) with haplotype classes on the last axis.
+        n_classes (int): Number of columns to keep.
 
     Returns:
-        str: Haplotype with biggest change in frequency from min to max freq.
+        np.arr: HFT(s) with n_classes columns.
+    """
+    hft = hft[..., :n_classes]
+    n_pad = n_classes - hft.shape[-1]
+    if n_pad > 0:
+        hft = np.pad(hft, [(0, 0)] * (hft.ndim - 1) + [(0, n_pad)])
+
+    return hft
+
+
+def pack_haps(haps_arr):
     """
-    freqChanges = {}
-    for hap in haps:
-        hapFreqs = [
-            tsHapDicts[i][hap] for i in range(len(tsHapDicts)) if hap in tsHapDicts[i]
-        ]
-        # Ensures min is prior to max, set to max if max is first value or only
-        max_val = max(hapFreqs)
-        max_loc = hapFreqs.index(max_val)
+    Packs haplotypes into 64-bit words, with one bit-plane per bit of the allele code.
+    Biallelic haplotypes without missing data take a single bit per SNP.
 
-        if len(list(hapFreqs[:max_loc])) == 0:
-            min_val = 0
-        else:
-            min_val = min(hapFreqs[:max_loc])
+    Args:
+        haps_arr (np.arr): Haplotypes of shape (chromosomes, snps), missing alleles as -1.
+
+    Returns:
+        np.arr: uint64 array of shape (chromosomes, planes, words).
+    """
+    haps_arr = np.asarray(haps_arr, dtype=np.int64)
+    # Shift missing (-1) up to 0 only when there is missing data
+    codes = haps_arr + 1 if haps_arr.min(initial=0) < 0 else haps_arr
+    n_planes = max(1, int(codes.max(initial=0)).bit_length())
 
-        freqChanges[hap] = max_val - min_val
+    n_haps, n_snps = codes.shape
+    n_words = max(1, -(-n_snps // 64))
+    bits = np.zeros((n_haps, n_planes, n_words * 64), dtype=np.uint8)
+    for plane in range(n_planes):
+        bits[:, plane, :n_snps] = (codes >> plane) & 1
 
-    return max(freqChanges, key=freqChanges.get)
+    return np.packbits(bits, axis=2, bitorder="little").view(np.uint64)
 
 
-def getHapFreqsForTimePoint(currSample, hapToIndex, maxPossibleHaps):
+def iter_rolling_hfts(haps, samp_sizes, win_size, n_classes=None):
     """
-    Create haplotype freq spectrum for a given sample and haplotype.
+    Slides a window along SNPs and yields the HFT of each window, same as get_ts_hap_freqs() on each of them.
+    Each chromosome's haplotype is kept as a packed shift register: sliding shifts the leaving SNP out and
+        the entering SNP in, so nothing is rebuilt from the full window.
 
     Args:
-        currSample (list[str]): Set of haplotypes in current time-sample.
-        hapToIndex (int): Index of hap from hap-bag to calculate with.
-        maxPossibleHaps (int): Number of total possible haplotypes.
+        haps (np.arr): Haplotypes of shape (snps, chromosomes), missing alleles as -1.
+        samp_sizes (list[int]): Number of chromosomes sampled at each timepoint.
+        win_size (int): Number of SNPs in each window.
+        n_classes (int, optional): Only keep this many columns, see hft_from_classes().
+
+    Yields:
+        np.arr: HFT of shape (timepoints, n_classes or sum(samp_sizes)) for windows starting at SNP 0, 1, ..., snps - win_size.
+    """
+    haps = np.asarray(haps, dtype=np.int64)
+    codes = haps + 1 if haps.min(initial=0) < 0 else haps
+    n_planes = max(1, int(codes.max(initial=0)).bit_length())
+    # SNP codes as bit-planes, shape (snps, planes, chromosomes)
+    code_bits = np.stack(
+        [((codes >> plane) & 1).astype(np.uint64) for plane in range(n_planes)], axis=1
+    )
+
+    n_snps, n_chroms = haps.shape
+    n_words = max(1, -(-win_size // 64))
+    top_mask = np.uint64((1 << (win_size - 64 * (n_words - 1))) - 1)
+    registers = np.zeros((n_chroms, n_planes, n_words), dtype=np.uint64)
+
+    one, carry_shift = np.uint64(1), np.uint64(63)
+    for snp in range(n_snps):
+        # Shift the whole window up by one SNP, the oldest one falls off the top word
+        carry = registers[:, :, :-1] >> carry_shift
+        registers <<= one
+        registers[:, :, 1:] |= carry
+        registers[:, :, -1] &= top_mask
+        registers[:, :, 0] |= code_bits[snp].T
+
+        if snp >= win_size - 1:
+            labels, uniq_haps = get_hap_classes(registers)
+            yield hft_from_classes(labels, uniq_haps, samp_sizes, n_classes)
+
+
+def popcount(words):
+    """Counts set bits over the last axis of a uint64 array via a byte lookup table."""
+    words = np.ascontiguousarray(words)
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def hamming_dists(packed, target):
+    """
+    Counts SNPs at which each packed haplotype differs from target.
+
+    Args:
+        packed (np.arr): Packed haplotypes of shape (haps, planes, words), see pack_haps().
+        target (np.arr): Single packed haplotype of shape (planes, words).
+
+    Returns:
+        np.arr: Number of differing SNPs for each haplotype.
+    """
+    # A SNP differs if any plane of its allele code differs
+    diffs = np.bitwise_or.reduce(packed ^ target, axis=1)
+    return popcount(diffs)
+
+
+def get_hap_classes(packed):
+    """
+    Finds unique haplotypes and which one each chromosome carries.
+
+    Args:
+        packed (np.arr): Packed haplotypes, see pack_haps().
 
     Returns:
-        list[float]: Haplotype frequency spectrum for a given set of haplotypes.
+        np.arr: Class label of each chromosome, classes are numbered in order of first appearance.
+        np.arr: Packed haplotype of each class.
+    """
+    rows = packed.reshape(len(packed), -1)
+    if rows.shape[1] == 1:
+        # Single word haplotypes are grouped as plain integers, much faster than unique rows
+        rows = rows[:, 0]
+    uniq_haps, first_idxs, labels = np.unique(
+        rows, axis=0, return_index=True, return_inverse=True
+    )
+    order = np.argsort(first_idxs)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+
+    return ranks[labels.reshape(-1)], uniq_haps[order].reshape(-1, *packed.shape[1:])
+
+
+def count_haps_per_tp(labels, tp_labels, n_tps, n_classes):
     """
-    hfs = [0] * maxPossibleHaps
-    for hap in currSample:
-        hfs[hapToIndex[hap]] += 1
+    Counts chromosomes of each class at each timepoint.
 
-    hfs = [x / len(currSample) for x in hfs]
+    Args:
+        labels (np.arr): Class of each chromosome.
+        tp_labels (np.arr): Timepoint of each chromosome, -1 for chromosomes that aren't counted.
+        n_tps (int): Number of timepoints.
+        n_classes (int): Number of columns to count into. Classes past this are dropped.
+
+    Returns:
+        np.arr: Counts of shape (timepoints, n_classes).
+    """
+    counted = (tp_labels >= 0) & (labels < n_classes)
+    counts = np.bincount(
+        tp_labels[counted] * n_classes + labels[counted], minlength=n_tps * n_classes
+    )
 
-    return hfs
+    return counts.reshape(n_tps, n_classes)
 
 
-def getMostSimilarHapIndex(haps, targHap):
+def get_highest_vel_hap(tp_freqs):
     """
-    Calculate distances between a current haplotype and all given haps in sample.
+    Calculates hap frequency differences between min/max freqs for all haps, returns hap with largest change.
+    The min is taken from timepoints prior to the (first) max, and is 0 if the max is at the first timepoint.
 
     Args:
-        haps (list[str]): Haplotypes for a given sample point.
-        targHap (str): Haplotype to calculate distance from.
+        tp_freqs (np.arr): Frequencies of each hap class with shape (timepoints, classes).
 
     Returns:
-        int: Index of the haplotype in the hapbag that has the min distance from targHap.
+        int: Class with the biggest change in frequency, the first one on ties.
     """
-    minDist = float("inf")
-    for i in range(len(haps)):
-        dist = seqDist(haps[i], targHap)
-        if dist < minDist:
-            minDist = dist
-            minIndex = i
+    max_vals = tp_freqs.max(axis=0)
+    max_locs = tp_freqs.argmax(axis=0)
+
+    before_max = np.arange(len(tp_freqs))[:, None] < max_locs[None, :]
+    min_vals = np.where(before_max, tp_freqs, np.inf).min(axis=0)
+    min_vals[max_locs == 0] = 0
 
-            return minIndex
+    return int(np.argmax(max_vals - min_vals))
 
 
-def seqDist(hap1, hap2):
+def rank_haps_by_dist(uniq_haps, winning_hap):
     """
-    Calculates pairwise distance between two haplotypes
+    Orders hap classes by Hamming distance to the winning hap, ties broken by order of first appearance.
 
     Args:
-        hap1 (list): Haplotype 1
-        hap2 (list): Haplotype 2
+        uniq_haps (np.arr): Packed haplotype of each class, see get_hap_classes().
+        winning_hap (int): Class of the winning hap, see get_highest_vel_hap().
 
     Returns:
-        int: Number of pairwise differences (sequence distance) between haps
+        np.arr: HFT column of each class, the winning hap is column 0.
     """
-    assert len(hap1) == len(hap2)
-    numDiffs = 0
-    for i in range(len(hap1)):
-        if hap1[i] != hap2[i]:
-            numDiffs += 1
+    dists = hamming_dists(uniq_haps, uniq_haps[winning_hap])
+    order = np.lexsort((np.arange(len(dists)), dists))
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
 
-    return numDiffs
+    return ranks
 
 
 def haps_to_strlist(haps_arr):
@@ -170,3 +298,16 @@ def haps_to_strlist(haps_arr):
     strhaps = ["".join([str(i) for i in hap]).replace("-1", "n") for hap in haplist]
 
     return strhaps
+
+
+def strlist_to_haps(strhaps):
+    """
+    Inverse of haps_to_strlist().
+
+    Args:
+        strhaps (list[str]): Str representations of haplotypes, missing alleles as "n".
+
+    Returns:
+        np.arr: Haplotypes of shape (chromosomes, snps), missing alleles as -1.
+    """
+    return np.array([[-1 if c == "n" else int(c) for c in hap] for hap in strhaps])
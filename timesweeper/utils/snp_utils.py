@@ -1,18 +1,46 @@
+import gzip
+import logging
+import os
+import re
+import struct
+import subprocess
+from collections import Counter
+
 import allel
 import numpy as np
 
+from timesweeper.utils import store_utils as stu
+
+# htslib-backed readers are optional, allel's text parser is the fallback
+try:
+    import cyvcf2
+except ImportError:
+    cyvcf2 = None
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+# Per-timepoint allele counts, shape (snps, timepoints, alleles)
+TS_COUNTS_FIELD = "variants/TS_AC"
+# skallel's default alt_number of 3 allows for alleles 0-3
+MAX_ALLELE = 3
+# Reader backends in order of preference
+READER_BACKENDS = ["cyvcf2", "pysam", "allel"]
+# Site filters available under "site filters" in the config, applied in this order
+SITE_FILTERS = ["biallelic", "min maf", "max missingness"]
+# Each entry of a tabix linear index covers 2^14 bp, so the number of entries bounds a contig's last record
+TABIX_LINEAR_SHIFT = 14
+# Furthest read_region_with_flanks() pads a region looking for flanking SNPs, in bp
+MAX_FLANK_PAD = 10_000_000
+
+logger = logging.getLogger("snp_utils")
+
 
 # General util functions
-def read_vcf(vcf_file, samples_list, benchmark):
-    """
-    Loads VCF file and grabs relevant fields.
-    For generating training data from simulated VCFs, which are typically small.
-    Args:
-        vcf_file (str): Path to vcf file.
-        benchmark (bool): Whether to look for Mut_Type or not.
-    Returns:
-        allel.vcf object: VCF data in the form of dictionary type object.
-    """
+def get_fields(benchmark):
+    """Fields to pull from VCFs, mutation type and selection coeff are only needed when benchmarking."""
     if benchmark:
         fields = [
             "variants/CHROM",
@@ -23,53 +51,748 @@ def read_vcf(vcf_file, samples_list, benchmark):
         ]
     else:
         fields = ["variants/CHROM", "variants/POS", "calldata/GT"]
-    if samples_list:
+
+    return fields
+
+
+def get_numbers(fields, number):
+    """Max number of values to parse for the INFO fields that are actually requested."""
+    return {f: number for f in ["variants/MT", "variants/S"] if f in fields}
+
+
+### VCF reader backends
+def get_reader_backend(vcf_file, backend=None):
+    """
+    Picks the reader to decode a VCF/BCF with.
+
+    Args:
+        vcf_file (str): Path to vcf/bcf file.
+        backend (str, optional): One of READER_BACKENDS. Defaults to the fastest one installed.
+
+    Returns:
+        str: Name of the reader backend.
+    """
+    available = {"cyvcf2": cyvcf2 is not None, "pysam": pysam is not None, "allel": True}
+    if backend is None:
+        backend = next(b for b in READER_BACKENDS if available[b])
+    elif backend not in available:
+        raise ValueError(f"Unknown VCF reader {backend}, options are {READER_BACKENDS}")
+    elif not available[backend]:
+        raise ImportError(f"VCF reader {backend} was requested but is not installed")
+
+    if backend == "allel" and vcf_file.endswith(".bcf"):
+        raise ValueError(
+            f"{vcf_file} is a BCF, which needs cyvcf2 or pysam to be installed to read."
+        )
+
+    return backend
+
+
+def read_vcf_samples(vcf_file, backend=None):
+    """Gets sample names from the header of a VCF/BCF, in file order."""
+    backend = get_reader_backend(vcf_file, backend)
+    if backend == "cyvcf2":
+        return list(cyvcf2.VCF(vcf_file).samples)
+    elif backend == "pysam":
+        with pysam.VariantFile(vcf_file) as vf:
+            return list(vf.header.samples)
+
+    return list(allel.read_vcf_headers(vcf_file).samples)
+
+
+def _iter_cyvcf2_records(vcf_file, gt, info_fields, region=None, samples=None):
+    vf = cyvcf2.VCF(vcf_file, samples=samples, gts012=False)
+    for var in vf(region) if region else vf:
+        # Last column of the array is the phasing flag, negative values are missing/vector end
+        gts = var.genotype.array()[:, :-1] if gt else None
+        yield var.CHROM, var.POS, gts, [var.INFO.get(f) for f in info_fields]
+
+    vf.close()
+
+
+def _iter_pysam_records(vcf_file, gt, info_fields, region=None, samples=None):
+    with pysam.VariantFile(vcf_file) as vf:
+        if samples:
+            vf.subset_samples(samples)
+        for rec in vf.fetch(region=region) if region else vf:
+            gts = None
+            if gt:
+                gts = np.array(
+                    [
+                        [-1 if a is None else a for a in call.allele_indices]
+                        for call in rec.samples.values()
+                    ]
+                )
+            yield rec.chrom, rec.pos, gts, [rec.info.get(f) for f in info_fields]
+
+
+def _records_to_chunk(records, fields, numbers):
+    """Packs (chrom, pos, gts, info values) records into a dict with the same fields, dtypes and fill values as allel."""
+    chroms, positions, gts, info = [], [], [], {f: [] for f in numbers}
+    for chrom, pos, gt, info_values in records:
+        chroms.append(chrom)
+        positions.append(pos)
+        if "calldata/GT" in fields:
+            gts.append(gt)
+        for field, value in zip(numbers, info_values):
+            info[field].append(() if value is None else np.atleast_1d(value))
+
+    chunk = {
+        "variants/CHROM": np.array(chroms, dtype=object),
+        "variants/POS": np.array(positions, dtype=np.int32),
+    }
+    if "calldata/GT" in fields:
+        gts = np.stack(gts)
+        chunk["calldata/GT"] = np.where(gts < 0, -1, gts).astype(np.int8)
+    for field, dtype, fill in [
+        ("variants/MT", np.int32, -1),
+        ("variants/S", np.float32, np.nan),
+    ]:
+        if field in numbers:
+            arr = np.full((len(chroms), numbers[field]), fill, dtype=dtype)
+            for i, values in enumerate(info[field]):
+                values = values[: numbers[field]]
+                arr[i, : len(values)] = values
+            chunk[field] = arr
+
+    return chunk
+
+
+def iter_htslib_chunks(
+    vcf_file, fields, numbers, chunk_length, backend, region=None, samples=None
+):
+    """
+    Decodes a VCF/BCF with an htslib-backed reader into allel-style chunks.
+
+    Args:
+        vcf_file (str): Path to vcf/bcf file, needs to be indexed if region is given.
+        fields (list[str]): Fields to pull, see get_fields().
+        numbers (dict): Max number of values for each INFO field, see get_numbers().
+        chunk_length (int): Number of variants per chunk.
+        backend (str): "cyvcf2" or "pysam".
+        region (str, optional): Region in the form of chrom:start-end.
+        samples (list[str], optional): Subset of samples to pull.
+
+    Yields:
+        tuple[dict, int, str, int]: (chunk, n_variants, chrom, pos) just like skallel does.
+    """
+    iter_records = _iter_cyvcf2_records if backend == "cyvcf2" else _iter_pysam_records
+    info_fields = [f.split("/")[1] for f in numbers]
+    records = iter_records(vcf_file, "calldata/GT" in fields, info_fields, region, samples)
+
+    while True:
+        batch = [rec for _, rec in zip(range(chunk_length), records)]
+        if not batch:
+            return
+
+        chunk = _records_to_chunk(batch, fields, numbers)
+        yield chunk, len(batch), batch[-1][0], batch[-1][1]
+
+
+def _read_htslib(vcf_file, fields, numbers, backend, region=None, samples=None):
+    """Reads a whole file or region into a single chunk dict, None if there are no records."""
+    chunks = [
+        chunk
+        for chunk, *_ in iter_htslib_chunks(
+            vcf_file, fields, numbers, 100000, backend, region, samples
+        )
+    ]
+    if not chunks:
+        return None
+
+    return {field: np.concatenate([c[field] for c in chunks]) for field in chunks[0]}
+
+
+def read_vcf(vcf_file, samples_list, benchmark, backend=None):
+    """
+    Loads VCF file and grabs relevant fields.
+    For generating training data from simulated VCFs, which are typically small.
+    Args:
+        vcf_file (str): Path to vcf/bcf file or genotype store created with `timesweeper index`.
+        benchmark (bool): Whether to look for Mut_Type or not.
+        backend (str, optional): VCF reader to use, see get_reader_backend().
+    Returns:
+        allel.vcf object: VCF data in the form of dictionary type object.
+    """
+    fields = get_fields(benchmark)
+    numbers = get_numbers(fields, 100)
+    if stu.is_store(vcf_file):
+        chunks = [chunk for chunk, *_ in stu.iter_store_chunks(vcf_file, fields)]
+        vcf = {field: np.concatenate([c[field] for c in chunks]) for field in chunks[0]}
+        if samples_list:
+            samples = stu.read_manifest(vcf_file)["samples"]
+            vcf["calldata/GT"] = vcf["calldata/GT"][
+                :, [samples.index(s) for s in samples_list]
+            ]
+        return vcf
+
+    backend = get_reader_backend(vcf_file, backend)
+    if backend != "allel":
+        return _read_htslib(vcf_file, fields, numbers, backend, samples=samples_list)
+    elif samples_list:
         vcf = allel.read_vcf(
             vcf_file,
             fields=fields,
             samples=samples_list,
-            numbers={"variants/MT": 100, "variants/S": 100},
+            numbers=numbers,
         )
     else:
-        vcf = allel.read_vcf(
-            vcf_file, fields=fields, numbers={"variants/MT": 100, "variants/S": 100}
-        )
+        vcf = allel.read_vcf(vcf_file, fields=fields, numbers=numbers)
     return vcf
 
 
-def get_vcf_iter(vcf_file, benchmark):
+def parse_region(region):
+    """
+    Splits a region string into its parts.
+
+    Args:
+        region (str): Region in the form of chrom, chrom:start, or chrom:start-end.
+
+    Returns:
+        tuple[str, int, int]: Chrom, start, and end. Start and end are None if not given.
+    """
+    chrom, _, span = region.partition(":")
+    if not span:
+        return chrom, None, None
+
+    start, _, end = span.replace(",", "").partition("-")
+    return chrom, int(start), int(end) if end else None
+
+
+def format_region(chrom, start=None, end=None):
+    """Inverse of parse_region()."""
+    if start is None:
+        return str(chrom)
+    if end is None:
+        return f"{chrom}:{start}"
+    return f"{chrom}:{start}-{end}"
+
+
+def read_bed_regions(bed_file):
+    """
+    Reads intervals from a BED file.
+
+    Args:
+        bed_file (str): BED file, only the first three columns are used.
+
+    Returns:
+        list[tuple[str, int, int]]: (chrom, start, end) of each interval, converted to 1-based inclusive.
+    """
+    regions = []
+    with open(bed_file, "r") as infile:
+        for line in infile:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            chrom, start, end = line.split()[:3]
+            regions.append((chrom, int(start) + 1, int(end)))
+
+    return regions
+
+
+def merge_regions(regions):
+    """
+    Sorts and merges overlapping or adjacent intervals so no SNP is visited twice.
+
+    Args:
+        regions (list[tuple[str, int, int]]): (chrom, start, end) intervals, 1-based inclusive.
+
+    Returns:
+        list[tuple[str, int, int]]: Merged intervals, chromosomes in order of first appearance.
+    """
+    by_chrom = {}
+    for chrom, start, end in regions:
+        by_chrom.setdefault(chrom, []).append((start, end))
+
+    merged = []
+    for chrom, intervals in by_chrom.items():
+        intervals.sort()
+        cur_start, cur_end = intervals[0]
+        for start, end in intervals[1:]:
+            if start <= cur_end + 1:
+                cur_end = max(cur_end, end)
+            else:
+                merged.append((chrom, cur_start, cur_end))
+                cur_start, cur_end = start, end
+        merged.append((chrom, cur_start, cur_end))
+
+    return merged
+
+
+def read_vcf_region(vcf_file, region, benchmark, samp_sizes=None, backend=None):
+    """
+    Loads a single region of an indexed VCF or genotype store.
+
+    Args:
+        vcf_file (str): Path to tabix-indexed vcf/bcf file or genotype store created with `timesweeper index`.
+        region (str): Region in the form of chrom:start-end.
+        benchmark (bool): Whether to look for Mut_Type or not.
+        samp_sizes (list[int], optional): If given and reading from a store, load per-timepoint
+            allele counts (TS_COUNTS_FIELD) instead of genotypes. Defaults to None.
+        backend (str, optional): VCF reader to use, see get_reader_backend().
+
+    Returns:
+        allel.vcf object: VCF data in the form of dictionary type object, None if region is empty.
+    """
+    fields = get_fields(benchmark)
+    if stu.is_store(vcf_file):
+        if samp_sizes is not None:
+            fields = [f for f in fields if f != "calldata/GT"] + [TS_COUNTS_FIELD]
+        return stu.read_store_region(vcf_file, *parse_region(region), fields)
+
+    backend = get_reader_backend(vcf_file, backend)
+    if backend != "allel":
+        return _read_htslib(
+            vcf_file, fields, get_numbers(fields, 100), backend, region=region
+        )
+
+    return allel.read_vcf(
+        vcf_file,
+        fields=fields,
+        region=region,
+        numbers=get_numbers(fields, 100),
+    )
+
+
+def read_region_with_flanks(
+    vcf_file,
+    chrom,
+    start,
+    end,
+    n_flank,
+    benchmark,
+    samp_sizes=None,
+    chrom_len=None,
+    pad=50000,
+    site_filter=None,
+    filter_stats=None,
+    max_pad=MAX_FLANK_PAD,
+):
+    """
+    Loads records in chrom:start-end plus n_flank SNPs on either side so that every SNP in the region can be the center of a full window.
+    The region is padded by pad bp and the pad doubled until enough flanking SNPs are found, the chromosome ends, or the pad reaches max_pad.
+    Regions without SNPs are given up on after the first read, they have no windows to flank.
+
+    Args:
+        vcf_file (str): Path to tabix-indexed vcf file or genotype store created with `timesweeper index`.
+        chrom (str): Chromosome/contig name.
+        start (int): 1-based inclusive start of the region, None for the whole chromosome.
+        end (int): 1-based inclusive end of the region, None for the whole chromosome.
+        n_flank (int): Number of SNPs needed on each side of the region, typically win_size // 2.
+        benchmark (bool): Whether to look for Mut_Type or not.
+        samp_sizes (list[int], optional): Passed to read_vcf_region(). Defaults to None.
+        chrom_len (int, optional): Length of chrom if known, avoids padding past the end.
+        pad (int, optional): Initial padding in bp. Defaults to 50000.
+        site_filter (callable, optional): Applied to every read before flanks are counted, so
+            n_flank SNPs are left on each side after filtering, see filter_sites().
+        filter_stats (collections.Counter, optional): Updated with the number of sites in the core
+            region (not the flanks) each filter removed.
+        max_pad (int, optional): Largest padding in bp, bounds how much is read around a region with sparse flanks.
+            Windows at the region's edges may be left out if their flanking SNPs are further than this.
+
+    Returns:
+        allel.vcf object: VCF data for the region and flanks, None if region is empty.
+    """
+    if start is None:
+        vcf = read_vcf_region(vcf_file, format_region(chrom), benchmark, samp_sizes)
+        if site_filter and vcf is not None:
+            vcf = site_filter(vcf, stats=filter_stats)
+        return vcf
+
+    end = start if end is None else end
+    max_pos = chrom_len if chrom_len else np.iinfo(np.int32).max
+    while True:
+        lo, hi = max(1, start - pad), min(end + pad, max_pos)
+        vcf = read_vcf_region(
+            vcf_file, format_region(chrom, lo, hi), benchmark, samp_sizes
+        )
+        if vcf is None:
+            return None
+
+        if site_filter:
+            # Only the last read is kept, so only count what was removed from it
+            removed = Counter()
+            raw_pos = vcf["variants/POS"]
+            vcf = site_filter(
+                vcf, stats=removed, count_mask=(raw_pos >= start) & (raw_pos <= end)
+            )
+
+        positions = vcf["variants/POS"]
+        i_lo = np.searchsorted(positions, start, side="left")
+        i_hi = np.searchsorted(positions, end, side="right")
+        if i_lo == i_hi:
+            break
+        if (i_lo >= n_flank or lo == 1) and (
+            len(positions) - i_hi >= n_flank or hi == max_pos
+        ):
+            break
+        if pad >= max_pad:
+            logger.warning(
+                f"Fewer than {n_flank} flanking SNPs within {max_pad} bp of {format_region(chrom, start, end)}, windows at its edges are skipped"
+            )
+            break
+
+        pad = min(pad * 2, max_pad)
+
+    if site_filter and filter_stats is not None:
+        filter_stats.update(removed)
+
+    if i_lo == i_hi:
+        return None
+
+    keep = slice(max(i_lo - n_flank, 0), min(i_hi + n_flank, len(positions)))
+    return {field: np.asarray(arr[keep]) for field, arr in vcf.items()}
+
+
+def get_contigs(vcf_file):
+    """
+    Gets contig names and lengths of a VCF or genotype store, in file order.
+    Uses ##contig header lines for VCFs, and falls back to `tabix -l` if there are none.
+    Contigs without a length are given the extent of their records instead, see get_contig_extent().
+
+    Args:
+        vcf_file (str): Path to tabix-indexed vcf file or genotype store created with `timesweeper index`.
+
+    Returns:
+        dict: Contig name to length (or None if it has no records).
+    """
+    if stu.is_store(vcf_file):
+        return stu.get_store_contigs(vcf_file)
+
+    backend = get_reader_backend(vcf_file)
+    contigs = {}
+    if backend == "pysam":
+        with pysam.VariantFile(vcf_file) as vf:
+            contigs = {c: vf.header.contigs[c].length for c in vf.header.contigs}
+    elif backend == "cyvcf2":
+        headers = cyvcf2.VCF(vcf_file).raw_header.splitlines()
+    else:
+        headers = allel.read_vcf_headers(vcf_file).headers
+
+    if backend != "pysam":
+        for line in headers:
+            if line.startswith("##contig="):
+                contig_id = re.search(r"ID=([^,>]+)", line).group(1)
+                length = re.search(r"length=(\d+)", line)
+                contigs[contig_id] = int(length.group(1)) if length else None
+
+    if not contigs:
+        contigs = {c: None for c in get_indexed_contigs(vcf_file)}
+
+    extents = get_tabix_extents(vcf_file)
+    for chrom, length in contigs.items():
+        if not length:
+            contigs[chrom] = (
+                extents[chrom] if chrom in extents else get_contig_extent(vcf_file, chrom)
+            )
+
+    return contigs
+
+
+def get_indexed_contigs(vcf_file):
+    """Contigs with records in an indexed VCF, in index order."""
+    if pysam is not None:
+        with pysam.TabixFile(vcf_file) as tf:
+            return list(tf.contigs)
+
+    return subprocess.check_output(["tabix", "-l", vcf_file], text=True).split()
+
+
+def get_tabix_extents(vcf_file):
+    """
+    Reads an upper bound on the last position of each contig from the linear index of a .tbi, without reading any records.
+    Each linear index entry covers 2^TABIX_LINEAR_SHIFT bp, so contigs are bounded to the end of their last entry.
+
+    Args:
+        vcf_file (str): Path to bgzipped VCF with a .tbi index next to it.
+
+    Returns:
+        dict: Contig name to extent, empty if there's no .tbi.
+    """
+    tbi_file = f"{vcf_file}.tbi"
+    if not os.path.exists(tbi_file):
+        return {}
+
+    with gzip.open(tbi_file, "rb") as infile:
+        data = infile.read()
+
+    # Header: magic, n_ref, format, col_seq, col_beg, col_end, meta, skip, l_nm, then l_nm bytes of names
+    n_ref, l_nm = struct.unpack_from("<i", data, 4)[0], struct.unpack_from("<i", data, 32)[0]
+    names = data[36 : 36 + l_nm].split(b"\0")[:n_ref]
+    offset = 36 + l_nm
+
+    extents = {}
+    for name in names:
+        (n_bin,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            (n_chunk,) = struct.unpack_from("<i", data, offset + 4)
+            offset += 8 + 16 * n_chunk
+        (n_intv,) = struct.unpack_from("<i", data, offset)
+        offset += 4 + 8 * n_intv
+        extents[name.decode()] = n_intv << TABIX_LINEAR_SHIFT
+
+    return extents
+
+
+def get_contig_extent(vcf_file, chrom):
+    """
+    Position of the last record on chrom, streamed through the index for VCFs without a .tbi (e.g. .csi).
+
+    Args:
+        vcf_file (str): Path to indexed vcf/bcf file.
+        chrom (str): Contig name.
+
+    Returns:
+        int: Last position on chrom, None if it has no records.
+    """
+    last_pos = None
+    if pysam is not None:
+        with pysam.VariantFile(vcf_file) as vf:
+            for record in vf.fetch(chrom):
+                last_pos = record.pos
+        return last_pos
+
+    with subprocess.Popen(
+        ["tabix", vcf_file, chrom], stdout=subprocess.PIPE, text=True
+    ) as proc:
+        for line in proc.stdout:
+            last_pos = line.split("\t", 2)[1]
+
+    return int(last_pos) if last_pos is not None else None
+
+
+def get_vcf_iter(vcf_file, benchmark, samp_sizes=None, chunk_length=100000, backend=None):
     """
     Loads VCF file into allel generator and grabs relevant fields.
     For real data VCFs that are too large to load into memory.
 
     Args:
-        vcf_file (str): Path to vcf file.
+        vcf_file (str): Path to vcf/bcf file or genotype store created with `timesweeper index`.
         benchmark (bool): Whether to look for Mut_Type or not.
+        samp_sizes (list[int], optional): If given, chunks hold per-timepoint allele counts
+            (TS_COUNTS_FIELD) instead of the full genotype array. Defaults to None.
+        chunk_length (int, optional): Number of variants per chunk. Defaults to 100000.
+        backend (str, optional): VCF reader to use, see get_reader_backend().
 
     Returns:
         allel.vcf_iterator object: Generator for VCF data in the form of dictionary type object.
     """
-    if benchmark:
-        fields = [
-            "variants/CHROM",
-            "variants/POS",
-            "calldata/GT",
-            "variants/MT",
-            "variants/S",
-        ]
-    else:
-        fields = ["variants/CHROM", "variants/POS", "calldata/GT"]
+    fields = get_fields(benchmark)
+    if samp_sizes is not None:
+        if stu.is_store(vcf_file):
+            # Counts are already in the store, skip the genotypes entirely
+            fields = [f for f in fields if f != "calldata/GT"] + [TS_COUNTS_FIELD]
+            return stu.iter_store_chunks(vcf_file, fields)
+
+        # Parse in small pieces so only a fraction of a chunk of genotypes is ever in memory
+        return iter_count_chunks(
+            get_vcf_iter(
+                vcf_file,
+                benchmark,
+                chunk_length=max(chunk_length // 10, 1),
+                backend=backend,
+            ),
+            samp_sizes,
+            chunk_length,
+        )
+
+    if stu.is_store(vcf_file):
+        return stu.iter_store_chunks(vcf_file, fields)
+
+    backend = get_reader_backend(vcf_file, backend)
+    if backend != "allel":
+        return iter_htslib_chunks(
+            vcf_file, fields, get_numbers(fields, 20), chunk_length, backend
+        )
 
     _fields, _samples, _headers, vcf_iter = allel.iter_vcf_chunks(
         vcf_file,
         fields=fields,
-        chunk_length=100000,
-        numbers={"variants/MT": 20, "variants/S": 20},
+        chunk_length=chunk_length,
+        numbers=get_numbers(fields, 20),
     )
 
     return vcf_iter
 
 
+def iter_count_chunks(vcf_iter, samp_sizes, chunk_length):
+    """
+    Converts genotype chunks to per-timepoint allele counts as they are parsed, regrouping into chunk_length variants.
+
+    Args:
+        vcf_iter (allel.vcf_iterator): Generator of VCF chunks with calldata/GT.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        chunk_length (int): Number of variants per yielded chunk.
+
+    Yields:
+        tuple[dict, int, str, int]: (chunk, n_variants, chrom, pos) just like skallel does, with GT swapped for TS_COUNTS_FIELD.
+    """
+    pending = []
+    n_pending = 0
+    for chunk in vcf_iter:
+        chunk = dict(chunk[0])
+        chunk[TS_COUNTS_FIELD] = count_ts_alleles(
+            get_geno_arr(chunk), samp_sizes
+        ).astype(np.int32)
+        del chunk["calldata/GT"]
+
+        pending.append(chunk)
+        n_pending += len(chunk["variants/POS"])
+        if n_pending >= chunk_length:
+            yield _concat_count_chunks(pending)
+            pending = []
+            n_pending = 0
+
+    if pending:
+        yield _concat_count_chunks(pending)
+
+
+def _concat_count_chunks(chunks):
+    chunk = {field: np.concatenate([c[field] for c in chunks]) for field in chunks[0]}
+    n_variants = len(chunk["variants/POS"])
+
+    return chunk, n_variants, chunk["variants/CHROM"][-1], chunk["variants/POS"][-1]
+
+
+def stitch_vcf_chunks(vcf_iter, win_size):
+    """
+    Re-blocks a chunked VCF iterator so that no windows are lost at chunk seams.
+    The trailing win_size - 1 SNPs of each block are carried as a halo into the next block
+        of the same chromosome, so centering windows on range(win_size // 2, len(block) - win_size // 2)
+        visits every SNP exactly once. Blocks never span chromosomes.
+
+    Args:
+        vcf_iter (allel.vcf_iterator): Generator of VCF chunks, as given by get_vcf_iter().
+        win_size (int): Number of SNPs used for each window.
+
+    Yields:
+        dict: VCF dict-like chunk with all fields sliced to a single chromosome, halo prepended.
+    """
+    overlap = 2 * (win_size // 2)
+    halo = None
+    for chunk in vcf_iter:
+        if isinstance(chunk, tuple):
+            chunk = chunk[0]  # skallel yields (chunk, n_variants, chrom, pos)
+
+        chroms = chunk["variants/CHROM"]
+        if len(chroms) == 0:
+            continue
+
+        breaks = list(np.flatnonzero(chroms[1:] != chroms[:-1]) + 1)
+        for start, end in zip([0] + breaks, breaks + [len(chroms)]):
+            block = {field: arr[start:end] for field, arr in chunk.items()}
+
+            if (
+                halo is not None
+                and len(halo["variants/CHROM"]) > 0
+                and halo["variants/CHROM"][0] == chroms[start]
+            ):
+                block = {
+                    field: np.concatenate([halo[field], block[field]])
+                    for field in block
+                }
+
+            n_snps = len(block["variants/CHROM"])
+            keep = min(n_snps, overlap)
+            halo = {field: arr[n_snps - keep :] for field, arr in block.items()}
+
+            yield block
+
+
+### Site filtering
+def get_site_filters(yaml_data):
+    """
+    Reads the optional "site filters" block of the config, e.g. {"biallelic": True, "min maf": 0.05, "max missingness": 0.2}.
+
+    Args:
+        yaml_data (dict): Config.
+
+    Returns:
+        dict: Enabled filters and their thresholds, empty if filtering is off.
+    """
+    filters = yaml_data.get("site filters") or {}
+    unknown = set(filters) - set(SITE_FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown site filters {unknown}, options are {SITE_FILTERS}")
+
+    return {
+        f: filters[f] for f in SITE_FILTERS if filters.get(f) not in (None, False)
+    }
+
+
+def get_site_filter_masks(ts_counts, n_chroms, filters):
+    """
+    Evaluates each filter on all sites at once.
+
+    Args:
+        ts_counts (np.arr): Per-timepoint allele counts of shape (snps, timepoints, alleles).
+        n_chroms (int): Total number of sampled chromosomes, i.e. ploidy * sum(samp_sizes).
+        filters (dict): Enabled filters, see get_site_filters().
+
+    Returns:
+        dict: Filter name to boolean mask of sites that pass it.
+    """
+    pooled = ts_counts.sum(axis=1)
+    n_called = pooled.sum(axis=1)
+
+    masks = {}
+    if filters.get("biallelic"):
+        masks["biallelic"] = (pooled > 0).sum(axis=1) <= 2
+
+    if "min maf" in filters:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            maf = 1 - pooled.max(axis=1) / n_called
+        # Sites with no calls at all have no MAF, treat as monomorphic
+        masks["min maf"] = np.nan_to_num(maf) >= filters["min maf"]
+
+    if "max missingness" in filters:
+        masks["max missingness"] = (
+            1 - n_called / n_chroms
+        ) <= filters["max missingness"]
+
+    return masks
+
+
+def filter_sites(vcf, samp_sizes, ploidy, filters, stats=None, count_mask=None):
+    """
+    Drops sites that fail any of the configured filters from a chunk.
+
+    Args:
+        vcf (allel.vcf object): VCF dict-like chunk.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        ploidy (int): Ploidy of samples.
+        filters (dict): Enabled filters, see get_site_filters().
+        stats (collections.Counter, optional): Updated with the number of sites each filter removed.
+            Sites failing multiple filters are attributed to the first one in SITE_FILTERS order.
+        count_mask (np.arr, optional): Only count removed sites where this is True, e.g. to skip flanks.
+
+    Returns:
+        dict: Chunk with all fields masked to passing sites. Per-timepoint allele counts (TS_COUNTS_FIELD) are added if missing so they aren't computed again later.
+    """
+    if not filters:
+        return vcf
+
+    vcf = dict(vcf)
+    if TS_COUNTS_FIELD not in vcf:
+        vcf[TS_COUNTS_FIELD] = count_ts_alleles(get_geno_arr(vcf), samp_sizes).astype(
+            np.int32
+        )
+
+    masks = get_site_filter_masks(
+        vcf[TS_COUNTS_FIELD], ploidy * sum(samp_sizes), filters
+    )
+    keep = np.ones(len(vcf["variants/POS"]), dtype=bool)
+    for name, mask in masks.items():
+        if stats is not None:
+            removed = keep & ~mask
+            if count_mask is not None:
+                removed &= count_mask
+            stats[name] += int(removed.sum())
+        keep &= mask
+
+    return {field: np.asarray(arr)[keep] for field, arr in vcf.items()}
+
+
 def get_geno_arr(vcf):
     """
     Returns Genotype array with calldata.
@@ -83,24 +806,28 @@ def get_geno_arr(vcf):
     return allel.GenotypeArray(vcf["calldata/GT"])
 
 
-def make_loc_tups(vcf, benchmark):
+def make_loc_arr(vcf, benchmark):
     """
-    Zips up chrom, position, and mutations for easy dict-filling.
+    Collects chrom, position, and mutation info of every SNP into a single structured array.
 
     Args:
         vcf (allel.vcf object): VCF dict-like object.
         benchmark (bool): Whether to look for Mut_Type or not.
 
     Returns:
-        list[tuple]: List of tuples with (chrom, pos, mut).
+        np.arr: Structured array with fields (chrom, pos) and (mt, s) if benchmarking.
     """
+    chroms = np.asarray(vcf["variants/CHROM"]).astype(str)
+    fields = {"chrom": chroms, "pos": np.asarray(vcf["variants/POS"])}
     if benchmark:
-        MTs = np.nanmax(vcf["variants/MT"], axis=1).flatten()
-        Ss = np.nanmax(vcf["variants/S"], axis=1).flatten()
+        fields["mt"] = np.nanmax(vcf["variants/MT"], axis=1).flatten()
+        fields["s"] = np.nanmax(vcf["variants/S"], axis=1).flatten()
 
-        return list(zip(vcf["variants/CHROM"], vcf["variants/POS"], MTs, Ss,))
-    else:
-        return list(zip(vcf["variants/CHROM"], vcf["variants/POS"]))
+    locs = np.empty(len(chroms), dtype=[(k, v.dtype) for k, v in fields.items()])
+    for k, v in fields.items():
+        locs[k] = v
+
+    return locs
 
 
 ### Get aft from vcf
@@ -113,15 +840,36 @@ def vcf_to_genos(vcf, benchmark):
         benchmark (bool): Whether to look for Mut_Type or not.
 
     Returns:
-        tuple[allel.GenotypeArray, list[tup(chrom, pos,  mut)]]: Genotype arrays and associated id information.
+        tuple[allel.GenotypeArray, np.arr]: Genotype arrays and associated id information, see make_loc_arr().
     """
     # Shape (snps, samps, ploidy)
     geno_arr = get_geno_arr(vcf)
-    locs = make_loc_tups(vcf, benchmark)
+    locs = make_loc_arr(vcf, benchmark)
 
     return geno_arr, locs
 
 
+def vcf_to_ts_counts(vcf, samp_sizes, benchmark):
+    """
+    Takes in vcf chunk and returns per-timepoint allele counts, using stored counts if the chunk has them.
+
+    Args:
+        vcf_obj (allel.vcf): Loaded VCF object (whole or chunked), with GT or TS_COUNTS_FIELD.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        benchmark (bool): Whether to look for Mut_Type or not.
+
+    Returns:
+        tuple[np.arr, np.arr]: Allele counts of shape (snps, timepoints, alleles) and associated id information, see make_loc_arr().
+    """
+    if TS_COUNTS_FIELD in vcf:
+        ts_counts = np.asarray(vcf[TS_COUNTS_FIELD])
+    else:
+        ts_counts = count_ts_alleles(get_geno_arr(vcf), samp_sizes)
+    locs = make_loc_arr(vcf, benchmark)
+
+    return ts_counts, locs
+
+
 ### Haplotypes from VCF
 def vcf_to_haps(vcf, benchmark):
     """
@@ -132,10 +880,10 @@ def vcf_to_haps(vcf, benchmark):
         benchmark (bool): Whether to look for Mut_Type or not.
 
     Returns:
-        tuple[allel.HaplotypeArray, list[tup(chrom, pos,  mut)]]: Haplotype arrays and associated id information.
+        tuple[allel.HaplotypeArray, np.arr]: Haplotype arrays and associated id information, see make_loc_arr().
     """
     hap_arr = get_geno_arr(vcf).to_haplotypes()
-    locs = make_loc_tups(vcf, benchmark)
+    locs = make_loc_arr(vcf, benchmark)
 
     return hap_arr, locs
 
@@ -160,6 +908,27 @@ def split_arr(arr, samp_sizes):
     return arr_list
 
 
+def count_ts_alleles(genos, samp_sizes, max_allele=MAX_ALLELE):
+    """
+    Counts alleles separately for each timepoint.
+
+    Args:
+        genos (allel.GenotypeArray): Genotype array containing all timepoints.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        max_allele (int, optional): Highest allele index to count. Defaults to MAX_ALLELE.
+
+    Returns:
+        np.arr: Allele counts with shape (snps, timepoints, max_allele + 1).
+    """
+    return np.stack(
+        [
+            allel.GenotypeArray(timepoint).count_alleles(max_allele=max_allele)
+            for timepoint in split_arr(genos, samp_sizes)
+        ],
+        axis=1,
+    )
+
+
 def get_vel_minor_alleles(ts_genos, max_allele):
     """
     Gets index of minor allele to use for MAF.
@@ -191,6 +960,24 @@ def get_vel_minor_alleles(ts_genos, max_allele):
         return np.argmax(last_genos - first_genos, axis=1), first_genos, last_genos
 
 
+def get_vel_minor_alleles_from_counts(ts_counts):
+    """
+    Gets index of minor allele to use for MAF from per-timepoint allele counts.
+    Based on the highest-velocity allele from the first to the last timepoint, same as get_vel_minor_alleles().
+
+    Args:
+        ts_counts (np.arr): Allele counts with shape (snps, timepoints, alleles), see count_ts_alleles().
+
+    Returns:
+        np.arr: Array of indices of minor alleles.
+    """
+    if ts_counts.shape[1] == 1:
+        # Single timepoint
+        return np.argmax(ts_counts[:, 0], axis=1)
+
+    return np.argmax(ts_counts[:, -1] - ts_counts[:, 0], axis=1)
+
+
 def get_last_minor_alleles(ts_genos, max_allele):
     """
     Gets index of minor allele to use for MAF.
@@ -217,14 +1004,36 @@ def calc_maft(snp, min_allele_idx):
         min_allele_idx (int): Index of minor allele.
 
     Returns:
-        float: Minor allele frequency (MAF) at a given timepoint.
+        float: Minor allele frequency (MAF) at a given timepoint, 0 if there are no calls.
     """
-    try:
-        maf = np.divide(snp[min_allele_idx], snp.sum())
-        return maf
-    except RuntimeWarning:
+    total = snp.sum()
+    if total == 0:
         return 0.0
 
+    return np.divide(snp[min_allele_idx], total)
+
+
+def calc_ts_maft(ts_counts, min_alleles):
+    """
+    Calculates minor allele frequency of every SNP at every timepoint at once.
+
+    Args:
+        ts_counts (np.arr): Allele counts with shape (snps, timepoints, alleles), see count_ts_alleles().
+        min_alleles (np.arr): Index of the minor allele of each SNP.
+
+    Returns:
+        np.arr: MAF of shape (timepoints, snps), 0 where a timepoint has no calls for a SNP.
+    """
+    min_counts = np.take_along_axis(
+        ts_counts, np.asarray(min_alleles)[:, None, None], axis=2
+    )[:, :, 0]
+    totals = ts_counts.sum(axis=2)
+
+    maft = np.zeros(totals.shape, dtype=np.float64)
+    np.divide(min_counts, totals, out=maft, where=totals > 0)
+
+    return maft.T
+
 
 def get_allele_counts(snp, min_allele_idx):
     min_counts = snp[min_allele_idx]
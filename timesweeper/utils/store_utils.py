@@ -0,0 +1,568 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+STORE_MANIFEST = "manifest.json"
+STORE_VERSION = 1
+# Number of examples (windows) in each training store shard
+TRAINING_SHARD_SIZE = 4096
+# Per-replicate label columns of a training store, features are stored under their data type
+TRAINING_FIELDS = ["scenario", "rep", "sel_coeff", "center_offset", "window"]
+
+
+### Columnar genotype store
+def is_store(path):
+    """Checks whether a path is a genotype store written by `timesweeper index`."""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, STORE_MANIFEST))
+
+
+def read_manifest(store_dir):
+    """Reads the JSON manifest describing the chunks and metadata of a store."""
+    with open(os.path.join(store_dir, STORE_MANIFEST), "r") as infile:
+        manifest = json.load(infile)
+
+    return manifest
+
+
+def write_manifest(store_dir, manifest):
+    """Writes manifest to a temp file and moves it into place so readers never see a partial one."""
+    tmp_file = os.path.join(store_dir, STORE_MANIFEST + ".tmp")
+    with open(tmp_file, "w") as outfile:
+        json.dump(manifest, outfile, indent=2)
+    os.replace(tmp_file, os.path.join(store_dir, STORE_MANIFEST))
+
+
+def field_path(chunk_dir, field):
+    """Maps an allel-style field name (e.g. 'calldata/GT') to its .npy file in a chunk directory."""
+    return os.path.join(chunk_dir, f"{field}.npy")
+
+
+def write_arrays(store_dir, name, arrays):
+    """
+    Writes arrays as individual .npy files into a temp directory and moves it into place as store_dir/name.
+
+    Args:
+        store_dir (str): Store directory.
+        name (str): Name of the chunk or shard directory.
+        arrays (dict): Field name to array mapping.
+    """
+    tmp_dir = os.path.join(store_dir, name + ".tmp")
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    for field, arr in arrays.items():
+        os.makedirs(os.path.dirname(field_path(tmp_dir, field)), exist_ok=True)
+        if arr.dtype == object:
+            arr = arr.astype(str)  # Object arrays can't be memory-mapped
+        np.save(field_path(tmp_dir, field), arr)
+
+    out_dir = os.path.join(store_dir, name)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+
+def write_store_chunk(store_dir, chunk_idx, chunk):
+    """
+    Writes all fields of a chunk as individual .npy files.
+
+    Args:
+        store_dir (str): Store directory.
+        chunk_idx (int): Index of the chunk, used for naming.
+        chunk (dict): Field name to array mapping, all arrays indexed by SNP on the first axis.
+
+    Returns:
+        dict: Manifest entry for the chunk.
+    """
+    name = f"chunk_{chunk_idx:05d}"
+    write_arrays(store_dir, name, chunk)
+
+    chroms = chunk["variants/CHROM"]
+    positions = chunk["variants/POS"]
+
+    return {
+        "name": name,
+        "n_variants": int(len(positions)),
+        "chroms": [str(c) for c in dict.fromkeys(chroms)],
+        "first": [str(chroms[0]), int(positions[0])],
+        "last": [str(chroms[-1]), int(positions[-1])],
+    }
+
+
+def load_store_chunk(store_dir, chunk_entry, fields=None, mmap_mode="r"):
+    """
+    Loads a chunk from the store as a dict of memory-mapped arrays.
+
+    Args:
+        store_dir (str): Store directory.
+        chunk_entry (dict): Entry from the manifest "chunks" list.
+        fields (list[str], optional): Fields to load. Defaults to all fields in the store.
+        mmap_mode (str, optional): Passed to np.load. Defaults to "r".
+
+    Returns:
+        dict: VCF dict-like chunk.
+    """
+    if fields is None:
+        fields = read_manifest(store_dir)["fields"]
+
+    chunk_dir = os.path.join(store_dir, chunk_entry["name"])
+    return {
+        field: np.load(field_path(chunk_dir, field), mmap_mode=mmap_mode)
+        for field in fields
+        if os.path.exists(field_path(chunk_dir, field))
+    }
+
+
+def iter_store_chunks(store_dir, fields=None, chunks=None):
+    """
+    Generator of store chunks shaped like allel.iter_vcf_chunks output.
+
+    Args:
+        store_dir (str): Store directory.
+        fields (list[str], optional): Fields to load. Defaults to all fields in the store.
+        chunks (list[dict], optional): Subset of manifest chunk entries to load.
+
+    Yields:
+        tuple[dict, int, str, int]: (chunk, n_variants, chrom, pos) just like skallel does.
+    """
+    if chunks is None:
+        chunks = read_manifest(store_dir)["chunks"]
+
+    for entry in chunks:
+        chunk = load_store_chunk(store_dir, entry, fields)
+        yield chunk, entry["n_variants"], entry["last"][0], entry["last"][1]
+
+
+def get_store_contigs(store_dir):
+    """
+    Gets contig names and the position of their last record from a store, in file order.
+
+    Args:
+        store_dir (str): Store directory.
+
+    Returns:
+        dict: Contig name to last position on it.
+    """
+    contigs = {}
+    for entry in read_manifest(store_dir)["chunks"]:
+        chunk = load_store_chunk(store_dir, entry, ["variants/CHROM", "variants/POS"])
+        chroms = chunk["variants/CHROM"]
+        last_idxs = np.append(np.flatnonzero(chroms[1:] != chroms[:-1]), len(chroms) - 1)
+        for idx in last_idxs:
+            contigs[str(chroms[idx])] = int(chunk["variants/POS"][idx])
+
+    return contigs
+
+
+def read_store_region(store_dir, chrom, start=None, end=None, fields=None):
+    """
+    Pulls all records on chrom with start <= POS <= end from the store.
+
+    Args:
+        store_dir (str): Store directory.
+        chrom (str): Chromosome/contig name.
+        start (int, optional): 1-based inclusive start position. Defaults to the beginning of chrom.
+        end (int, optional): 1-based inclusive end position. Defaults to the end of chrom.
+        fields (list[str], optional): Fields to load. Defaults to all fields in the store.
+
+    Returns:
+        dict: VCF dict-like object, or None if no records are in the region.
+    """
+    start = 0 if start is None else start
+    end = np.iinfo(np.int64).max if end is None else end
+
+    pieces = []
+    for entry in read_manifest(store_dir)["chunks"]:
+        if str(chrom) not in entry["chroms"]:
+            continue
+
+        chunk = load_store_chunk(store_dir, entry, fields)
+        on_chrom = np.flatnonzero(chunk["variants/CHROM"] == str(chrom))
+        positions = chunk["variants/POS"][on_chrom]
+        # Records within a chromosome are sorted, slice with a binary search
+        lo = np.searchsorted(positions, start, side="left")
+        hi = np.searchsorted(positions, end, side="right")
+        idxs = on_chrom[lo:hi]
+        if len(idxs):
+            pieces.append({field: np.asarray(arr[idxs]) for field, arr in chunk.items()})
+
+    if not pieces:
+        return None
+
+    return {field: np.concatenate([p[field] for p in pieces]) for field in pieces[0]}
+
+
+### Sharded training data store
+def is_training_store(path):
+    """Checks whether a path is a training data store written by `timesweeper condense`."""
+    return is_store(path) and read_manifest(path).get("type") == "training"
+
+
+def write_training_shard(store_dir, shard_idx, examples, data_types):
+    """
+    Writes condensed replicates as a shard of contiguous feature arrays and columnar labels.
+
+    Args:
+        store_dir (str): Store directory.
+        shard_idx (int): Index of the shard, used for naming.
+        examples (list[tuple]): (rep, scenario, features, sel_coeff, center_offset, window) of each example, features being a dict of data type to array.
+        data_types (list[str]): Feature types to write, every example needs all of them.
+
+    Returns:
+        dict: Manifest entry for the shard.
+    """
+    reps, scenarios, feats, sel_coeffs, offsets, windows = zip(*examples)
+    arrays = {
+        "scenario": np.array(scenarios, dtype=str),
+        "rep": np.array(reps, dtype=str),
+        "sel_coeff": np.array(sel_coeffs, dtype=np.float64),
+        "center_offset": np.array(offsets, dtype=np.int64),
+        "window": np.array(windows, dtype=str),
+    }
+    for data_type in data_types:
+        arrays[data_type] = np.stack([f[data_type] for f in feats]).astype(np.float32)
+
+    name = f"shard_{shard_idx:05d}"
+    write_arrays(store_dir, name, arrays)
+
+    return {"name": name, "n_examples": len(examples)}
+
+
+def get_replicate_key(path):
+    """Size and modification time of a replicate, a replicate is condensed again if either changes."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def get_store_mismatches(manifest, data_types, config):
+    """Names of the data types and config keys a training store was condensed with that differ from the given ones."""
+    mismatches = []
+    if manifest.get("data types") != list(data_types):
+        mismatches.append("data types")
+    if "replicates" not in manifest:
+        mismatches.append("replicates")
+
+    stored = manifest.get("config") or {}
+    config = config or {}
+    mismatches += sorted(
+        key for key in set(stored) | set(config) if stored.get(key) != config.get(key)
+    )
+
+    return mismatches
+
+
+def open_training_store(store_dir, data_types, config=None, overwrite=False):
+    """
+    Gets the manifest of a training store to append to, starting a new store if there's none yet.
+    Stores condensed with different data types or feature config aren't appended to, their replicates don't mix.
+    Only an existing training store is ever removed, and only with overwrite.
+
+    Args:
+        store_dir (str): Store directory.
+        data_types (list[str]): Feature types to write.
+        config (dict, optional): JSON-able feature settings replicates are condensed with, e.g. window size.
+        overwrite (bool, optional): Start an existing training store over even if it matches.
+
+    Returns:
+        dict: Manifest of the store, already on disk.
+    """
+    # Compare through JSON so tuples and lists match what was read back
+    config = json.loads(json.dumps(config))
+    if is_training_store(store_dir):
+        if overwrite:
+            shutil.rmtree(store_dir)
+        else:
+            manifest = read_manifest(store_dir)
+            mismatches = get_store_mismatches(manifest, data_types, config)
+            if not mismatches:
+                return manifest
+
+            raise ValueError(
+                f"{store_dir} was condensed with different {', '.join(mismatches)}, "
+                "use another output or --overwrite to start it over"
+            )
+
+    elif os.path.exists(store_dir) and (
+        not os.path.isdir(store_dir) or os.listdir(store_dir)
+    ):
+        raise ValueError(f"{store_dir} exists and isn't a training store, refusing to write to it")
+
+    os.makedirs(store_dir, exist_ok=True)
+
+    manifest = {
+        "version": STORE_VERSION,
+        "type": "training",
+        "data types": list(data_types),
+        "config": config,
+        "n_examples": 0,
+        "shards": [],
+        "replicates": {},
+    }
+    write_manifest(store_dir, manifest)
+
+    return manifest
+
+
+def get_store_samples(store_dir, manifest, samples):
+    """
+    Gets the samples a training store is condensed from, saving samples as them if the store has none yet.
+    Randomly subsampled individuals are drawn once per store, so later runs condense new replicates from the same ones.
+
+    Args:
+        store_dir (str): Store directory.
+        manifest (dict): Manifest of the store, see open_training_store(). Updated in place.
+        samples (list[str]): Samples drawn for this run.
+
+    Returns:
+        list[str]: Samples to condense with.
+    """
+    if manifest.get("samples") is None:
+        manifest["samples"] = samples
+        write_manifest(store_dir, manifest)
+
+    return manifest["samples"]
+
+
+def get_pending_replicates(manifest, paths):
+    """
+    Filters out replicates the store already holds, unchanged since they were condensed.
+
+    Args:
+        manifest (dict): Training store manifest, see open_training_store().
+        paths (list[str]): Replicate files.
+
+    Returns:
+        list[str]: Paths that are new or changed, in the given order.
+    """
+    done = manifest["replicates"]
+    pending = []
+    for path in paths:
+        entry = done.get(os.path.abspath(path))
+        if entry is None or {k: entry[k] for k in ("size", "mtime")} != get_replicate_key(path):
+            pending.append(path)
+
+    return pending
+
+
+def append_training_store(store_dir, manifest, results, shard_size=TRAINING_SHARD_SIZE):
+    """
+    Streams condensed replicates into new shards of about shard_size examples as they come in, so only one shard is ever held in memory.
+    All examples of a replicate go into the same shard.
+    The manifest is rewritten after every shard, so a killed run loses at most one shard of work and picks up from there.
+
+    Args:
+        store_dir (str): Store directory.
+        manifest (dict): Manifest of the store, see open_training_store(). Updated in place.
+        results (iterable[tuple[str, list]]): (replicate path, examples) pairs, see write_training_shard() for examples. \
+            Examples are None for replicates that failed, which are recorded too so they aren't retried until they change.
+        shard_size (int, optional): Number of examples per shard.
+
+    Returns:
+        dict: Updated manifest.
+    """
+    pending = []
+    failed = []
+
+    def flush():
+        name = None
+        if pending:
+            entry = write_training_shard(
+                store_dir,
+                len(manifest["shards"]),
+                [example for _, examples in pending for example in examples],
+                manifest["data types"],
+            )
+            manifest["shards"].append(entry)
+            name = entry["name"]
+
+        # A replicate condensed again points at its new rows, the old ones are dropped on read
+        idx = 0
+        for path, examples in pending:
+            manifest["replicates"][os.path.abspath(path)] = {
+                **get_replicate_key(path),
+                "shard": name,
+                "index": idx,
+                "count": len(examples),
+            }
+            idx += len(examples)
+        for path in failed:
+            manifest["replicates"][os.path.abspath(path)] = {
+                **get_replicate_key(path),
+                "shard": None,
+                "index": None,
+                "count": 0,
+            }
+        manifest["n_examples"] = sum(r["count"] for r in manifest["replicates"].values())
+        write_manifest(store_dir, manifest)
+        pending.clear()
+        failed.clear()
+
+    n_pending = 0
+    for path, examples in results:
+        if examples:
+            pending.append((path, examples))
+            n_pending += len(examples)
+        else:
+            failed.append(path)
+        if n_pending >= shard_size:
+            flush()
+            n_pending = 0
+    flush()
+
+    return manifest
+
+
+def write_training_store(store_dir, results, data_types, shard_size=TRAINING_SHARD_SIZE):
+    """
+    Writes condensed replicates to a new training store, see append_training_store().
+
+    Args:
+        store_dir (str): Directory to write the store to, will be overwritten.
+        results (iterable[tuple[str, list]]): (replicate path, examples) pairs, see append_training_store().
+        data_types (list[str]): Feature types to write.
+        shard_size (int, optional): Number of examples per shard.
+
+    Returns:
+        dict: Manifest of the written store.
+    """
+    manifest = open_training_store(store_dir, data_types, overwrite=True)
+
+    return append_training_store(store_dir, manifest, results, shard_size)
+
+
+def get_live_rows(manifest):
+    """
+    Masks the rows of each shard that still belong to a replicate, rows of replicates condensed again later are dropped.
+
+    Args:
+        manifest (dict): Training store manifest.
+
+    Returns:
+        list[np.arr]: Boolean mask for each shard.
+    """
+    if "replicates" not in manifest:
+        return [np.ones(entry["n_examples"], dtype=bool) for entry in manifest["shards"]]
+
+    live = {entry["name"]: np.zeros(entry["n_examples"], dtype=bool) for entry in manifest["shards"]}
+    for rep in manifest["replicates"].values():
+        if rep["shard"] is not None:
+            live[rep["shard"]][rep["index"] : rep["index"] + rep.get("count", 1)] = True
+
+    return [live[entry["name"]] for entry in manifest["shards"]]
+
+
+def get_row_replicates(manifest):
+    """
+    Maps the rows of each shard to the replicate they were condensed from, every window of a replicate shares it.
+
+    Args:
+        manifest (dict): Training store manifest.
+
+    Returns:
+        list[np.arr]: Replicate path of each row of each shard, empty for stores that don't record replicates.
+    """
+    rows = {entry["name"]: np.full(entry["n_examples"], "", dtype=object) for entry in manifest["shards"]}
+    for path, rep in manifest.get("replicates", {}).items():
+        if rep["shard"] is not None:
+            rows[rep["shard"]][rep["index"] : rep["index"] + rep.get("count", 1)] = path
+
+    return [rows[entry["name"]] for entry in manifest["shards"]]
+
+
+def load_training_labels(store_dir, shard_entry):
+    """Loads the label columns of a shard, shards written before windows were labelled only hold center windows."""
+    shard = load_store_chunk(store_dir, shard_entry, TRAINING_FIELDS)
+    if "window" not in shard:
+        shard["window"] = np.full(shard_entry["n_examples"], "center")
+
+    return shard
+
+
+def read_training_labels(store_dir):
+    """
+    Reads just the label columns of a training store, without touching any features.
+
+    Args:
+        store_dir (str): Store directory.
+
+    Returns:
+        dict: TRAINING_FIELDS label arrays of all replicates, in store order.
+    """
+    manifest = read_manifest(store_dir)
+    labels = {field: [] for field in TRAINING_FIELDS}
+    for entry, live in zip(manifest["shards"], get_live_rows(manifest)):
+        shard = load_training_labels(store_dir, entry)
+        for field in TRAINING_FIELDS:
+            labels[field].append(np.asarray(shard[field])[live])
+
+    return {
+        field: np.concatenate(arrs) if arrs else np.empty(0)
+        for field, arrs in labels.items()
+    }
+
+
+def read_training_data(store_dir, data_type, scenarios=None, transform=None):
+    """
+    Reads one feature type and the labels of a training store into a single preallocated array.
+    Shards are memory-mapped and copied straight into place, so peak memory is about the size of the result.
+
+    Args:
+        store_dir (str): Store directory.
+        data_type (str): Feature type to read, e.g. "aft" or "hft".
+        scenarios (list[str], optional): Only read replicates of these scenarios. Defaults to all of them.
+        transform (callable, optional): Applied to the features of each shard before they are copied, e.g. to resize HFTs.
+
+    Returns:
+        dict: "data" array of shape (examples, ...), the TRAINING_FIELDS label arrays, and the "replicate" each example
+            was condensed from, all in store order. Replicates are scenario/rep for stores that don't record them.
+    """
+    manifest = read_manifest(store_dir)
+    if data_type not in manifest["data types"]:
+        raise ValueError(f"{store_dir} has no {data_type} data, only {manifest['data types']}")
+
+    # Labels are small, use them to size the output before touching any features
+    labels = {field: [] for field in TRAINING_FIELDS + ["replicate"]}
+    masks = []
+    for entry, live, replicates in zip(
+        manifest["shards"], get_live_rows(manifest), get_row_replicates(manifest)
+    ):
+        shard = load_training_labels(store_dir, entry)
+        mask = live.copy()
+        if scenarios is not None:
+            mask &= np.isin(shard["scenario"], scenarios)
+        masks.append(mask)
+        for field in TRAINING_FIELDS:
+            labels[field].append(np.asarray(shard[field])[mask])
+
+        # Older stores only hold center windows, so scenario and rep identify their replicates
+        unknown = replicates == ""
+        replicates[unknown] = np.char.add(
+            np.char.add(np.asarray(shard["scenario"], dtype=str)[unknown], "/"),
+            np.asarray(shard["rep"], dtype=str)[unknown],
+        )
+        labels["replicate"].append(replicates[mask])
+    labels = {
+        field: np.concatenate(arrs) if arrs else np.empty(0)
+        for field, arrs in labels.items()
+    }
+
+    data = None
+    filled = 0
+    for entry, mask in zip(manifest["shards"], masks):
+        if not mask.any():
+            continue
+
+        feats = load_store_chunk(store_dir, entry, [data_type])[data_type][mask]
+        if transform is not None:
+            feats = transform(feats)
+        if data is None:
+            data = np.empty((len(labels["rep"]), *feats.shape[1:]), dtype=feats.dtype)
+        data[filled : filled + len(feats)] = feats
+        filled += len(feats)
+
+    if data is None:
+        data = np.empty((0,), dtype=np.float32)
+
+    return {"data": data, **labels}
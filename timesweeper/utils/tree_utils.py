@@ -0,0 +1,233 @@
+import numpy as np
+
+# Tree-sequence libraries are optional, only needed for sim_stdpopsim --recapitate
+try:
+    import msprime
+    import pyslim
+    import tskit
+except ImportError:
+    msprime = pyslim = tskit = None
+
+# Alt bases written for the derived alleles of a site, sites with more than this many in the samples are dropped
+ALT_BASES = ["T", "C", "G"]
+# SLiM mutation type neutral mutations are overlaid as, same as m1 in stdpopsim scripts
+NEUTRAL_MUT_TYPE = 1
+
+
+def check_tree_seq_libs():
+    """Raises if msprime, pyslim, or tskit are missing."""
+    if msprime is None:
+        raise ImportError(
+            "Recapitation needs msprime, pyslim, and tskit, install them with pip install timesweeper[tree-seq]"
+        )
+
+
+def scale_recomb_rate(recomb_rate, Q):
+    """Per-tick recombination rate of a stdpopsim script rescaled by Q, same as the script uses."""
+    return (1 - (1 - 2 * recomb_rate) ** Q) / 2
+
+
+def recapitate(ts, ancestral_Ne, recomb_rate, mut_rate, seed=None):
+    """
+    Simulates the burn-in a tree sequence skipped with the coalescent, then overlays neutral mutations on all of it.
+    Mutations already in the tree sequence (e.g. the sweep) are kept.
+
+    Args:
+        ts (tskit.TreeSequence): Tree sequence written by SLiM.
+        ancestral_Ne (int): Size of the population before the SLiM simulation started.
+        recomb_rate (float): Recombination rate per tick.
+        mut_rate (float): Neutral mutation rate per tick.
+        seed (int, optional): Random seed. Defaults to a random one.
+
+    Returns:
+        tskit.TreeSequence: Recapitated tree sequence with neutral mutations.
+    """
+    rng = np.random.default_rng(seed)
+    ts = pyslim.recapitate(
+        ts,
+        ancestral_Ne=ancestral_Ne,
+        recombination_rate=recomb_rate,
+        random_seed=rng.integers(1, 2 ** 31),
+    )
+    next_id = pyslim.next_slim_mutation_id(ts)
+
+    return msprime.sim_mutations(
+        ts,
+        rate=mut_rate,
+        model=msprime.SLiMMutationModel(type=NEUTRAL_MUT_TYPE, next_id=next_id),
+        keep=True,
+        random_seed=rng.integers(1, 2 ** 31),
+    )
+
+
+def get_tp_nodes(ts, num_tps):
+    """
+    Groups the sample nodes of remembered individuals by the time they were sampled at.
+
+    Args:
+        ts (tskit.TreeSequence): Tree sequence written by SLiM.
+        num_tps (int): Number of timepoints sampled.
+
+    Returns:
+        list[np.arr]: Nodes of each timepoint oldest first, the two nodes of each individual next to each other.
+    """
+    node_times = ts.tables.nodes.time
+    remembered = [
+        ind
+        for ind in ts.individuals()
+        if ind.flags & pyslim.INDIVIDUAL_REMEMBERED
+    ]
+    ind_times = np.array([node_times[ind.nodes[0]] for ind in remembered])
+
+    # Times are ticks ago, so the oldest sample has the largest time
+    tp_times = np.unique(ind_times)[::-1]
+    if len(tp_times) != num_tps:
+        raise ValueError(
+            f"Found samples at {len(tp_times)} times, expected {num_tps} timepoints"
+        )
+
+    return [
+        np.concatenate(
+            [ind.nodes for ind, t in zip(remembered, ind_times) if t == tp_time]
+        )
+        for tp_time in tp_times
+    ]
+
+
+def get_mut_info(mut):
+    """SLiM mutation type and selection coefficient of a mutation, overlaid ones without metadata are neutral."""
+    mut_list = mut.metadata.get("mutation_list") if mut.metadata else None
+    if not mut_list:
+        return NEUTRAL_MUT_TYPE, 0.0
+
+    # SLiM keeps selection coefficients as float32, written by their shortest float32 repr (0.1 not 0.10000000149011612)
+    return mut_list[-1]["mutation_type"], float(str(np.float32(mut_list[-1]["selection_coeff"])))
+
+
+def get_site_fields(ts, tp_nodes):
+    """
+    Pulls the variants of the sampled nodes out of a tree sequence.
+
+    Args:
+        ts (tskit.TreeSequence): Recapitated tree sequence, see recapitate().
+        tp_nodes (list[np.arr]): Nodes of each timepoint, see get_tp_nodes().
+
+    Returns:
+        np.arr: 1-based positions.
+        np.arr: Allele of each sampled node at each site, shape (sites, nodes).
+        list[list[int]]: SLiM mutation type of each derived allele at each site.
+        list[list[float]]: Selection coefficient of each derived allele at each site.
+    """
+    samples = np.concatenate(tp_nodes)
+    positions, genos, mut_types, sel_coeffs = [], [], [], []
+    for var in ts.variants(samples=samples):
+        n_alt = len(var.alleles) - 1
+        if not var.genotypes.any() or n_alt > len(ALT_BASES):
+            continue
+
+        # Derived states are SLiM mutation id stacks, the mutation that made each one is the last in its stack
+        muts = {m.derived_state: m for m in var.site.mutations}
+        mut_info = [get_mut_info(muts[a]) for a in var.alleles[1:]]
+
+        positions.append(int(var.site.position) + 1)
+        genos.append(var.genotypes)
+        mut_types.append([i[0] for i in mut_info])
+        sel_coeffs.append([i[1] for i in mut_info])
+
+    genos = np.array(genos, dtype=np.int8).reshape(-1, len(samples))
+
+    return np.array(positions, dtype=np.int64), genos, mut_types, sel_coeffs
+
+
+def write_merged_vcf(
+    outfile, positions, genos, samp_sizes, mut_types, sel_coeffs, chrom_len, ploidy=2
+):
+    """
+    Writes sampled genotypes as a merged VCF, same as process_vcfs writes from SLiM multivcfs.
+    Genotypes are written unphased like the homozygous ref fill of merged forward simulations.
+
+    Args:
+        outfile (str): VCF to write.
+        positions (np.arr): 1-based position of each site.
+        genos (np.arr): Allele of each sampled chromosome at each site, shape (sites, chromosomes).
+            Chromosomes are in timepoint order, with the ploidy chromosomes of each individual next to each other.
+        samp_sizes (list[int]): Number of individuals sampled at each timepoint.
+        mut_types (list[list[int]]): SLiM mutation type of each derived allele at each site.
+        sel_coeffs (list[list[float]]): Selection coefficient of each derived allele at each site.
+        chrom_len (int): Length of the simulated chromosome.
+        ploidy (int, optional): Ploidy of samples. Defaults to 2.
+    """
+    samples = [
+        f"i{i}" if tp == 0 else f"{tp + 1}:i{i}"
+        for tp, n_inds in enumerate(samp_sizes)
+        for i in range(n_inds)
+    ]
+    order = np.argsort(positions, kind="stable")
+
+    with open(outfile, "w") as ofile:
+        ofile.write("##fileformat=VCFv4.2\n")
+        ofile.write(
+            '##INFO=<ID=MT,Number=.,Type=Integer,Description="Mutation type">\n'
+        )
+        ofile.write(
+            '##INFO=<ID=S,Number=.,Type=Float,Description="Selection coefficient">\n'
+        )
+        ofile.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        ofile.write(f"##contig=<ID=1,length={chrom_len}>\n")
+        ofile.write(
+            "\t".join(
+                ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+                + samples
+            )
+            + "\n"
+        )
+
+        for idx in order:
+            n_alt = len(mut_types[idx])
+            info = f"MT={','.join(str(i) for i in mut_types[idx])};S={','.join(str(i) for i in sel_coeffs[idx])}"
+            gts = genos[idx].astype(str).reshape(-1, ploidy)
+            ofile.write(
+                "\t".join(
+                    ["1", str(positions[idx]), ".", "A", ",".join(ALT_BASES[:n_alt])]
+                    + ["1000", "PASS", info, "GT"]
+                    + ["/".join(gt) for gt in gts]
+                )
+                + "\n"
+            )
+
+
+def recapitate_replicate(
+    trees_file,
+    outfile,
+    num_tps,
+    ancestral_Ne,
+    recomb_rate,
+    mut_rate,
+    chrom_len,
+    seed=None,
+):
+    """
+    Turns the tree sequence of a replicate into its merged VCF, without a multivcf or a forward-simulated burn-in.
+
+    Args:
+        trees_file (str): Tree sequence written by SLiM.
+        outfile (str): Merged VCF to write.
+        num_tps (int): Number of timepoints sampled.
+        ancestral_Ne (int): Size of the population before the SLiM simulation started.
+        recomb_rate (float): Recombination rate per tick.
+        mut_rate (float): Neutral mutation rate per tick.
+        chrom_len (int): Length of the simulated chromosome.
+        seed (int, optional): Random seed. Defaults to a random one.
+    """
+    ts = recapitate(tskit.load(trees_file), ancestral_Ne, recomb_rate, mut_rate, seed)
+    tp_nodes = get_tp_nodes(ts, num_tps)
+    positions, genos, mut_types, sel_coeffs = get_site_fields(ts, tp_nodes)
+    write_merged_vcf(
+        outfile,
+        positions,
+        genos,
+        [len(nodes) // 2 for nodes in tp_nodes],
+        mut_types,
+        sel_coeffs,
+        chrom_len,
+    )